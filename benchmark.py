@@ -0,0 +1,1304 @@
+import argparse
+import asyncio
+import bisect
+import gc
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Callable, Iterator, Optional
+from urllib.parse import urljoin
+
+from requests.adapters import HTTPAdapter
+
+import mock_server
+from main import (
+    AdaptivePolicy, AmbiguousAscFacility, AscSlotStore, Bot, BookingCandidate, Cassette, Clock, Config,
+    CronPolicy, HistoryStore, IntervalPolicy, Logger, Orchestrator, RateGovernor, RecordingAdapter,
+    ReplayAdapter, Scheduler, SchedulePolicy,
+    date_ordinal, extract_applications, extract_csrf, extract_options, match_asc_facilities, pair_asc_slots,
+    parse_date, parse_schedule, read_dates, send_control, start_control_server, summarize,
+    ASC_POLICY_CLOSEST, ASC_POLICY_EARLIEST, BOOKING_UNKNOWN, DAYS_CHUNK_SIZE, DEFAULT_POLL_SCHEDULE,
+    DEFAULT_TIMES_TTL, LOG_FORMAT, METRICS
+)
+from mock_server import MockAis, MockServer
+
+
+class FakeClock(Clock):
+    def __init__(self, start: float):
+        self.current = start
+        self.sleeps = 0
+
+    def now(self) -> float:
+        return self.current
+
+    def sleep(self, seconds: float):
+        self.sleeps += 1
+        self.current += seconds
+
+    def wait(self, seconds: float, event: threading.Event) -> bool:
+        if seconds > 0:
+            self.sleep(seconds)
+        return False
+
+
+class RecordingPolicy(IntervalPolicy):
+    def __init__(self, seconds: float):
+        super().__init__(seconds)
+        self.due = 0.0
+
+    def next(self, after: float) -> float:
+        self.due = super().next(after)
+        return self.due
+
+
+class QuietLogger:
+    def __call__(self, message: str | Exception, level: int = logging.INFO):
+        pass
+
+    def debug(self, message: str):
+        pass
+
+
+quiet = QuietLogger()
+
+
+def make_bot(
+        server: MockServer,
+        directory: str,
+        name: str = "config",
+        bot_class: type[Bot] = Bot,
+        adapter: HTTPAdapter = None,
+        **params: str
+) -> Bot:
+    state = server.state
+    values = {
+        "EMAIL": state.email,
+        "PASSWORD": state.password,
+        "COUNTRY": state.country,
+        "FACILITY_ID": next(iter(state.facilities)),
+        "MIN_DATE": "01.01.2026",
+        "MAX_DATE": "None",
+        "NEED_ASC": "False",
+        "ASC_FACILITY_ID": next(iter(state.asc_facilities)),
+        "SCHEDULE_ID": state.schedule_id,
+        "SESSION_TTL": "0",
+        **params
+    }
+    config_file = os.path.join(directory, name)
+    with open(config_file, "w") as f:
+        f.write("\n".join(f"{k}={v}" for k, v in values.items()))
+
+    return bot_class(
+        Config(config_file),
+        quiet,
+        f"{config_file}.asc",
+        f"{config_file}.session",
+        adapter,
+        server.url
+    )
+
+
+def mock_ais(**params) -> MockAis:
+    return MockAis(appointment_datetime=datetime(2027, 6, 1, 9, 0), **params)
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def bench_scheduler(hours: float = 1, poll_seconds: float = 0.5):
+    start = datetime(2026, 1, 1, 12, 0, 0).timestamp()
+    end = start + hours * 3600
+
+    def at(minute: int, second: int, hour: int = 12, day: int = 1) -> float:
+        return datetime(2026, 1, day, hour, minute, second).timestamp()
+
+    cron = CronPolicy(DEFAULT_POLL_SCHEDULE)
+    assert cron.next(at(0, 0)) == at(0, 10)
+    assert cron.next(at(0, 10)) == at(0, 12)
+    assert cron.next(at(0, 10) + 0.5) == at(0, 12)
+    assert cron.next(at(0, 11)) == at(0, 12)
+    assert cron.next(at(0, 58)) == at(5, 10)
+    assert cron.next(at(57, 30)) == at(0, 10, hour=13)
+    assert CronPolicy("0 0 0").next(at(0, 0)) == at(0, 0, hour=0, day=2)
+    assert CronPolicy("30 */15 9-10").next(at(59, 59, hour=10)) == at(0, 30, hour=9, day=2)
+
+    # Loop which was used in Bot.process before the scheduler: sleep 1.5 s and check the window
+    clock = FakeClock(start)
+    legacy_polls = []
+    while clock.now() < end:
+        clock.sleep(1.5)
+        now = datetime.fromtimestamp(clock.now())
+        if now.minute % 5 != 0 or now.second < 10:
+            continue
+        legacy_polls.append(clock.now())
+        clock.current += poll_seconds
+    legacy_wakeups = clock.sleeps
+
+    clock = FakeClock(start)
+    polls = []
+    scheduler = Scheduler(clock)
+
+    def poll():
+        polls.append(clock.now())
+        clock.current += poll_seconds
+        if clock.now() >= end:
+            scheduler.stop()
+
+    scheduler.add(parse_schedule(DEFAULT_POLL_SCHEDULE), poll)
+    scheduler.run()
+    assert polls[0] == start + 10
+    assert all(datetime.fromtimestamp(x).minute % 5 == 0 and datetime.fromtimestamp(x).second >= 10 for x in polls)
+    assert all(b - a >= 2 for a, b in zip(polls, polls[1:]))
+    assert len([x for x in polls if x < end]) == round(hours * 12) * 25
+
+    def window_delays(fired: list[float]) -> list[float]:
+        delays = dict()
+        for x in fired:
+            opened = datetime.fromtimestamp(x).replace(second=10, microsecond=0).timestamp()
+            delays.setdefault(opened, x - opened)
+        return list(delays.values())
+
+    print(f"Simulated {hours} h, poll takes {poll_seconds} s")
+    print(f"{'':<12}{'wakeups':>10}{'polls':>10}{'window open delay p50/max, s':>32}")
+    for name, wakeups, fired in (
+            ("1.5 s loop", legacy_wakeups, legacy_polls),
+            ("scheduler", scheduler.wakeups, polls)
+    ):
+        delays = window_delays(fired)
+        print(f"{name:<12}{wakeups:>10}{len(fired):>10}"
+              f"{statistics.median(delays):>22.3f} / {max(delays):.3f}")
+
+    fires = 200
+    jitter = []
+    scheduler = Scheduler()
+    policy = RecordingPolicy(0.01)
+
+    def measure():
+        jitter.append(time.time() - policy.due)
+        if len(jitter) >= fires:
+            scheduler.stop()
+
+    scheduler.add(policy, measure)
+    scheduler.run()
+    print(f"Real clock firing jitter over {fires} fires: "
+          f"p50 {statistics.median(jitter) * 1000:.3f} ms, "
+          f"p99 {percentile(jitter, 0.99) * 1000:.3f} ms, "
+          f"max {max(jitter) * 1000:.3f} ms")
+
+
+def measure_parse(parse: Callable, repeat: int) -> tuple[float, float]:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        parse()
+    elapsed = (time.perf_counter() - started) / repeat
+
+    tracemalloc.start()
+    parse()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_parse(repeat: int = 20):
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        BeautifulSoup = None
+
+    csrf = "Kx3F" * 20
+    facilities = {str(90 + i): f"Consulate {i}" for i in range(10)}
+    asc_facilities = {str(120 + i): f"ASC {i}" for i in range(10)}
+    pages = {
+        "sign_in": mock_server.sign_in_page(csrf),
+        "dashboard": mock_server.dashboard_page(csrf, "ca", {"1234567": datetime(2027, 2, 10, 8, 15)}),
+        "groups": mock_server.dashboard_page(
+            csrf,
+            "ca",
+            {"111": datetime(2027, 2, 10, 8, 15)},
+            {"222": None, "333": datetime(2027, 3, 1, 9, 0)}
+        ),
+        "appointment": mock_server.appointment_page(csrf, facilities, asc_facilities),
+    }
+    facility_select = "appointments_consulate_appointment_facility_id"
+
+    fast = {
+        "sign_in": lambda: extract_csrf(pages["sign_in"]),
+        "dashboard": lambda: extract_applications(pages["dashboard"]),
+        "groups": lambda: extract_applications(pages["groups"]),
+        "appointment": lambda: extract_options(pages["appointment"], facility_select),
+    }
+    assert fast["sign_in"]() == csrf
+    assert fast["appointment"]() == facilities
+    assert fast["dashboard"]()[0][1][0] == "APPLICANT 1234567"
+
+    soup = dict()
+    if BeautifulSoup:
+        soup = {
+            "sign_in": lambda: BeautifulSoup(pages["sign_in"], "html.parser")
+            .find("meta", {"name": "csrf-token"})["content"],
+            "dashboard": lambda: BeautifulSoup(pages["dashboard"], "html.parser")
+            .find_all("div", {"class": "application"}),
+            "groups": lambda: BeautifulSoup(pages["groups"], "html.parser")
+            .find_all("div", {"class": "application"}),
+            "appointment": lambda: {
+                x["value"]: x.text
+                for x in BeautifulSoup(pages["appointment"], "html.parser")
+                .find("select", {"id": facility_select}).find_all("option") if x["value"]
+            },
+        }
+        assert [x[1][0] for x in fast["groups"]()] == [x.find("td").text for x in soup["groups"]()]
+    else:
+        print("bs4 is not installed, BeautifulSoup is skipped")
+    assert [x[1][0] for x in fast["groups"]()] == ["APPLICANT 111", "APPLICANT 222", "APPLICANT 333"]
+
+    print(f"{'page':<14}{'size, KB':>10}{'parser':>16}{'time, ms':>12}{'peak memory, KB':>18}")
+    for name, text in pages.items():
+        for parser_name, parsers in (("extractor", fast), ("BeautifulSoup", soup)):
+            if name not in parsers:
+                continue
+            elapsed, peak = measure_parse(parsers[name], repeat)
+            print(f"{name:<14}{len(text) / 1024:>10.1f}{parser_name:>16}{elapsed * 1000:>12.2f}{peak / 1024:>18.1f}")
+
+
+def legacy_read_dates(chunks: list[bytes], after: str, before: str) -> list[str]:
+    dates = [x["date"] for x in json.loads(b"".join(chunks))]
+    dates.sort()
+    candidate_dates = []
+    for available_date in dates:
+        if parse_date(available_date) <= parse_date(after):
+            continue
+        if parse_date(available_date) >= parse_date(before):
+            break
+        candidate_dates.append(available_date)
+    return candidate_dates
+
+
+def bench_days(sizes: tuple[int, ...] = (100, 1000, 10000), window: int = 20, repeat: int = 20):
+    print(f"days.json with N dates from tomorrow on, the current appointment is {window} dates away, "
+          f"read in {DAYS_CHUNK_SIZE // 1024} KB chunks")
+    print(f"{'dates':>7}{'size, KB':>10}{'reader':>22}{'time, ms':>10}{'peak memory, KB':>17}")
+    start = date.today()
+    for size in sizes:
+        dates = [(start + timedelta(days=1 + i)).isoformat() for i in range(size)]
+        payload = json.dumps([{"date": x, "business_day": True} for x in dates]).encode()
+        after, before = start.isoformat(), dates[min(window, size - 1)]
+
+        def chunks() -> Iterator[bytes]:
+            for i in range(0, len(payload), DAYS_CHUNK_SIZE):
+                yield payload[i:i + DAYS_CHUNK_SIZE]
+
+        readers = {
+            "json, sort, filter": lambda: legacy_read_dates(list(chunks()), after, before),
+            "stream, history": lambda: read_dates(chunks(), after, before, []),
+            "stream, no history": lambda: read_dates(chunks(), after, before),
+        }
+        expected = dates[:min(window, size - 1)]
+        listed = []
+        read_dates(chunks(), after, before, listed)
+        # the history gets a prefix of the list which reaches past the window
+        assert listed == dates[:len(listed)] and listed[-1] >= before
+        for name, reader in readers.items():
+            assert reader() == expected, name
+            elapsed, peak = measure_parse(reader, repeat)
+            print(f"{size:>7}{len(payload) / 1024:>10.1f}{name:>22}{elapsed * 1000:>10.3f}{peak / 1024:>17.1f}")
+
+
+class LegacyCandidate:
+    def __init__(self, available_date: str, available_time: str):
+        self.available_date = available_date
+        self.available_time = available_time
+        self.asc_available_date: Optional[str] = None
+        self.asc_available_time: Optional[str] = None
+        self.csrf: Optional[str] = None
+        self.body: Optional[str] = None
+
+    @property
+    def appointment_datetime(self) -> datetime:
+        return datetime.strptime(f"{self.available_date} {self.available_time}", "%Y-%m-%d %H:%M")
+
+
+def legacy_decide(
+        dates: list[str],
+        times: list[str],
+        min_date: date,
+        appointment_datetime: datetime
+) -> list[LegacyCandidate]:
+    candidate_dates = []
+    for available_date_str in dates:
+        available_date = datetime.strptime(available_date_str, "%Y-%m-%d").date()
+        if available_date <= min_date:
+            continue
+        if available_date >= appointment_datetime.date():
+            break
+        candidate_dates.append(available_date_str)
+
+    batch = [LegacyCandidate(x, y) for x in candidate_dates for y in times]
+    return sorted(
+        (x for x in batch if min_date < x.appointment_datetime.date() and
+         x.appointment_datetime < appointment_datetime),
+        key=lambda x: (x.available_date, x.available_time)
+    )
+
+
+def decide(bot: Bot, dates: list[str], times: list[str]) -> list[BookingCandidate]:
+    batch = [BookingCandidate(x, y) for x in bot.get_candidate_dates(dates) for y in times]
+    limits = bot.improvement_limits()
+    return sorted((x for x in batch if bot.is_improvement(x, limits)), key=lambda x: x.key)
+
+
+def bench_decision(sizes: tuple[int, ...] = (30, 1000, 10000), times: int = 10, repeat: int = 5):
+    print(f"N available dates from tomorrow on, {times} times each, the current appointment is after the last date")
+    print(f"{'dates':>7}{'candidates':>12}{'model':>22}{'time, ms':>10}{'peak memory, KB':>17}")
+    available_times = [f"{8 + i // 2:02}:{i % 2 * 30:02}" for i in range(times)]
+    start = date.today()
+    with tempfile.TemporaryDirectory() as directory, MockServer(mock_ais()) as server:
+        for size in sizes:
+            dates = [(start + timedelta(days=1 + i)).isoformat() for i in range(size)]
+            bot = make_bot(server, directory, MIN_DATE=start.strftime("%d.%m.%Y"))
+            bot.appointment_datetime = datetime.combine(start + timedelta(days=size + 1), datetime.min.time())
+
+            models = {
+                "strptime, dict-backed": lambda: legacy_decide(
+                    dates, available_times, bot.config.min_date, bot.appointment_datetime
+                ),
+                "ordinals, slots": lambda: decide(bot, dates, available_times),
+            }
+            expected = [(x.available_date, x.available_time) for x in models["strptime, dict-backed"]()]
+            for name, model in models.items():
+                assert [(x.available_date, x.available_time) for x in model()] == expected, name
+                elapsed, peak = measure_parse(model, repeat)
+                print(f"{size:>7}{len(expected):>12}{name:>22}{elapsed * 1000:>10.3f}{peak / 1024:>17.1f}")
+
+
+def bench_e2e(latency: float = 0.05, runs: int = 5):
+    startup = []
+    detection = []
+    requests_per_booking = []
+
+    for _ in range(runs):
+        state = mock_ais(latency=latency)
+        server = MockServer(state).start()
+        with tempfile.TemporaryDirectory() as directory:
+            bot = make_bot(server, directory, POLL_SCHEDULE="every 0.5")
+
+            started = time.perf_counter()
+            bot.init()
+            startup.append(time.perf_counter() - started)
+
+            requests_before = len(state.requests)
+            release = state.release(time.time() - state.started_at + 1.0, "89", "2027-01-15", ["09:00", "10:00"])
+
+            thread = threading.Thread(target=bot.process, daemon=True)
+            bot.init = lambda: None
+            thread.start()
+            booked = state.booked.wait(30)
+            bot.scheduler.stop()
+            server.stop()
+
+            if not booked:
+                print("Slot was not booked")
+                continue
+
+            appeared_at = state.started_at + release.at
+            booked_at = next(x[0] for x in state.bookings if x[4])
+            detection.append(booked_at - appeared_at)
+            requests_per_booking.append(len([x for x in state.requests if x[0] <= booked_at]) - requests_before)
+
+    print(f"Latency of every response {latency * 1000:.0f} ms, poll every 0.5 s, {runs} runs")
+    print(f"startup (init), s:                     p50 {statistics.median(startup):.3f}  max {max(startup):.3f}")
+    if detection:
+        print(f"slot appearance to book POST, s:       p50 {statistics.median(detection):.3f}  "
+              f"max {max(detection):.3f}")
+        print(f"requests per successful booking:       p50 {statistics.median(requests_per_booking):.0f}  "
+              f"max {max(requests_per_booking)}")
+
+
+def bench_prefetch(latency: float = 0.1, dates: int = 5):
+    print(f"{dates} candidate dates, only the last one has a free time, latency {latency * 1000:.0f} ms")
+    for prefetch_dates in (0, dates):
+        state = mock_ais(latency=latency)
+        for i in range(1, dates):
+            state.add_slots("89", f"2027-01-{i:02d}", [])
+        state.add_slots("89", f"2027-01-{dates:02d}", ["09:00"])
+        server = MockServer(state).start()
+
+        with tempfile.TemporaryDirectory() as directory:
+            bot = make_bot(server, directory, PREFETCH_DATES=str(prefetch_dates))
+            bot.init()
+            started = time.time()
+            bot.poll()
+            booked_at = next(x[0] for x in state.bookings if x[4])
+        server.stop()
+        print(f"PREFETCH_DATES={prefetch_dates:<4} days.json to book POST: {booked_at - started:.3f} s")
+
+
+class DashboardCheckBot(Bot):
+    def send_batch(self, batch: list[BookingCandidate]) -> list[str]:
+        response = self.post_booking(self.prepare_booking(batch[0]))
+        if response.is_redirect:
+            self.request("instructions", "GET", urljoin(response.url, response.headers["Location"]),
+                         headers=self.headers())
+        return [BOOKING_UNKNOWN]
+
+
+def bench_booking(latency: float = 0.05, taken: int = 5):
+    print(f"{taken} taken times before a free one, latency {latency * 1000:.0f} ms")
+    for name, bot_class in (("dashboard", DashboardCheckBot), ("classified", Bot)):
+        state = mock_ais(latency=latency)
+        state.add_taken_slots("89", "2027-01-15", [f"{8 + i:02d}:00" for i in range(taken)])
+        state.add_slots("89", "2027-01-15", [f"{8 + taken:02d}:00"])
+        server = MockServer(state).start()
+
+        with tempfile.TemporaryDirectory() as directory:
+            bot = make_bot(server, directory, bot_class=bot_class)
+            bot.init()
+            requests_before = len(state.requests)
+            bot.poll()
+        server.stop()
+
+        attempts = [x[0] for x in state.bookings]
+        cycle = statistics.median(b - a for a, b in itertools.pairwise(attempts))
+        print(f"{name:<11} retry cycle per time: {cycle * 1000:.0f} ms, "
+              f"requests per poll: {len(state.requests) - requests_before}")
+
+
+def bench_contention(
+        latency: float = 0.05,
+        contention: float = 0.1,
+        times: int = 6,
+        runs: int = 20,
+        stall_rate: float = 0.3
+):
+    print(f"{times} times released at once, other applicants book each one after {contention * 1000:.0f} ms "
+          f"on average, latency {latency * 1000:.0f} ms, {stall_rate:.0%} of responses {latency * 1000:.0f} ms "
+          f"later, {runs} runs")
+    print(f"{'BOOK_PARALLEL':>13}{'booked':>9}{'rank of booked time':>22}{'book POSTs':>13}{'reschedules':>14}"
+          f"{'left on a worse time':>22}")
+    released_times = [f"{9 + i:02d}:00" for i in range(times)]
+    for book_parallel in (1, 2, 4):
+        booked = 0
+        ranks = []
+        posts = []
+        reschedules = []
+        worse = 0
+        for _ in range(runs):
+            state = mock_ais(latency=latency, contention=contention, stall_rate=stall_rate, stall_seconds=latency)
+            server = MockServer(state).start()
+            with tempfile.TemporaryDirectory() as directory:
+                bot = make_bot(server, directory, BOOK_PARALLEL=str(book_parallel))
+                bot.init()
+                state.release(0, "89", "2027-01-15", released_times)
+                bot.poll()
+            server.stop()
+
+            successes = [x for x in state.bookings if x[4]]
+            posts.append(len(state.bookings))
+            reschedules.append(len(successes))
+            if successes:
+                booked += 1
+                ranks.append(released_times.index(state.appointment_datetime.strftime("%H:%M")))
+                worse += ranks[-1] > min(released_times.index(x[3]) for x in successes)
+        print(f"{book_parallel:>13}{booked / runs:>9.0%}"
+              f"{statistics.mean(ranks) if ranks else float('nan'):>22.2f}"
+              f"{statistics.mean(posts):>13.1f}{statistics.mean(reschedules):>14.2f}{worse / runs:>22.0%}")
+        assert worse == 0, f"BOOK_PARALLEL={book_parallel} left {worse} runs on a worse time"
+
+
+def bench_diffing(polls: int = 100, interval: float = 0.25, dates: int = 5, rate_limit: int = 150):
+    print(f"{dates} listed dates without times, {polls} polls every {interval} s, "
+          f"429 after {rate_limit} requests a minute, a time appears at poll {polls // 2}")
+    print(f"{'TIMES_TTL':>9}{'release on':>12}{'requests/poll before release':>30}{'429s':>6}{'booked after, s':>17}")
+    for times_ttl in (0, DEFAULT_TIMES_TTL, 60):
+        for release_on in ("new date", "listed date"):
+            state = mock_ais(rate_limit=rate_limit)
+            for i in range(dates):
+                state.add_slots("89", f"2027-01-{i + 10:02d}", [])
+            server = MockServer(state).start()
+
+            with tempfile.TemporaryDirectory() as directory:
+                bot = make_bot(server, directory, TIMES_TTL=str(times_ttl))
+                bot.init()
+                requests_before = len(state.requests)
+                requests_before_release = released_at = 0
+                for i in range(polls):
+                    if i == polls // 2:
+                        requests_before_release = len(state.requests)
+                        released_at = time.time()
+                        state.add_slots("89", "2027-01-02" if release_on == "new date" else "2027-01-12", ["09:00"])
+                    # noinspection PyBroadException
+                    try:
+                        bot.poll()
+                    except Exception:
+                        pass
+                    time.sleep(interval)
+            server.stop()
+
+            requests = state.requests[requests_before:]
+            booked = [x[0] for x in state.bookings if x[4]]
+            print(f"{times_ttl:>9}{release_on:>12}{(requests_before_release - requests_before) / (polls // 2):>30.1f}"
+                  f"{sum(1 for x in requests if x[2] == 429):>6}"
+                  f"{f'{booked[0] - released_at:.2f}' if booked else 'missed':>17}")
+
+
+def bench_facilities(latency: float = 0.05, empty_polls: int = 10):
+    # the whole city name pairs a consulate with its ASC, a shared first word does not
+    assert match_asc_facilities(
+        {"1": "San Jose", "2": "San Salvador", "3": "Ciudad Juárez", "4": "New Delhi", "5": ""},
+        {"11": "San Salvador ASC", "12": "Ciudad Juarez ASC", "13": "New York ASC", "14": ""}
+    ) == {"2": "11", "3": "12"}
+    try:
+        match_asc_facilities({"1": "Toronto"}, {"11": "Toronto ASC", "12": "TORONTO asc"})
+        assert False, "an ambiguous ASC was paired"
+    except AmbiguousAscFacility:
+        pass
+
+    facilities = {"89": "Toronto", "91": "Ottawa", "92": "Vancouver", "93": "Montreal"}
+    releases = {"89": "2027-03-01", "92": "2027-01-15", "93": "2027-01-10"}
+    print(f"{len(facilities)} facilities, free dates {releases}, latency {latency * 1000:.0f} ms")
+    print(f"{'FACILITY_IDS':>18}{'SCAN_BUDGET':>13}{'POOL_SIZE':>11}{'days.json/poll':>16}{'poll, ms':>10}"
+          f"{'polls to book':>15}{'booked':>18}")
+    for facility_ids, scan_budget, pool_size in (
+            ("None", 1, 1),
+            ("all", 4, 1),
+            ("all", 4, 4),
+            ("89,91,92,93:0.5", 4, 4),
+            ("89,91,92,93:0.5", 2, 4),
+    ):
+        state = mock_ais(latency=latency, facilities=facilities)
+        server = MockServer(state).start()
+        with tempfile.TemporaryDirectory() as directory:
+            bot = make_bot(server, directory, FACILITY_IDS=facility_ids, SCAN_BUDGET=str(scan_budget),
+                           POOL_SIZE=str(pool_size))
+            bot.init()
+            days_before = state.count("days")
+            started = time.perf_counter()
+            for _ in range(empty_polls):
+                bot.poll()
+            poll_seconds = (time.perf_counter() - started) / empty_polls
+            days_per_poll = (state.count("days") - days_before) / empty_polls
+
+            for facility_id, available_date in releases.items():
+                state.add_slots(facility_id, available_date, ["09:00"])
+            polls = 0
+            while not state.bookings and polls < 10:
+                polls += 1
+                bot.poll()
+        server.stop()
+
+        booked = next((f"{x[1]} {x[2]}" for x in state.bookings if x[4]), "none")
+        print(f"{facility_ids:>18}{scan_budget:>13}{pool_size:>11}{days_per_poll:>16.1f}{poll_seconds * 1000:>10.0f}"
+              f"{polls:>15}{booked:>18}")
+
+
+class UnpacedGovernor(RateGovernor):
+    def acquire(self, host: str, account: str) -> float:
+        return 0.0
+
+    def feedback(self, host: str, status: int, retry_after: Optional[str] = None) -> float:
+        return 0.0
+
+
+def poll_until(bot: Bot, deadline: float):
+    while time.time() < deadline:
+        # noinspection PyBroadException
+        try:
+            bot.get_available_dates()
+        except Exception:
+            pass
+
+
+def bench_governor(instances: int = 3, seconds: float = 20, rate_limit: int = 60, rate_window: float = 10):
+    allowed = rate_limit * 60 / rate_window
+    print(f"{instances} instances poll days.json in a loop for {seconds:g} s, "
+          f"the server allows {rate_limit} requests in {rate_window:g} s ({allowed:.0f} a minute)")
+    print(f"{'pacing':<28}{'requests':>10}{'ok':>6}{'429s':>6}{'ok/s':>7}{'throttled, s':>14}")
+    budget = str(int(allowed * 0.9))
+    for name, params in (
+            ("none", None),
+            ("backoff only", {}),
+            ("RATE_LIMIT, own buckets", {"RATE_LIMIT": budget, "RATE_BURST": "5"}),
+            ("RATE_LIMIT, shared file", {"RATE_LIMIT": budget, "RATE_BURST": "5", "RATE_FILE": "rate.db"}),
+    ):
+        state = mock_ais(rate_window=rate_window)
+        server = MockServer(state).start()
+        with tempfile.TemporaryDirectory() as directory:
+            bots = []
+            for i in range(instances):
+                values = dict(params or {})
+                if "RATE_FILE" in values:
+                    values["RATE_FILE"] = os.path.join(directory, values["RATE_FILE"])
+                # every bot gets its own store like a separate process, only RATE_FILE connects them
+                bot = make_bot(server, directory, name=f"config{i}", **values)
+                if params is None:
+                    bot.governor = UnpacedGovernor(bot.governor.store, 0, 0, 1, 0)
+                bot.init()
+                bots.append(bot)
+
+            def throttled() -> float:
+                return sum(v for (k, _), v in METRICS.counters.items() if k == "ais_throttle_seconds_total")
+
+            with state.lock:
+                state.rate_limit = rate_limit
+                state.request_times = []
+            requests_before = len(state.requests)
+            throttled_before = throttled()
+            deadline = time.time() + seconds
+            threads = [threading.Thread(target=poll_until, args=(x, deadline)) for x in bots]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            requests = state.requests[requests_before:]
+        server.stop()
+
+        ok = sum(1 for x in requests if x[2] == 200)
+        print(f"{name:<28}{len(requests):>10}{ok:>6}{sum(1 for x in requests if x[2] == 429):>6}"
+              f"{ok / seconds:>7.1f}{throttled() - throttled_before:>14.1f}")
+
+
+def bench_hedging(calls: int = 400, latency: float = 0.02, stall_rate: float = 0.03, stall_seconds: float = 1.0):
+    print(f"{calls} days.json calls, latency {latency * 1000:.0f} ms, "
+          f"{stall_rate:.0%} of responses stall for {stall_seconds:g} s")
+    print(f"{'setup':<22}{'p50, ms':>9}{'p95, ms':>9}{'p99, ms':>9}{'max, ms':>9}{'requests/call':>15}{'errors':>8}")
+    for name, params in (
+            ("no hedging", {"HEDGE": "None"}),
+            ("TIMEOUTS=days:0.5", {"HEDGE": "None", "TIMEOUTS": "days:0.5"}),
+            ("HEDGE=days", {"HEDGE": "days"}),
+    ):
+        state = mock_ais(latency=latency)
+        server = MockServer(state).start()
+        with tempfile.TemporaryDirectory() as directory:
+            bot = make_bot(server, directory, POOL_SIZE="4", **params)
+            bot.init()
+            state.stall_rate = stall_rate
+            state.stall_seconds = stall_seconds
+            requests_before = state.count("days")
+            durations = []
+            errors = 0
+            for _ in range(calls):
+                started = time.perf_counter()
+                # noinspection PyBroadException
+                try:
+                    bot.get_available_dates()
+                except Exception:
+                    errors += 1
+                durations.append(time.perf_counter() - started)
+            requests = state.count("days") - requests_before
+        server.stop()
+
+        print(f"{name:<22}{percentile(durations, 0.5) * 1000:>9.0f}{percentile(durations, 0.95) * 1000:>9.0f}"
+              f"{percentile(durations, 0.99) * 1000:>9.0f}{max(durations) * 1000:>9.0f}"
+              f"{requests / calls:>15.2f}{errors:>8}")
+
+
+def bench_clock(skews: tuple[float, ...] = (2.5, -2.5), runs: int = 4, latency: float = 0.02, lead: float = 0.2):
+    print(f"Slots released {lead:g} s before every fifth second of the server clock, polls at \"*/5 * *\", "
+          f"latency {latency * 1000:.0f} ms, {runs} runs")
+    print(f"{'server skew, s':>14}{'CLOCK_SYNC':>12}{'offset, s':>11}{'error, s':>10}"
+          f"{'poll lag, s':>13}{'release to book POST, s':>25}")
+    for skew in skews:
+        for clock_sync in (False, True):
+            state = mock_ais(latency=latency, clock_skew=skew)
+            server = MockServer(state).start()
+            with tempfile.TemporaryDirectory() as directory:
+                bot = make_bot(server, directory, CLOCK_SYNC=str(clock_sync))
+                bot.init()
+                # the polls of a window are what feeds the estimate
+                for _ in range(20):
+                    bot.get_available_dates()
+                    time.sleep(random.uniform(0, 0.1))
+
+                lags = []
+                delays = []
+                for run in range(runs):
+                    boundary = (int(time.time() + skew) // 5 + 2) * 5
+                    released_at = boundary - skew - lead
+                    available_date = f"2027-01-{20 - run:02d}"
+                    state.release(released_at - state.started_at, "89", available_date, ["09:00"])
+                    scheduler = Scheduler(bot.clock)
+
+                    def poll():
+                        started = time.time()
+                        bot.poll()
+                        if started >= released_at:
+                            lags.append(started + skew - boundary)
+                            scheduler.stop()
+
+                    scheduler.add(CronPolicy("*/5 * *"), poll)
+                    scheduler.run()
+                    delays.extend(x[0] - released_at for x in state.bookings if x[2] == available_date and x[4])
+            server.stop()
+
+            offset = getattr(bot.clock, "offset", 0.0)
+            error = getattr(bot.clock, "error", None)
+            print(f"{skew:>14g}{str(clock_sync):>12}{offset:>11.3f}{f'{error:.3f}' if error is not None else '-':>10}"
+                  f"{statistics.mean(lags):>13.3f}{statistics.mean(delays):>25.3f}")
+
+
+def bench_accounts(latency: float = 0.02, counts: tuple[int, ...] = (1, 10, 100), workers: int = 32):
+    print(f"{'accounts':>10}{'init, s':>10}{'poll round, s':>16}{'CPU/account, ms':>18}{'memory/account, KB':>21}")
+    for count in counts:
+        state = mock_ais(latency=latency)
+        state.add_slots("89", "2027-08-01", ["09:00"])
+        server = MockServer(state).start()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+
+        with tempfile.TemporaryDirectory() as directory:
+            gc.collect()
+            tracemalloc.start()
+            bots = [make_bot(server, directory, f"config{i}", adapter=adapter) for i in range(count)]
+            orchestrator = Orchestrator(bots, quiet, workers)
+
+            async def init():
+                asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers))
+                await asyncio.gather(*[orchestrator.init_bot(x) for x in bots])
+
+            async def poll():
+                asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers))
+                await orchestrator.poll_bots(bots)
+
+            started = time.perf_counter()
+            asyncio.run(init())
+            init_time = time.perf_counter() - started
+            gc.collect()
+            memory, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            started = time.perf_counter()
+            cpu_started = time.process_time()
+            asyncio.run(poll())
+            poll_time = time.perf_counter() - started
+            cpu_time = time.process_time() - cpu_started
+
+        server.stop()
+        print(f"{count:>10}{init_time:>10.3f}{poll_time:>16.3f}{cpu_time / count * 1000:>18.2f}"
+              f"{memory / count / 1024:>21.1f}")
+
+
+def bench_session(latency: float = 0.05):
+    state = mock_ais(latency=latency)
+    server = MockServer(state).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, session_ttl in (("full login", "0"), ("first start", "3600"), ("cached session", "3600")):
+            bot = make_bot(server, directory, SESSION_TTL=session_ttl)
+            requests_before = len(state.requests)
+            started = time.perf_counter()
+            bot.init()
+            bot.get_available_dates()
+            print(f"{name:<16} cold start to first days.json: {time.perf_counter() - started:.3f} s, "
+                  f"{len(state.requests) - requests_before} requests")
+    server.stop()
+
+
+def run_release_burst(bot: Bot, polls: int, release: Optional[Callable] = None) -> float:
+    started = time.perf_counter()
+    bot.init()
+    for i in range(polls):
+        if i == polls - 1 and release:
+            release()
+        bot.poll()
+    if bot.asc_refresh:
+        bot.asc_refresh.join()
+    return time.perf_counter() - started
+
+
+def bench_replay(latency: float = 0.05, polls: int = 10, taken: int = 3):
+    print(f"{polls} polls with NEED_ASC, {taken} taken times and a free one released before the last poll, "
+          f"latency {latency * 1000:.0f} ms")
+    print(f"{'run':<16}{'time, s':>9}{'requests':>10}{'booked':>18}")
+    state = mock_ais(latency=latency, password="correct horse battery staple")
+    # listed the whole time, but later than the current appointment
+    state.add_slots("89", "2027-07-01", ["10:00"])
+    state.add_slots("95", "2027-06-28", ["08:00", "08:15"])
+    server = MockServer(state).start()
+
+    def release():
+        state.add_taken_slots("89", "2027-01-15", [f"{8 + i:02d}:00" for i in range(taken)])
+        state.add_slots("89", "2027-01-15", [f"{8 + taken:02d}:00"])
+        state.add_slots("95", "2027-01-12", [f"08:{i * 15:02d}" for i in range(taken + 1)])
+
+    with tempfile.TemporaryDirectory() as directory:
+        cassette_file = os.path.join(directory, "cassette.jsonl")
+        adapter = RecordingAdapter(Cassette(cassette_file))
+        bot = make_bot(server, directory, "record", adapter=adapter, NEED_ASC="True")
+        requests_before = len(state.requests)
+        elapsed = run_release_burst(bot, polls, release)
+        booked = bot.appointment_datetime
+        server.stop()
+        print(f"{'record':<16}{elapsed:>9.3f}{len(state.requests) - requests_before:>10}"
+              f"{booked.strftime('%Y-%m-%d %H:%M'):>18}")
+
+        with open(cassette_file) as f:
+            content = f.read()
+        assert state.password not in content and state.email not in content
+        assert not any(x in content for x in state.sessions)
+        print(f"cassette: {len(content.splitlines())} records, {len(content) / 1024:.1f} KB, "
+              f"no password, email or session cookie")
+
+        for speed in (1.0, 0.0):
+            adapter = ReplayAdapter(cassette_file, speed)
+            name = f"replay speed {speed:g}"
+            bot = make_bot(server, directory, name.replace(" ", "_"), adapter=adapter, NEED_ASC="True")
+            elapsed = run_release_burst(bot, polls)
+            assert bot.appointment_datetime == booked, name
+            print(f"{name:<16}{elapsed:>9.3f}{adapter.replayed:>10}{booked.strftime('%Y-%m-%d %H:%M'):>18}")
+
+
+def set_config_value(config_file: str, key: str, value: str):
+    with open(config_file) as f:
+        lines = [x for x in f.read().splitlines() if not x.startswith(f"{key}=")]
+    with open(config_file, "w") as f:
+        f.write("\n".join([*lines, f"{key}={value}"]))
+
+
+def bench_daemon(latency: float = 0.05, pause: float = 3):
+    print(f"Daemon polling every 1 s, latency {latency * 1000:.0f} ms, config changes applied through the control API")
+    print(f"{'change':<24}{'time, ms':>10}{'requests':>10}{'sign ins':>10}{'new connections':>17}")
+    state = mock_ais(latency=latency)
+    state.add_slots("89", "2027-07-01", ["10:00"])
+    state.add_slots("92", "2027-07-02", ["10:00"])
+    server = MockServer(state).start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        bot = make_bot(server, directory, POLL_SCHEDULE="every 1s", WARM_UP_SECONDS="0")
+        control = start_control_server(0, bot)
+        port = control.server_address[1]
+        thread = threading.Thread(target=bot.process, daemon=True)
+        started = time.perf_counter()
+        thread.start()
+        while not send_control(port, "status")["running"]:
+            time.sleep(0.01)
+        startup = time.perf_counter() - started
+        pool = bot.session.get_adapter(server.url).poolmanager.connection_from_url(server.url)
+
+        def measure(name: str, command: str) -> dict:
+            requests_before, sign_ins, connections = len(state.requests), state.count("sign_in"), pool.num_connections
+            command_started = time.perf_counter()
+            result = send_control(port, command)
+            print(f"{name:<24}{(time.perf_counter() - command_started) * 1000:>10.0f}"
+                  f"{len(state.requests) - requests_before:>10}{state.count('sign_in') - sign_ins:>10}"
+                  f"{pool.num_connections - connections:>17}")
+            return result
+
+        print(f"{'start (login)':<24}{startup * 1000:>10.0f}{len(state.requests):>10}{state.count('sign_in'):>10}"
+              f"{pool.num_connections:>17}")
+        config_file = bot.config.config_file
+        changes = (
+            ("MIN_DATE", "01.02.2026"),
+            ("MAX_DATE", "01.12.2027"),
+            ("FACILITY_ID", "92"),
+            ("NEED_ASC", "True"),
+            ("POLL_SCHEDULE", "every 0.5s"),
+            ("EMAIL", "other@example.com")
+        )
+        for key, value in changes:
+            set_config_value(config_file, key, value)
+            result = measure(f"reload {key}", "reload")
+            assert result["status"]["logins"] == 1
+            if key == "EMAIL":
+                assert result["restart"] == ["EMAIL"]
+            else:
+                assert result["applied"] == [key], result
+        assert bot.facilities == {"92": 1.0} and bot.config.need_asc
+        set_config_value(config_file, "FACILITY_ID", "")
+        result = measure("reload no FACILITY_ID", "reload")
+        assert "error" in result and bot.config.facility_id == "92" and bot.facilities == {"92": 1.0}, result
+        set_config_value(config_file, "FACILITY_ID", "92")
+
+        measure("poll", "poll")
+        measure("pause", "pause")
+        polls = state.count("days")
+        time.sleep(pause)
+        print(f"days.json while paused for {pause:g} s: {state.count('days') - polls}")
+        measure("resume", "resume")
+
+        bot.scheduler.call(bot.scheduler.stop)
+        thread.join()
+        control.shutdown()
+    server.stop()
+
+
+def bench_asc(latency: float = 0.05, counts: tuple[int, ...] = (5, 20, 50), concurrency: tuple[int, ...] = (1, 8)):
+    print(f"{'ASC dates':>10}" + "".join(f"{f'concurrency {x}, s':>20}" for x in concurrency))
+    for count in counts:
+        row = f"{count:>10}"
+        for workers in concurrency:
+            state = mock_ais(latency=latency)
+            for i in range(count):
+                state.add_slots("95", datetime.fromordinal(datetime(2027, 1, 1).toordinal() + i).strftime("%Y-%m-%d"),
+                                ["08:00"])
+            server = MockServer(state).start()
+            with tempfile.TemporaryDirectory() as directory:
+                bot = make_bot(server, directory, NEED_ASC="True", ASC_CONCURRENCY=str(workers))
+                bot.login()
+                bot.init_csrf_and_cookie()
+                started = time.perf_counter()
+                bot.init_asc_dates()
+                row += f"{time.perf_counter() - started:>20.3f}"
+            server.stop()
+        print(row)
+
+
+def bench_pairing(sizes: tuple[int, ...] = (100, 1000, 10000), density: float = 0.3, nested_max: int = 1000):
+    random.seed(1)
+    first_day = date(2027, 1, 1).toordinal()
+    print(f"Consulate and ASC calendars of N days, {density:.0%} of the days have free times")
+    print(f"{'N':>7}{'nested loop, ms':>17}{'bisect per date, ms':>21}{'one pass, ms':>14}"
+          f"{'ASC gap earliest, d':>21}{'ASC gap closest, d':>20}")
+    for size in sizes:
+        consulate = [date.fromordinal(first_day + i).isoformat() for i in range(size) if random.random() < density]
+        asc = {date.fromordinal(first_day + i).isoformat(): ["08:00"] for i in range(size) if random.random() < density}
+
+        started = time.perf_counter()
+        legacy = []
+        for available_date_str in consulate if size <= nested_max else []:
+            available_date = datetime.strptime(available_date_str, "%Y-%m-%d").date()
+            min_asc_date = available_date - timedelta(days=7)
+            legacy.append(next((
+                k for k, v in asc.items()
+                if min_asc_date <= datetime.strptime(k, "%Y-%m-%d").date() < available_date and v
+            ), None))
+        legacy_time = time.perf_counter() - started
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = AscSlotStore(os.path.join(directory, "asc"), 3600)
+            for asc_date, times in asc.items():
+                store.set(asc_date, times, time.time())
+
+            started = time.perf_counter()
+            for available_date_str in consulate:
+                available_ordinal = date_ordinal(available_date_str)
+                store.find(available_ordinal - 7, available_ordinal)
+            bisect_time = time.perf_counter() - started
+
+            gaps = dict()
+            for policy in (ASC_POLICY_EARLIEST, ASC_POLICY_CLOSEST):
+                started = time.perf_counter()
+                slots = store.usable()
+                consulate_days = [date_ordinal(x) for x in consulate]
+                pairs = pair_asc_slots(consulate_days, [x[0] for x in slots], policy)
+                if policy == ASC_POLICY_EARLIEST:
+                    one_pass_time = time.perf_counter() - started
+                    if size <= nested_max:
+                        assert [slots[i][1] if i is not None else None for i in pairs] == legacy
+                gaps[policy] = statistics.mean(x - slots[i][0] for x, i in zip(consulate_days, pairs) if i is not None)
+
+        legacy_column = f"{legacy_time * 1000:.2f}" if size <= nested_max else "-"
+        print(f"{size:>7}{legacy_column:>17}{bisect_time * 1000:>21.2f}{one_pass_time * 1000:>14.2f}"
+              f"{gaps[ASC_POLICY_EARLIEST]:>21.1f}{gaps[ASC_POLICY_CLOSEST]:>20.1f}")
+
+
+class LegacyLogger:
+    def __init__(self, log_file: str, console: io.TextIOBase):
+        log_formatter = logging.Formatter(LOG_FORMAT)
+        self.root_logger = logging.getLogger()
+
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setFormatter(log_formatter)
+        self.root_logger.addHandler(file_handler)
+
+        console_handler = logging.StreamHandler(console)
+        console_handler.setFormatter(log_formatter)
+        self.root_logger.addHandler(console_handler)
+
+        self.root_logger.setLevel("DEBUG")
+
+    def __call__(self, message: str | Exception):
+        self.root_logger.debug(message, exc_info=isinstance(message, Exception))
+
+
+def bench_history(days: int = 90, polls_per_hour: int = 600, dates: int = 200, change_every: int = 60):
+    random.seed(1)
+    start = datetime(2026, 1, 1).timestamp()
+    first_day = datetime(2026, 3, 1).toordinal()
+    available = [first_day + i * 2 for i in range(dates)]
+    observations = days * 24 * polls_per_hour
+
+    with tempfile.TemporaryDirectory() as directory:
+        history_file = os.path.join(directory, "history.db")
+        store = HistoryStore(history_file)
+        connection = store.connect()
+        started = time.perf_counter()
+        dates_json = []
+        for i in range(observations):
+            if not i % change_every:
+                available[random.randrange(dates)] += random.choice((-1, 1))
+                dates_json = [date.fromordinal(x).isoformat() for x in sorted(available)]
+            store.write(connection, "dates", ("ca", "89"), int(start + i * 3600 / polls_per_hour), dates_json)
+            if not i % 1000:
+                connection.commit()
+        connection.commit()
+        connection.close()
+        write_time = time.perf_counter() - started
+        size = os.path.getsize(history_file)
+
+        store = HistoryStore(history_file).start()
+        started = time.perf_counter()
+        for _ in range(1000):
+            store.record_dates("ca", "89", start + observations * 3600 / polls_per_hour, dates_json)
+        enqueue_time = (time.perf_counter() - started) / 1000
+        store.stop()
+
+        started = time.perf_counter()
+        rows = store.query_earlier("ca", "89", date.fromordinal(first_day), start)
+        query_time = time.perf_counter() - started
+
+    print(f"{observations} days.json observations of {dates} dates over {days} days "
+          f"({polls_per_hour} polls per hour)")
+    print(f"file size:            {size / 1024 / 1024:.1f} MB ({size / observations:.0f} B per poll)")
+    print(f"write on the writer:  {write_time / observations * 1e6:.0f} us per poll")
+    print(f"cost in the poll:     {enqueue_time * 1e6:.1f} us per record_dates()")
+    print(f"query:                {len(rows)} rows with dates earlier than {date.fromordinal(first_day)} "
+          f"in {query_time * 1000:.1f} ms")
+
+
+def synthetic_releases(start: float, days: int) -> list[float]:
+    releases = []
+    for day in range(days):
+        midnight = start + day * 24 * 3600
+        if random.random() < 0.7:
+            releases.append(midnight + 8 * 3600 + 120 + random.uniform(-60, 60))
+        if random.random() < 0.5:
+            releases.append(midnight + 20 * 3600 + 1860 + random.uniform(-60, 60))
+        releases.extend(midnight + random.uniform(0, 24 * 3600) for _ in range(3))
+    return sorted(releases)
+
+
+def record_releases(history_file: str, releases: list[float], lifetime: float, start: float):
+    store = HistoryStore(history_file)
+    connection = store.connect()
+    base_dates = ["2027-03-01", "2027-03-02"]
+    events = [(start, base_dates)]
+    for i, released_at in enumerate(releases):
+        released = [date.fromordinal(date(2026, 12, 1).toordinal() + i % 60).isoformat(), *base_dates]
+        events.append((released_at, released))
+        events.append((released_at + lifetime, base_dates))
+    for observed_at, dates in sorted(events, key=lambda x: x[0]):
+        store.write(connection, "dates", ("ca", "89"), int(observed_at), dates)
+    connection.commit()
+    connection.close()
+
+
+def replay(policy: SchedulePolicy, start: float, end: float, releases: list[float], lifetime: float):
+    polls = []
+    due = policy.next(start)
+    while due < end:
+        polls.append(due)
+        due = policy.next(due)
+
+    delays = []
+    for released_at in releases:
+        i = bisect.bisect_left(polls, released_at)
+        if i < len(polls) and polls[i] < released_at + lifetime:
+            delays.append(polls[i] - released_at)
+    return len(polls) / ((end - start) / 3600), delays
+
+
+def bench_adaptive(history_file: Optional[str] = None, lifetime: float = 120, budgets: tuple[int, ...] = (600, 120)):
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as directory:
+        if history_file:
+            country, facility_id = HistoryStore(history_file).connect().execute(
+                "SELECT country, facility_id FROM dates GROUP BY country, facility_id ORDER BY COUNT(*) DESC"
+            ).fetchone()
+            releases, first_seen = HistoryStore(history_file).releases(country, facility_id, 0)
+            if not releases:
+                print(f"No releases in {history_file}")
+                return
+            start = datetime.fromtimestamp(first_seen).replace(hour=0, minute=0, second=0).timestamp()
+            end = releases[-1] + lifetime
+            split = start + (end - start) * 0.75
+            print(f"Replay of {history_file} ({country} {facility_id}): {len(releases)} releases, "
+                  f"learn from the first 75%, slots live {lifetime:.0f} s")
+        else:
+            country, facility_id = "ca", "89"
+            start = datetime(2026, 1, 1).timestamp()
+            split = start + 21 * 24 * 3600
+            end = split + 7 * 24 * 3600
+            releases = synthetic_releases(start, 28)
+            print(f"Synthetic releases around 08:02 and 20:31 plus 3 random ones a day, learn from 21 days, "
+                  f"replay 7 days, slots live {lifetime:.0f} s")
+
+        training_file = os.path.join(directory, "history.db")
+        record_releases(training_file, [x for x in releases if x < split], lifetime, start)
+        training = HistoryStore(training_file)
+        test_releases = [x for x in releases if split <= x < end]
+
+        policies = [("fixed " + DEFAULT_POLL_SCHEDULE, parse_schedule(DEFAULT_POLL_SCHEDULE))]
+        for budget in budgets:
+            policies.append((
+                f"adaptive, {budget}/h",
+                AdaptivePolicy(budget, 60, lambda since: training.releases(country, facility_id, since))
+            ))
+
+        print(f"{'schedule':<24}{'polls/h':>9}{'detected':>10}{'delay p50, s':>14}{'delay p90, s':>14}")
+        for name, policy in policies:
+            polls_per_hour, delays = replay(policy, split, end, test_releases, lifetime)
+            print(f"{name:<24}{polls_per_hour:>9.0f}{len(delays) / len(test_releases):>10.0%}"
+                  f"{percentile(delays, 0.5) if delays else float('nan'):>14.1f}"
+                  f"{percentile(delays, 0.9) if delays else float('nan'):>14.1f}")
+
+
+def bench_logging(polls: int = 200, dates: int = 300):
+    days = [{"date": datetime.fromordinal(739252 + i).strftime("%Y-%m-%d"), "business_day": True}
+            for i in range(dates)]
+    times = {"available_times": [f"{8 + i // 4:02d}:{i % 4 * 15:02d}" for i in range(32)], "business_times": []}
+
+    def legacy_poll(logger: LegacyLogger):
+        logger("Get available date")
+        logger(f"Response: {days}")
+        available_dates = sorted(x["date"] for x in days)
+        logger(f"All available dates: {available_dates}")
+        logger("Get available time")
+        logger(f"Response: {times}")
+        logger(f"All available times for date {available_dates[0]}: {times['available_times']}")
+
+    def new_poll(logger: Logger):
+        logger.debug("Get available date")
+        available_dates = sorted(x["date"] for x in days)
+        logger.debug(f"Response: {summarize(available_dates)}")
+        logger(f"All available dates: {summarize(available_dates)}")
+        logger.debug("Get available time")
+        logger.debug(f"Response: {summarize(times['available_times'])}")
+        logger(f"All available times for date {available_dates[0]}: {summarize(times['available_times'])}")
+
+    root_logger = logging.getLogger()
+    print(f"{dates} dates in days.json, {polls} polls")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, log_file, create, poll in (
+                ("legacy", "legacy.txt", lambda x: LegacyLogger(x, io.StringIO()), legacy_poll),
+                ("queue, DEBUG", "debug.txt", lambda x: Logger(x, LOG_FORMAT, "DEBUG"), new_poll),
+                ("queue, INFO", "info.txt", lambda x: Logger(x, LOG_FORMAT, "INFO"), new_poll),
+        ):
+            log_file = os.path.join(directory, log_file)
+            handlers = list(root_logger.handlers)
+            stderr = sys.stderr
+            sys.stderr = io.StringIO()
+            try:
+                logger = create(log_file)
+                started = time.perf_counter()
+                for _ in range(polls):
+                    poll(logger)
+                elapsed = time.perf_counter() - started
+                if isinstance(logger, Logger):
+                    logger.stop()
+            finally:
+                sys.stderr = stderr
+                for handler in list(root_logger.handlers):
+                    if handler not in handlers:
+                        root_logger.removeHandler(handler)
+                        handler.close()
+            print(f"{name:<14} per poll on the polling thread: {elapsed / polls * 1000:.3f} ms, "
+                  f"log size per poll: {os.path.getsize(log_file) / polls / 1024:.1f} KB")
+
+
+def self_signed_certificate(directory: str) -> tuple[str, str]:
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+            "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+            "-keyout", keyfile, "-out", certfile
+        ],
+        check=True,
+        capture_output=True
+    )
+    return certfile, keyfile
+
+
+def bench_warm_up(latency: float = 0.02, keep_alive: float = 1.0, runs: int = 10):
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            certfile, keyfile = self_signed_certificate(directory)
+        except (OSError, subprocess.CalledProcessError):
+            print("openssl is not available, using plain http")
+            certfile, keyfile = None, None
+
+        state = mock_ais(latency=latency, keep_alive=keep_alive)
+        state.add_slots("89", "2027-08-01", ["09:00"])
+        server = MockServer(state, certfile=certfile, keyfile=keyfile).start()
+        bot = make_bot(server, directory)
+        bot.verify = certfile or True
+        bot.init()
+
+        print(f"{server.url}, latency {latency * 1000:.0f} ms, server closes idle connections after {keep_alive} s")
+        for name, warm_up in (("cold", False), ("warmed up", True)):
+            first_request = []
+            for _ in range(runs):
+                time.sleep(keep_alive + 0.5)
+                if warm_up:
+                    bot.warm_up()
+                started = time.perf_counter()
+                bot.get_available_dates()
+                first_request.append(time.perf_counter() - started)
+            print(f"{name:<10} first days.json in the window: p50 {statistics.median(first_request) * 1000:.1f} ms, "
+                  f"max {max(first_request) * 1000:.1f} ms")
+        server.stop()
+
+
+BENCHMARKS = {
+    "scheduler": bench_scheduler,
+    "parse": bench_parse,
+    "days": bench_days,
+    "decision": bench_decision,
+    "e2e": bench_e2e,
+    "prefetch": bench_prefetch,
+    "booking": bench_booking,
+    "contention": bench_contention,
+    "diffing": bench_diffing,
+    "facilities": bench_facilities,
+    "governor": bench_governor,
+    "hedging": bench_hedging,
+    "clock": bench_clock,
+    "accounts": bench_accounts,
+    "session": bench_session,
+    "replay": bench_replay,
+    "daemon": bench_daemon,
+    "asc": bench_asc,
+    "pairing": bench_pairing,
+    "logging": bench_logging,
+    "history": bench_history,
+    "adaptive": bench_adaptive,
+    "warmup": bench_warm_up,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default all)")
+    parser.add_argument(
+        "--history",
+        help="history.db to replay in the adaptive benchmark instead of synthetic releases"
+    )
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    for name in args.benchmarks or BENCHMARKS:
+        print(f"=== {name} ===")
+        if name == "adaptive" and args.history:
+            bench_adaptive(args.history)
+        else:
+            BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,44 @@
+import abc
+import argparse
+import asyncio
+import atexit
+import base64
+import bisect
+import collections
+import functools
+import heapq
+import http.client
+import io
+import itertools
 import json
 import logging
+import math
 import os.path
+import queue
 import random
 import re
+import shutil
+import sqlite3
+import tempfile
+import threading
 import time
+import unicodedata
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, date, timedelta
-from typing import Optional
-from urllib.parse import urlencode
+from email.utils import formatdate, parsedate_to_datetime
+from html.parser import HTMLParser
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, Iterator, Optional
+from urllib.parse import urlencode, urlparse
 
 import requests
-from bs4 import BeautifulSoup
-from requests import Response, HTTPError
+from requests import HTTPError, PreparedRequest, Response
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
 
 HOST = "ais.usvisa-info.com"
+BASE_URL = f"https://{HOST}"
 REFERER = "Referer"
 ACCEPT = "Accept"
 SET_COOKIE = "set-cookie"
@@ -117,17 +143,199 @@ COUNTRIES = {
 }
 DATE_TIME_FORMAT = "%H:%M %Y-%m-%d"
 DATE_FORMAT = "%d.%m.%Y"
-HTML_PARSER = "html.parser"
+HTML_CHUNK_SIZE = 16384
+DAYS_CHUNK_SIZE = 8192
+DAYS_DATE_PATTERN = re.compile(r'"date"\s*:\s*"(\d{4}-\d{2}-\d{2})"')
 NONE = "None"
 
 CONFIG_FILE = "config"
 ASC_FILE = "asc"
+SESSION_FILE = "session"
+HISTORY_FILE = "history.db"
 LOG_FILE = "log.txt"
 LOG_FORMAT = "%(asctime)s  %(message)s"
+DEFAULT_WORKERS = 32
+DEFAULT_CONTROL_PORT = 8765
+CONTROL_COMMANDS = ("status", "reload", "pause", "resume", "poll")
+# changing these needs a new login or a new connection pool, a reload keeps the running values
+RESTART_KEYS = (
+    "email", "password", "country", "schedule_id", "pool_size", "clock_sync", "rate_file", "history", "metrics_port",
+    "log_level", "log_max_bytes", "log_backup_count", "log_rotate_when"
+)
+LOCATION_KEYS = ("facility_id", "asc_facility_id", "facility_ids", "asc_facility_ids", "need_asc")
+SCHEDULE_KEYS = ("poll_schedule", "poll_budget", "poll_quiet_interval", "warm_up_seconds")
+DEFAULT_POLL_SCHEDULE = "10-59/2 */5 *"
+ADAPTIVE_SCHEDULE = "adaptive"
+DEFAULT_POLL_BUDGET = 600
+DEFAULT_POLL_QUIET_INTERVAL = 60
+ADAPTIVE_HISTORY_DAYS = 30
+ADAPTIVE_RELEARN_SECONDS = 3600
+ADAPTIVE_GAIN = 3
+DEFAULT_SESSION_TTL = 3600
+DEFAULT_ASC_TTL = 1800
+DEFAULT_ASC_CONCURRENCY = 4
+DEFAULT_ASC_TIMEOUT = 10
+ASC_WINDOW_DAYS = 7
+MINUTES_PER_DAY = 24 * 60
+ASC_POLICY_EARLIEST = "earliest"
+ASC_POLICY_CLOSEST = "closest"
+FACILITIES_ALL = "all"
+DEFAULT_SCAN_BUDGET = 3
+DEFAULT_POOL_SIZE = 4
+DEFAULT_WARM_UP_SECONDS = 3
+DEFAULT_WARM_CONNECTIONS = 2
+DEFAULT_BOOK_PARALLEL = 1
+DEFAULT_TIMES_TTL = 10
+WARM_UP_TIMEOUT = 5
+DEFAULT_RATE_BURST = 10
+DEFAULT_BACKOFF_MAX = 300
+BACKOFF_BASE = 1.0
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 10
+DEFAULT_TIMEOUTS = "book:30"
+DEFAULT_HEDGE = "days,times,asc_days,asc_times"
+DEFAULT_HEDGE_RATE = 12
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.01
+LATENCY_SAMPLES = 200
+CLOCK_SAMPLES = 64
+CLOCK_LOG_CHANGE = 0.25
+RATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    blocked_until REAL NOT NULL,
+    failures INTEGER NOT NULL
+);
+"""
+DEFAULT_LOG_LEVEL = "INFO"
+DEFAULT_LOG_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_LOG_BACKUP_COUNT = 5
+LOG_SUMMARY_ITEMS = 3
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+HISTORY_MAX_GAP = 3600
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dates (
+    id INTEGER PRIMARY KEY,
+    country TEXT NOT NULL,
+    facility_id TEXT NOT NULL,
+    first_seen INTEGER NOT NULL,
+    last_seen INTEGER NOT NULL,
+    polls INTEGER NOT NULL,
+    earliest INTEGER,
+    days TEXT NOT NULL,
+    read_until INTEGER
+);
+CREATE INDEX IF NOT EXISTS dates_earliest ON dates (country, facility_id, earliest);
+CREATE INDEX IF NOT EXISTS dates_first_seen ON dates (country, facility_id, first_seen);
+CREATE TABLE IF NOT EXISTS times (
+    id INTEGER PRIMARY KEY,
+    country TEXT NOT NULL,
+    facility_id TEXT NOT NULL,
+    day INTEGER NOT NULL,
+    first_seen INTEGER NOT NULL,
+    last_seen INTEGER NOT NULL,
+    polls INTEGER NOT NULL,
+    times TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS times_day ON times (country, facility_id, day, first_seen);
+"""
+BOOKING_BOOKED = "booked"
+BOOKING_SLOT_TAKEN = "slot_taken"
+BOOKING_CSRF_EXPIRED = "csrf_expired"
+BOOKING_LIMIT_REACHED = "limit_reached"
+BOOKING_UNKNOWN = "unknown"
+REDACTED = "REDACTED"
+# form fields, csrf tokens in pages and cookie values are replaced with REDACTED in cassettes
+REDACTED_FIELD_PATTERN = re.compile(r"((?:^|&)[^=&]*(?:email|password|token)[^=&]*=)[^&]*", re.IGNORECASE)
+REDACTED_TOKEN_PATTERN = re.compile(r"((?:csrf-token|authenticity_token)\"[^>]*?(?:content|value)=\")[^\"]*")
+REDACTED_COOKIE_PATTERN = re.compile(r"((?:^|,\s*)[^=;,\s]+=)[^;]*")
+# replayed bodies are decoded and complete, the server clock is taken from the recorded skew
+CASSETTE_DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive",
+                            "date"}
+SLOT_TAKEN_PATTERN = re.compile(r"no longer available|not available|already (been )?taken", re.IGNORECASE)
+LIMIT_REACHED_PATTERN = re.compile(r"limit|maximum number", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(date_str: str) -> date:
+    return date.fromisoformat(date_str)
 
 
-def parse_date(date_str: str) -> date:
-    return datetime.strptime(date_str, "%Y-%m-%d").date()
+@functools.lru_cache(maxsize=4096)
+def date_ordinal(date_str: str) -> int:
+    return parse_date(date_str).toordinal()
+
+
+def time_minutes(time_str: str) -> int:
+    hours, _, minutes = time_str.partition(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def datetime_key(value: datetime) -> int:
+    return value.toordinal() * MINUTES_PER_DAY + value.hour * 60 + value.minute
+
+
+def pair_asc_slots(consulate_days: list[int], asc_days: list[int], policy: str) -> list[Optional[int]]:
+    # both lists are sorted day ordinals, so the [day - ASC_WINDOW_DAYS, day) windows only move forward
+    pairs: list[Optional[int]] = []
+    start = end = 0
+    for day in consulate_days:
+        while start < len(asc_days) and asc_days[start] < day - ASC_WINDOW_DAYS:
+            start += 1
+        end = max(start, end)
+        while end < len(asc_days) and asc_days[end] < day:
+            end += 1
+        if start == end:
+            pairs.append(None)
+        else:
+            pairs.append(end - 1 if policy == ASC_POLICY_CLOSEST else start)
+    return pairs
+
+
+def parse_pairs(spec: Optional[str]) -> dict[str, str]:
+    pairs = dict()
+    for item in (spec or "").split(","):
+        key, _, value = item.partition(":")
+        if key.strip():
+            pairs[key.strip()] = value.strip()
+    return pairs
+
+
+def facility_city(name: str) -> str:
+    # "Ciudad Juarez ASC" and "Ciudad Juárez" are one city
+    words = re.findall(r"[a-z0-9]+", unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode().lower())
+    return " ".join(x for x in words if x != "asc")
+
+
+def match_asc_facilities(facilities: dict[str, str], asc_facilities: dict[str, str]) -> dict[str, str]:
+    # ASC centers are listed under the name of the city they serve, e.g. "Toronto" and "Toronto ASC"
+    cities = dict[str, list[str]]()
+    for asc_facility_id, asc_name in asc_facilities.items():
+        # options with blank text match nothing
+        if facility_city(asc_name):
+            cities.setdefault(facility_city(asc_name), []).append(asc_facility_id)
+
+    pairs = dict()
+    for facility_id, name in facilities.items():
+        matched = cities.get(facility_city(name), [])
+        if len(matched) > 1:
+            raise AmbiguousAscFacility(name, matched)
+        if matched:
+            pairs[facility_id] = matched[0]
+    return pairs
+
+
+def summarize(values: list) -> str:
+    if len(values) <= 2 * LOG_SUMMARY_ITEMS:
+        return str(values)
+    return (
+        f"{len(values)} items "
+        f"[{', '.join(map(str, values[:LOG_SUMMARY_ITEMS]))}, ..., "
+        f"{', '.join(map(str, values[-LOG_SUMMARY_ITEMS:]))}]"
+    )
 
 
 class NoScheduleIdException(Exception):
@@ -140,37 +348,1626 @@ class AppointmentDateLowerMinDate(Exception):
         super().__init__("Current appointment date and time lower than specified minimal date")
 
 
+class ConfigIncomplete(Exception):
+    def __init__(self, config_file: str, key: str):
+        super().__init__(f"{key} is not set in {config_file}, run once without --daemon to fill it in")
+
+
+class AmbiguousAscFacility(Exception):
+    def __init__(self, name: str, asc_facility_ids: list[str]):
+        super().__init__(f"ASC facilities {', '.join(asc_facility_ids)} all match {name}, set ASC_FACILITY_IDS")
+
+
+class HtmlElementNotFound(Exception):
+    def __init__(self, element: str):
+        super().__init__(f"Not found {element} on page")
+
+
+class HtmlExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.done = False
+
+    def extract(self, text: str):
+        for i in range(0, len(text), HTML_CHUNK_SIZE):
+            self.feed(text[i:i + HTML_CHUNK_SIZE])
+            if self.done:
+                return
+        self.close()
+
+    @staticmethod
+    def has_class(attrs: list[tuple[str, Optional[str]]], class_name: str) -> bool:
+        return any(k == "class" and v and class_name in v.split() for k, v in attrs)
+
+
+class CsrfExtractor(HtmlExtractor):
+    def __init__(self):
+        super().__init__()
+        self.csrf: Optional[str] = None
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, Optional[str]]]):
+        if self.done or tag != "meta":
+            return
+        attrs_dict = dict(attrs)
+        if attrs_dict.get("name") == "csrf-token":
+            self.csrf = attrs_dict.get("content")
+            self.done = True
+
+
+class ApplicationsExtractor(HtmlExtractor):
+    def __init__(self):
+        super().__init__()
+        # (start tag and text of the first link, texts of td cells, text of consular appointment)
+        self.applications: list[tuple[str, list[str], Optional[str]]] = []
+        # applications of other groups sit in later containers, so the whole page is read
+        self.div_depth = 0
+        self.application_depth: Optional[int] = None
+        self.link: Optional[str] = None
+        self.in_link = False
+        self.cells: list[str] = []
+        self.cell: Optional[str] = None
+        self.consular_appt: Optional[str] = None
+        self.in_consular_appt = False
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, Optional[str]]]):
+        if tag == "div":
+            if self.application_depth is None and HtmlExtractor.has_class(attrs, "application"):
+                self.application_depth = self.div_depth
+                self.link = None
+                self.cells = []
+                self.consular_appt = None
+            self.div_depth += 1
+            return
+
+        if self.application_depth is None:
+            return
+
+        if tag == "a" and self.link is None:
+            self.link = self.get_starttag_text()
+            self.in_link = True
+        elif tag == "td":
+            self.cell = ""
+        elif tag == "p" and self.consular_appt is None and HtmlExtractor.has_class(attrs, "consular-appt"):
+            self.consular_appt = ""
+            self.in_consular_appt = True
+
+    def handle_endtag(self, tag: str):
+        if tag == "div":
+            self.div_depth -= 1
+            if self.application_depth is not None and self.div_depth == self.application_depth:
+                self.applications.append((self.link or "", self.cells, self.consular_appt))
+                self.application_depth = None
+        elif tag == "a":
+            self.in_link = False
+        elif tag == "td" and self.cell is not None:
+            self.cells.append(self.cell)
+            self.cell = None
+        elif tag == "p":
+            self.in_consular_appt = False
+
+    def handle_data(self, data: str):
+        if self.application_depth is None:
+            return
+        if self.in_link:
+            self.link += data
+        if self.cell is not None:
+            self.cell += data
+        if self.in_consular_appt:
+            self.consular_appt += data
+
+
+class OptionsExtractor(HtmlExtractor):
+    def __init__(self, element_id: str):
+        super().__init__()
+        self.element_id = element_id
+        self.found = False
+        self.in_select = False
+        self.options: list[tuple[Optional[str], str]] = []
+        self.option: Optional[list] = None
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, Optional[str]]]):
+        if self.done:
+            return
+        if tag == "select" and dict(attrs).get("id") == self.element_id:
+            self.found = True
+            self.in_select = True
+        elif tag == "option" and self.in_select:
+            self.finish_option()
+            self.option = [dict(attrs).get("value"), ""]
+
+    def handle_endtag(self, tag: str):
+        if self.done or not self.in_select:
+            return
+        if tag == "option":
+            self.finish_option()
+        elif tag == "select":
+            self.finish_option()
+            self.in_select = False
+            self.done = True
+
+    def handle_data(self, data: str):
+        if self.option is not None:
+            self.option[1] += data
+
+    def finish_option(self):
+        if self.option is not None:
+            self.options.append((self.option[0], self.option[1]))
+            self.option = None
+
+
+class FlashExtractor(HtmlExtractor):
+    def __init__(self):
+        super().__init__()
+        self.messages: list[str] = []
+        self.flash_tag: Optional[str] = None
+        self.flash_depth = 0
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, Optional[str]]]):
+        if self.flash_tag is None:
+            if HtmlExtractor.has_class(attrs, "flash") or dict(attrs).get("id") == "flash_messages":
+                self.flash_tag = tag
+                self.flash_depth = 1
+                self.messages.append("")
+        elif tag == self.flash_tag:
+            self.flash_depth += 1
+
+    def handle_endtag(self, tag: str):
+        if tag != self.flash_tag:
+            return
+        self.flash_depth -= 1
+        if not self.flash_depth:
+            self.flash_tag = None
+
+    def handle_data(self, data: str):
+        if self.flash_tag is not None:
+            self.messages[-1] += data
+
+
+def extract_csrf(text: str) -> str:
+    extractor = CsrfExtractor()
+    extractor.extract(text)
+    if not extractor.csrf:
+        raise HtmlElementNotFound("csrf-token")
+    return extractor.csrf
+
+
+def extract_applications(text: str) -> list[tuple[str, list[str], Optional[str]]]:
+    extractor = ApplicationsExtractor()
+    extractor.extract(text)
+    return extractor.applications
+
+
+def extract_options(text: str, element_id: str) -> dict[str, str]:
+    extractor = OptionsExtractor(element_id)
+    extractor.extract(text)
+    if not extractor.found:
+        raise HtmlElementNotFound(element_id)
+    return {value: option_text for value, option_text in extractor.options if value}
+
+
+def read_dates(
+        chunks: Iterable[bytes],
+        after: str = "",
+        before: Optional[str] = None,
+        listed: Optional[list[str]] = None
+) -> list[str]:
+    # ISO dates compare as strings, so nothing is parsed. Dates from days.json come in ascending order, which lets
+    # reading stop at the first one past the window. listed gets every date read until then
+    dates = []
+    tail = b""
+    previous = ""
+    ascending = True
+    for chunk in chunks:
+        buffer = tail + chunk
+        # a date entry never spans the end of its object, the rest waits for the next chunk
+        cut = buffer.rfind(b"}") + 1
+        tail = buffer[cut:]
+        values = DAYS_DATE_PATTERN.findall(buffer[:cut].decode())
+        if not values:
+            continue
+        if listed is not None:
+            listed.extend(values)
+
+        ascending = ascending and values[0] >= previous and values == sorted(values)
+        previous = values[-1]
+        if not ascending:
+            dates.extend(x for x in values if after < x and (not before or x < before))
+            continue
+
+        end = bisect.bisect_left(values, before) if before else len(values)
+        dates.extend(values[bisect.bisect_right(values, after):end])
+        if end < len(values):
+            return dates
+
+    if not ascending:
+        dates.sort()
+        if listed is not None:
+            listed.sort()
+    return dates
+
+
+def extract_flash(text: str) -> list[str]:
+    extractor = FlashExtractor()
+    extractor.extract(text)
+    return [" ".join(message.split()) for message in extractor.messages if message.strip()]
+
+
+def classify_booking(response: Response) -> str:
+    if response.status_code in (301, 302, 303):
+        location = response.headers.get("Location", "")
+        if "/instructions" in location:
+            return BOOKING_BOOKED
+        if "/sign_in" in location:
+            return BOOKING_CSRF_EXPIRED
+        return BOOKING_UNKNOWN
+
+    if response.status_code in (401, 422):
+        return BOOKING_CSRF_EXPIRED
+
+    # 429 is the host throttling, not the account limit, and the governor already backs off on it
+    if response.status_code != 200:
+        return BOOKING_UNKNOWN
+
+    messages = " ".join(extract_flash(response.text))
+
+    if SLOT_TAKEN_PATTERN.search(messages):
+        return BOOKING_SLOT_TAKEN
+
+    if LIMIT_REACHED_PATTERN.search(messages):
+        return BOOKING_LIMIT_REACHED
+
+    return BOOKING_UNKNOWN
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> value
+        self.counters: dict[tuple[str, tuple[tuple[str, str], ...]], float] = dict()
+        # (name, labels) -> (bucket counts, sum, count)
+        self.histograms: dict[tuple[str, tuple[tuple[str, str], ...]], tuple[list[int], float, int]] = dict()
+        self.help: dict[str, tuple[str, str]] = dict()
+
+    def describe(self, name: str, metric_type: str, description: str):
+        self.help[name] = (metric_type, description)
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = value
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, value)
+        with self.lock:
+            buckets, total, count = self.histograms.get(key) or ([0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0)
+            buckets[bucket] += 1
+            self.histograms[key] = (buckets, total + value, count + 1)
+
+    @staticmethod
+    def format_labels(labels: tuple[tuple[str, str], ...], **extra: str) -> str:
+        labels = (*labels, *extra.items())
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def render(self) -> str:
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name: str):
+            if name in self.help and name not in described:
+                described.add(name)
+                metric_type, description = self.help[name]
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {metric_type}")
+
+        for (name, labels), value in counters:
+            describe(name)
+            lines.append(f"{name}{Metrics.format_labels(labels)} {value:g}")
+
+        for (name, labels), (buckets, total, count) in histograms:
+            describe(name)
+            cumulative = 0
+            for le, bucket_count in zip((*LATENCY_BUCKETS, "+Inf"), buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{Metrics.format_labels(labels, le=str(le))} {cumulative}")
+            lines.append(f"{name}_sum{Metrics.format_labels(labels)} {total:g}")
+            lines.append(f"{name}_count{Metrics.format_labels(labels)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+METRICS.describe("ais_request_duration_seconds", "histogram", "Latency of AIS requests by endpoint")
+METRICS.describe("ais_requests_total", "counter", "AIS requests by endpoint and status code")
+METRICS.describe("ais_logins_total", "counter", "Full login sequences")
+METRICS.describe("ais_unauthorized_total", "counter", "401 responses during polling which refreshed credentials")
+METRICS.describe("ais_polls_total", "counter", "Polls of available dates")
+METRICS.describe("ais_booking_attempts_total", "counter", "Booking requests sent")
+METRICS.describe("ais_bookings_total", "counter", "Successful bookings")
+METRICS.describe("ais_booking_results_total", "counter", "Booking responses by classified result")
+METRICS.describe("ais_rate_tokens", "gauge", "Tokens left in a rate limit bucket")
+METRICS.describe("ais_throttled_total", "counter", "Requests delayed by a rate limit bucket or backoff")
+METRICS.describe("ais_throttle_seconds_total", "counter", "Time requests waited for a rate limit bucket or backoff")
+METRICS.describe("ais_backoffs_total", "counter", "Backoffs after 429 and 5xx responses by status code")
+METRICS.describe("ais_hedged_requests_total", "counter", "Duplicated slow GETs by endpoint and the faster request")
+METRICS.describe("ais_clock_offset_seconds", "gauge", "Estimated AIS server clock minus local clock")
+METRICS.describe("ais_clock_error_seconds", "gauge", "Half width of the server clock offset estimate")
+METRICS.describe("ais_round_trip_seconds", "gauge", "Round trip of the last response with a Date header")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, log_format: str, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        data = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header(CONTENT_TYPE, "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class Clock:
+    SPIN_SECONDS = 0.002
+
+    def now(self) -> float:
+        return time.time()
+
+    def sleep(self, seconds: float):
+        deadline = time.perf_counter() + seconds
+        if seconds > Clock.SPIN_SECONDS:
+            time.sleep(seconds - Clock.SPIN_SECONDS)
+        while time.perf_counter() < deadline:
+            pass
+
+    def wait(self, seconds: float, event: threading.Event) -> bool:
+        # sleep which ends early once the event is set
+        deadline = time.perf_counter() + seconds
+        if event.wait(max(0.0, seconds - Clock.SPIN_SECONDS)):
+            return True
+        while time.perf_counter() < deadline:
+            pass
+        return False
+
+
+class ServerClock(Clock):
+    def __init__(self, samples: int = CLOCK_SAMPLES):
+        self.lock = threading.Lock()
+        # offset bounds (lower, upper) from every response, the true offset lies in all of them
+        self.samples: collections.deque[tuple[float, float]] = collections.deque(maxlen=samples)
+        self.offset = 0.0
+        self.error: Optional[float] = None
+        self.round_trip: Optional[float] = None
+        self.logged_offset: Optional[float] = None
+
+    def now(self) -> float:
+        return time.time() + self.offset
+
+    def observe(self, sent: float, received: float, date_header: Optional[str]) -> bool:
+        try:
+            server_time = parsedate_to_datetime(date_header).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+        with self.lock:
+            # Date has whole seconds: the server was at [server_time, server_time + 1) between sent and received
+            self.samples.append((server_time - received, server_time + 1 - sent))
+            lower = max(x[0] for x in self.samples)
+            upper = min(x[1] for x in self.samples)
+            # no offset fits all samples when the clocks drift apart, the oldest ones go first
+            while lower > upper and len(self.samples) > 1:
+                self.samples.popleft()
+                lower = max(x[0] for x in self.samples)
+                upper = min(x[1] for x in self.samples)
+
+            self.offset = (lower + upper) / 2
+            self.error = (upper - lower) / 2
+            self.round_trip = received - sent
+            METRICS.set("ais_clock_offset_seconds", self.offset)
+            METRICS.set("ais_clock_error_seconds", self.error)
+            METRICS.set("ais_round_trip_seconds", self.round_trip)
+
+            if self.logged_offset is None or abs(self.offset - self.logged_offset) >= CLOCK_LOG_CHANGE:
+                self.logged_offset = self.offset
+                return True
+            return False
+
+
+class RateStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # bucket -> [tokens, updated at, blocked until, failures]
+        self.buckets: dict[str, list[float]] = dict()
+
+    def transaction(self, keys: list[str], update: Callable[[dict[str, list[float]]], float]) -> float:
+        with self.lock:
+            states = {x: self.buckets[x] for x in keys if x in self.buckets}
+            result = update(states)
+            self.buckets.update(states)
+            return result
+
+
+class SharedRateStore(RateStore):
+    def __init__(self, rate_file: str):
+        super().__init__()
+        self.connection = sqlite3.connect(rate_file, timeout=30, isolation_level=None, check_same_thread=False)
+        # the buckets only matter while the bots run, durability is not worth an fsync per request
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.executescript(RATE_SCHEMA)
+
+    def transaction(self, keys: list[str], update: Callable[[dict[str, list[float]]], float]) -> float:
+        with self.lock:
+            # IMMEDIATE takes the write lock up front, so other processes wait instead of reading stale tokens
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                states = {
+                    row[0]: list(row[1:])
+                    for row in self.connection.execute(
+                        f"SELECT key, tokens, updated, blocked_until, failures FROM buckets "
+                        f"WHERE key IN ({','.join('?' * len(keys))})",
+                        keys
+                    )
+                }
+                result = update(states)
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?, ?)",
+                    [(k, *v) for k, v in states.items()]
+                )
+                self.connection.execute("COMMIT")
+                return result
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+
+class RateGovernor:
+    def __init__(
+            self,
+            store: RateStore,
+            host_rate: float,
+            account_rate: float,
+            burst: int,
+            backoff_max: float,
+            hedge_rate: float = 0,
+            clock: Optional[Clock] = None
+    ):
+        self.store = store
+        # requests per second, 0 leaves only the backoff
+        self.host_rate = host_rate
+        self.account_rate = account_rate
+        self.hedge_rate = hedge_rate
+        self.burst = max(1, burst)
+        self.backoff_max = backoff_max
+        self.clock = clock or Clock()
+        self.failing = False
+
+    def buckets(self, host: str, account: str) -> list[tuple[str, float]]:
+        return [(f"host {host}", self.host_rate), (f"account {host} {account}", self.account_rate)]
+
+    def take(self, buckets: list[tuple[str, float]], now: float, states: dict[str, list[float]]) -> float:
+        waits = []
+        for key, rate in buckets:
+            state = states.setdefault(key, [self.burst, now, 0.0, 0])
+            if rate > 0:
+                state[0] = min(self.burst, state[0] + max(0.0, now - state[1]) * rate)
+            state[1] = now
+            waits.append(max(state[2] - now, (1 - state[0]) / rate if rate > 0 and state[0] < 1 else 0.0))
+            self.failing = self.failing or state[3] > 0
+
+        if max(waits) > 0:
+            return max(waits)
+
+        for key, rate in buckets:
+            if rate > 0:
+                states[key][0] -= 1
+                METRICS.set("ais_rate_tokens", states[key][0], bucket=key)
+        return 0.0
+
+    def try_acquire(self, host: str, account: str, hedge: bool = False) -> bool:
+        buckets = self.buckets(host, account)
+        if hedge:
+            # hedges have a budget of their own, inside the host and account ones
+            buckets.append((f"hedge {host} {account}", self.hedge_rate))
+        return self.store.transaction(
+            [x[0] for x in buckets],
+            functools.partial(self.take, buckets, self.clock.now())
+        ) <= 0
+
+    def acquire(self, host: str, account: str) -> float:
+        buckets = self.buckets(host, account)
+        waited = 0.0
+        while True:
+            wait = self.store.transaction(
+                [x[0] for x in buckets],
+                functools.partial(self.take, buckets, self.clock.now())
+            )
+            if wait <= 0:
+                break
+            if not waited:
+                METRICS.inc("ais_throttled_total", account=account)
+            self.clock.sleep(wait)
+            waited += wait
+
+        if waited:
+            METRICS.inc("ais_throttle_seconds_total", waited, account=account)
+        return waited
+
+    def back_off(self, key: str, now: float, retry_after: float, states: dict[str, list[float]]) -> float:
+        state = states.setdefault(key, [self.burst, now, 0.0, 0])
+        state[3] += 1
+        delay = min(self.backoff_max, BACKOFF_BASE * 2 ** (state[3] - 1))
+        # equal jitter keeps at least half of the delay, so instances which failed together do not retry together
+        delay = max(retry_after, random.uniform(delay / 2, delay))
+        state[2] = max(state[2], now + delay)
+        return delay
+
+    def recover(self, key: str, states: dict[str, list[float]]) -> float:
+        if key in states:
+            states[key][3] = 0
+        return 0.0
+
+    def feedback(self, host: str, status: int, retry_after: Optional[str] = None) -> float:
+        key = f"host {host}"
+        if status == 429 or status >= 500:
+            self.failing = True
+            METRICS.inc("ais_backoffs_total", status=str(status))
+            try:
+                retry_after = min(float(retry_after or 0), self.backoff_max)
+            except ValueError:
+                retry_after = 0.0
+            return self.store.transaction(
+                [key],
+                functools.partial(self.back_off, key, self.clock.now(), retry_after)
+            )
+
+        if self.failing:
+            self.failing = False
+            self.store.transaction([key], functools.partial(self.recover, key))
+        return 0.0
+
+
+class LatencyTracker:
+    def __init__(self, size: int = LATENCY_SAMPLES):
+        self.samples: collections.deque[float] = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        with self.lock:
+            if len(self.samples) < HEDGE_MIN_SAMPLES:
+                return None
+            samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def parse_timeouts(spec: Optional[str], connect: float, read: float) -> dict[str, tuple[float, float]]:
+    # "book:30,days:2/5" -> read timeout of book, connect and read timeouts of days
+    timeouts = dict()
+    for endpoint, value in parse_pairs(spec).items():
+        connect_value, _, read_value = value.rpartition("/")
+        try:
+            timeouts[endpoint] = (float(connect_value or connect), float(read_value or read))
+        except ValueError:
+            pass
+    return timeouts
+
+
+def create_rate_store(rate_file: Optional[str]) -> RateStore:
+    return SharedRateStore(rate_file) if rate_file else RateStore()
+
+
+def cassette_url(url: str) -> str:
+    # cassettes are replayed against any base url
+    parsed = urlparse(url)
+    return f"{parsed.path}?{parsed.query}" if parsed.query else parsed.path
+
+
+def cassette_response(
+        adapter: HTTPAdapter,
+        request: PreparedRequest,
+        status: int,
+        headers: dict[str, str],
+        body: bytes
+) -> Response:
+    raw = HTTPResponse(
+        body=io.BytesIO(body),
+        headers=headers,
+        status=status,
+        reason=http.client.responses.get(status, ""),
+        preload_content=False,
+        decode_content=False
+    )
+    return adapter.build_response(request, raw)
+
+
+class Cassette:
+    def __init__(self, cassette_file: str):
+        self.cassette_file = cassette_file
+        self.secrets: set[str] = set()
+        self.bodies: dict[bytes, int] = dict()
+        self.started = time.time()
+        self.lock = threading.Lock()
+        open(self.cassette_file, "w").close()
+
+    def protect(self, *secrets: str):
+        with self.lock:
+            self.secrets.update(x for x in secrets if x)
+
+    def redact(self, text: str) -> str:
+        text = REDACTED_TOKEN_PATTERN.sub(rf"\1{REDACTED}", text)
+        for secret in self.secrets:
+            text = text.replace(secret, REDACTED)
+        return text
+
+    def record(
+            self,
+            request: PreparedRequest,
+            sent: float,
+            received: float,
+            status: int,
+            headers: dict[str, str],
+            body: bytes
+    ):
+        request_body = request.body.decode(errors="replace") if isinstance(request.body, bytes) else request.body
+        try:
+            skew = parsedate_to_datetime(headers.get("Date") or "").timestamp() - received
+        except (TypeError, ValueError):
+            skew = None
+
+        headers = {
+            k: REDACTED_COOKIE_PATTERN.sub(rf"\1{REDACTED}", v) if k.lower() == SET_COOKIE else v
+            for k, v in headers.items() if k.lower() not in CASSETTE_DROPPED_HEADERS
+        }
+
+        with self.lock:
+            try:
+                text = self.redact(body.decode())
+                stored = {"text": text}
+            except UnicodeDecodeError:
+                text = None
+                stored = {"base64": base64.b64encode(body).decode()}
+            key = text.encode() if text is not None else body
+
+            records = []
+            # polls return the same bodies over and over, each one is stored once
+            if key not in self.bodies:
+                self.bodies[key] = len(self.bodies)
+                records.append({"body": self.bodies[key], **stored})
+            records.append({
+                "at": round(sent - self.started, 3),
+                "elapsed": round(received - sent, 4),
+                "method": request.method,
+                "url": cassette_url(request.url),
+                "request": REDACTED_FIELD_PATTERN.sub(rf"\1{REDACTED}", request_body) if request_body else None,
+                "status": status,
+                "headers": headers,
+                "skew": skew,
+                "response": self.bodies[key]
+            })
+            with open(self.cassette_file, "a") as f:
+                f.writelines(json.dumps(x, separators=(",", ":")) + "\n" for x in records)
+
+
+class RecordingAdapter(HTTPAdapter):
+    def __init__(self, cassette: Cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(
+            self,
+            request: PreparedRequest,
+            stream=False,
+            timeout=None,
+            verify=True,
+            cert=None,
+            proxies=None
+    ) -> Response:
+        sent = time.time()
+        response = super().send(request, stream, timeout, verify, cert, proxies)
+        # the whole body is read here, streaming readers get it from memory
+        body = response.content
+        received = time.time()
+        self.cassette.record(request, sent, received, response.status_code, dict(response.headers), body)
+
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in CASSETTE_DROPPED_HEADERS - {"date"}}
+        return cassette_response(self, request, response.status_code, headers, body)
+
+
+class ReplayAdapter(HTTPAdapter):
+    def __init__(self, cassette_file: str, speed: float = 1.0):
+        super().__init__()
+        # 1 replays the recorded response times, 0 answers at once
+        self.speed = speed
+        self.bodies: dict[int, bytes] = dict()
+        # (method, url) -> exchanges in recorded order, the last one is repeated when the others are used up
+        self.exchanges: dict[tuple[str, str], collections.deque[dict]] = dict()
+        self.replayed = 0
+        self.lock = threading.Lock()
+
+        with open(cassette_file) as f:
+            for line in f:
+                record = json.loads(line)
+                if "response" not in record:
+                    self.bodies[record["body"]] = (
+                        record["text"].encode() if "text" in record else base64.b64decode(record["base64"])
+                    )
+                else:
+                    self.exchanges.setdefault((record["method"], record["url"]), collections.deque()).append(record)
+
+    def send(
+            self,
+            request: PreparedRequest,
+            stream=False,
+            timeout=None,
+            verify=True,
+            cert=None,
+            proxies=None
+    ) -> Response:
+        url = cassette_url(request.url)
+        with self.lock:
+            exchanges = self.exchanges.get((request.method, url))
+            if not exchanges:
+                raise requests.ConnectionError(f"No recorded response for {request.method} {url}", request=request)
+            exchange = exchanges.popleft() if len(exchanges) > 1 else exchanges[0]
+            self.replayed += 1
+
+        if self.speed > 0:
+            time.sleep(exchange["elapsed"] / self.speed)
+
+        headers = dict(exchange["headers"])
+        if exchange["skew"] is not None:
+            headers["Date"] = formatdate(time.time() + exchange["skew"], usegmt=True)
+        return cassette_response(self, request, exchange["status"], headers, self.bodies[exchange["response"]])
+
+    def close(self):
+        pass
+
+
+class SchedulePolicy(abc.ABC):
+    @abc.abstractmethod
+    def next(self, after: float) -> float:
+        pass
+
+
+class IntervalPolicy(SchedulePolicy):
+    def __init__(self, seconds: float):
+        if seconds <= 0:
+            raise ValueError(f"Interval must be positive: {seconds}")
+        self.seconds = seconds
+
+    def next(self, after: float) -> float:
+        return after + self.seconds
+
+
+class CronPolicy(SchedulePolicy):
+    def __init__(self, spec: str):
+        fields = spec.split()
+        if len(fields) != 3:
+            raise ValueError(f"Expected \"second minute hour\" schedule: {spec}")
+
+        self.seconds = CronPolicy.parse_field(fields[0], 59)
+        self.minutes = set(CronPolicy.parse_field(fields[1], 59))
+        self.hours = set(CronPolicy.parse_field(fields[2], 23))
+
+    @staticmethod
+    def parse_field(field: str, max_value: int) -> list[int]:
+        values = set()
+        for part in field.split(","):
+            value_range, _, step = part.partition("/")
+            if value_range == "*":
+                start, end = 0, max_value
+            elif "-" in value_range:
+                start, end = map(int, value_range.split("-", maxsplit=1))
+            else:
+                start = end = int(value_range)
+
+            if not 0 <= start <= end <= max_value:
+                raise ValueError(f"Schedule field out of range: {field}")
+
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return sorted(values)
+
+    def next(self, after: float) -> float:
+        moment = datetime.fromtimestamp(int(after) + 1)
+        for _ in range(2 * 24 * 60):
+            if moment.hour in self.hours and moment.minute in self.minutes:
+                for second in self.seconds:
+                    if second >= moment.second:
+                        return moment.replace(second=second).timestamp()
+            moment = moment.replace(second=0) + timedelta(minutes=1)
+        raise ValueError("Schedule never fires")
+
+
+class AdaptivePolicy(SchedulePolicy):
+    def __init__(
+            self,
+            budget: int,
+            quiet_interval: float,
+            history: Optional[Callable[[float], tuple[list[float], Optional[float]]]] = None
+    ):
+        self.budget = budget
+        self.quiet_interval = quiet_interval
+        # since -> (release times, time of the first observation)
+        self.history = history
+        self.learned_at: Optional[float] = None
+        # minute of day -> polls in that minute
+        self.polls: list[float] = []
+        self.fired: list[float] = []
+
+    def learn(self, now: float):
+        releases, first_seen = self.history(now - ADAPTIVE_HISTORY_DAYS * 24 * 3600) if self.history else ([], None)
+        days = max(1.0, (now - first_seen) / (24 * 3600)) if first_seen else 1.0
+
+        counts = [0.0] * 24 * 60
+        for released_at in releases:
+            moment = datetime.fromtimestamp(released_at)
+            minute = moment.hour * 60 + moment.minute
+            counts[minute] += 1
+            # a release is seen by the first poll after it, so it may belong to the previous minute
+            counts[minute - 1] += 0.5
+
+        base = min(60.0, 60 / self.quiet_interval)
+        polls = [base + (60 - base) * min(1.0, ADAPTIVE_GAIN * x / days) for x in counts]
+
+        for hour in range(24):
+            hour_polls = polls[hour * 60:(hour + 1) * 60]
+            total = sum(hour_polls)
+            if total <= self.budget:
+                continue
+            extra = total - base * 60
+            if extra > 0 and base * 60 <= self.budget:
+                scale = (self.budget - base * 60) / extra
+                hour_polls = [base + (x - base) * scale for x in hour_polls]
+            else:
+                hour_polls = [x * self.budget / total for x in hour_polls]
+            polls[hour * 60:(hour + 1) * 60] = hour_polls
+
+        self.polls = polls
+        self.learned_at = now
+
+    def next(self, after: float) -> float:
+        if self.learned_at is None or after - self.learned_at >= ADAPTIVE_RELEARN_SECONDS:
+            self.learn(after)
+
+        due = self.next_in_plan(after)
+
+        # hard cap on polls in any hour, whatever the plan says
+        self.fired = [x for x in self.fired if x > due - 3600]
+        if len(self.fired) >= self.budget:
+            due = max(due, self.fired[len(self.fired) - self.budget] + 3600)
+        self.fired.append(due)
+        return due
+
+    def next_in_plan(self, after: float) -> float:
+        moment = datetime.fromtimestamp(int(after)).replace(second=0)
+        for _ in range(2 * 24 * 60):
+            polls = self.polls[moment.hour * 60 + moment.minute]
+            if polls > 0:
+                start = moment.timestamp()
+                interval = 60 / polls
+                due = start + (int((after - start) / interval) + 1) * interval if after >= start else start
+                if due < start + 60:
+                    return due
+            moment += timedelta(minutes=1)
+        raise ValueError("Schedule never fires")
+
+
+def parse_schedule(spec: str) -> SchedulePolicy:
+    if spec.startswith("every "):
+        return IntervalPolicy(float(spec.removeprefix("every ").rstrip("s")))
+    return CronPolicy(spec)
+
+
+class ScheduledJob:
+    def __init__(
+            self,
+            policy: SchedulePolicy,
+            callback: Callable,
+            warm_up: Optional[Callable] = None,
+            lead: float = 0
+    ):
+        self.policy = policy
+        self.callback = callback
+        self.warm_up = warm_up
+        self.lead = lead
+
+
+class Scheduler:
+    def __init__(self, clock: Optional[Clock] = None, logger: Optional[Callable[[str], None]] = None):
+        self.clock = clock or Clock()
+        self.logger = logger
+        self.queue: list[tuple[float, int, ScheduledJob]] = []
+        self.counter = itertools.count()
+        self.running = False
+        self.paused = False
+        self.wakeups = 0
+        # commands from other threads run between jobs, so they never overlap a poll
+        self.commands: queue.Queue[tuple[Callable, Future]] = queue.Queue()
+        self.interrupt = threading.Event()
+
+    def add(
+            self,
+            policy: SchedulePolicy,
+            callback: Callable,
+            warm_up: Optional[Callable] = None,
+            lead: float = 0
+    ):
+        self.schedule(ScheduledJob(policy, callback, warm_up, lead), self.clock.now())
+
+    def schedule(self, job: ScheduledJob, after: float):
+        heapq.heappush(self.queue, (job.policy.next(after), next(self.counter), job))
+
+    def clear(self):
+        self.queue = []
+
+    def next_due(self) -> Optional[float]:
+        return self.queue[0][0] if self.queue else None
+
+    def stop(self):
+        self.running = False
+        self.interrupt.set()
+
+    def pause(self, paused: bool):
+        self.paused = paused
+        self.interrupt.set()
+
+    def call(self, command: Callable) -> Future:
+        future = Future()
+        self.commands.put((command, future))
+        self.interrupt.set()
+        return future
+
+    def run_commands(self):
+        while True:
+            try:
+                command, future = self.commands.get_nowait()
+            except queue.Empty:
+                return
+
+            # noinspection PyBroadException
+            try:
+                future.set_result(command())
+            except Exception as err:
+                future.set_exception(err)
+
+    def wait(self, seconds: float) -> bool:
+        if self.clock.wait(seconds, self.interrupt):
+            self.interrupt.clear()
+            return True
+        return False
+
+    def log_wait(self, due: float):
+        if self.logger and due - self.clock.now() > 10:
+            self.logger(f"Wait until {datetime.fromtimestamp(due).strftime('%H:%M:%S')}")
+
+    def needs_warm_up(self, job: ScheduledJob, due: float) -> bool:
+        return job.warm_up is not None and job.lead > 0 and due - self.clock.now() > job.lead
+
+    def run(self):
+        self.running = True
+        while self.running and self.queue:
+            self.run_commands()
+            if self.paused:
+                self.interrupt.wait()
+                self.interrupt.clear()
+                continue
+
+            # the job stays queued while waiting, a command may replace it
+            due, _, job = self.queue[0]
+            self.log_wait(due)
+
+            if self.needs_warm_up(job, due):
+                if self.wait(due - job.lead - self.clock.now()):
+                    continue
+                self.wakeups += 1
+                job.warm_up()
+
+            if self.wait(due - self.clock.now()):
+                continue
+            self.wakeups += 1
+
+            heapq.heappop(self.queue)
+            job.callback()
+            self.schedule(job, max(due, self.clock.now()))
+
+    async def sleep_until(self, moment: float):
+        delay = moment - self.clock.now() - Clock.SPIN_SECONDS
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.clock.sleep(max(0.0, moment - self.clock.now()))
+        self.wakeups += 1
+
+    async def run_async(self):
+        self.running = True
+        while self.running and self.queue:
+            due, _, job = heapq.heappop(self.queue)
+            self.log_wait(due)
+
+            if self.needs_warm_up(job, due):
+                await self.sleep_until(due - job.lead)
+                result = job.warm_up()
+                if asyncio.iscoroutine(result):
+                    await result
+
+            await self.sleep_until(due)
+
+            result = job.callback()
+            if asyncio.iscoroutine(result):
+                await result
+            self.schedule(job, max(due, self.clock.now()))
+
+
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only tracebacks are rendered in the calling thread, message formatting is left to the listener
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
 class Logger:
-    def __init__(self, log_file: str, log_format: str):
+    def __init__(
+            self,
+            log_file: str,
+            log_format: str,
+            level: str = DEFAULT_LOG_LEVEL,
+            max_bytes: int = DEFAULT_LOG_MAX_BYTES,
+            backup_count: int = DEFAULT_LOG_BACKUP_COUNT,
+            rotate_when: Optional[str] = None
+    ):
         log_formatter = logging.Formatter(log_format)
         root_logger = logging.getLogger()
 
-        file_handler = logging.FileHandler(log_file)
+        if rotate_when:
+            file_handler = TimedRotatingFileHandler(log_file, when=rotate_when, backupCount=backup_count)
+        else:
+            file_handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
         file_handler.setFormatter(log_formatter)
-        root_logger.addHandler(file_handler)
 
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(log_formatter)
-        root_logger.addHandler(console_handler)
 
-        root_logger.setLevel("DEBUG")
+        log_queue = queue.SimpleQueue()
+        self.listener = QueueListener(log_queue, file_handler, console_handler)
+        self.listener.start()
+        self.stopped = False
+        atexit.register(self.stop)
+
+        root_logger.addHandler(DeferredQueueHandler(log_queue))
+        root_logger.setLevel(level)
 
         self.root_logger = root_logger
 
-    def __call__(self, message: str | Exception):
-        self.root_logger.debug(message, exc_info=isinstance(message, Exception))
+    def __call__(self, message: str | Exception, level: int = logging.INFO):
+        if isinstance(message, Exception):
+            self.root_logger.error(message, exc_info=True)
+        else:
+            self.root_logger.log(level, message)
+
+    def debug(self, message: str):
+        self.root_logger.debug(message)
+
+    def stop(self):
+        if not self.stopped:
+            self.stopped = True
+            self.listener.stop()
+
+
+class AccountLogger:
+    def __init__(self, logger: Logger, account: str):
+        self.logger = logger
+        self.account = account
+
+    def __call__(self, message: str | Exception, level: int = logging.INFO):
+        if isinstance(message, Exception):
+            self.logger.root_logger.error(f"[{self.account}] {message}", exc_info=True)
+        else:
+            self.logger.root_logger.log(level, f"[{self.account}] {message}")
+
+    def debug(self, message: str):
+        self.logger.root_logger.debug(f"[{self.account}] {message}")
 
 
 class Appointment:
+    __slots__ = ("schedule_id", "description", "appointment_datetime")
+
     def __init__(self, schedule_id: str, description: str, appointment_datetime: Optional[datetime]):
         self.schedule_id = schedule_id
         self.description = description
         self.appointment_datetime = appointment_datetime
 
 
+class AvailabilityTracker:
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.dates: set[str] = set()
+        # date -> when its times were fetched, while the date stays listed
+        self.settled: dict[str, float] = dict()
+
+    def update(self, dates: list[str]) -> tuple[list[str], list[str]]:
+        current = set(dates)
+        appeared = sorted(current - self.dates)
+        gone = sorted(self.dates - current)
+        for x in gone:
+            self.settled.pop(x, None)
+        self.dates = current
+        return appeared, gone
+
+    def changed(self, dates: list[str], now: float) -> list[str]:
+        return [x for x in dates if x not in self.settled or now - self.settled[x] >= self.ttl]
+
+    def settle(self, available_date: str, now: float):
+        if self.ttl > 0:
+            self.settled[available_date] = now
+
+    def invalidate(self, available_date: Optional[str] = None):
+        if available_date is None:
+            self.settled.clear()
+        else:
+            self.settled.pop(available_date, None)
+
+
+class BookingCandidate:
+    __slots__ = (
+        "available_date", "available_time", "ordinal", "key", "facility_id", "asc_facility_id",
+        "asc_available_date", "asc_available_time", "asc_from_store", "csrf", "body"
+    )
+
+    def __init__(
+            self,
+            available_date: str,
+            available_time: str,
+            facility_id: Optional[str] = None,
+            asc_facility_id: Optional[str] = None
+    ):
+        self.available_date = available_date
+        self.available_time = available_time
+        # minutes since day one, so candidates and the current appointment compare as ints
+        self.ordinal = date_ordinal(available_date)
+        self.key = self.ordinal * MINUTES_PER_DAY + time_minutes(available_time)
+        self.facility_id = facility_id
+        self.asc_facility_id = asc_facility_id
+        self.asc_available_date: Optional[str] = None
+        self.asc_available_time: Optional[str] = None
+        self.asc_from_store = False
+        self.csrf: Optional[str] = None
+        self.body: Optional[str] = None
+
+    @property
+    def appointment_datetime(self) -> datetime:
+        return datetime.fromordinal(self.ordinal) + timedelta(minutes=self.key % MINUTES_PER_DAY)
+
+    def __str__(self) -> str:
+        if self.asc_available_date:
+            return (f"{self.available_date} {self.available_time} "
+                    f"(ASC {self.asc_available_date} {self.asc_available_time})")
+        return f"{self.available_date} {self.available_time}"
+
+
+class SessionCache:
+    def __init__(self, session_file: str, ttl: int):
+        self.session_file = session_file
+        self.ttl = ttl
+
+    def load(self) -> Optional[dict]:
+        if self.ttl <= 0 or not os.path.exists(self.session_file):
+            return None
+
+        with open(self.session_file) as f:
+            # noinspection PyBroadException
+            try:
+                data = json.load(f)
+            except:
+                return None
+
+        if not isinstance(data, dict) or data.get("saved_at", 0) + self.ttl < time.time():
+            return None
+        return data
+
+    def save(self, data: dict):
+        if self.ttl <= 0:
+            return
+
+        temp_file = f"{self.session_file}.tmp"
+        with open(temp_file, "w") as f:
+            json.dump({**data, "saved_at": time.time()}, f)
+        os.replace(temp_file, self.session_file)
+
+    def clear(self):
+        if os.path.exists(self.session_file):
+            os.remove(self.session_file)
+
+
+class AscSlotStore:
+    def __init__(self, asc_file: str, ttl: int):
+        self.asc_file = asc_file
+        self.ttl = ttl
+        self.ordinals: list[int] = []
+        # date ordinal -> (date, times, fetched at)
+        self.slots: dict[int, tuple[str, list[str], float]] = dict()
+        self.journal_size = 0
+        self.lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def load(self):
+        with self.lock:
+            self.ordinals = []
+            self.slots = dict()
+            self.journal_size = 0
+
+            if not os.path.exists(self.asc_file):
+                return
+
+            with open(self.asc_file) as f:
+                content = f.read()
+
+            # noinspection PyBroadException
+            try:
+                legacy = json.loads(content)
+            except:
+                legacy = None
+
+            if isinstance(legacy, dict):
+                fetched_at = os.path.getmtime(self.asc_file)
+                for asc_date, times in legacy.items():
+                    self.set(asc_date, times, fetched_at)
+                self.evict()
+                self.compact()
+                return
+
+            for line in content.splitlines():
+                # noinspection PyBroadException
+                try:
+                    record = json.loads(line)
+                    if record["times"] is None:
+                        self.unset(record["date"])
+                    else:
+                        self.set(record["date"], record["times"], record["at"])
+                    self.journal_size += 1
+                except:
+                    pass
+
+            self.evict()
+            if self.journal_size > len(self.slots):
+                self.compact()
+
+    def set(self, asc_date: str, times: list[str], fetched_at: float):
+        ordinal = date_ordinal(asc_date)
+        if ordinal not in self.slots:
+            bisect.insort(self.ordinals, ordinal)
+        self.slots[ordinal] = (asc_date, times, fetched_at)
+
+    def unset(self, asc_date: str) -> bool:
+        ordinal = date_ordinal(asc_date)
+        if ordinal not in self.slots:
+            return False
+        del self.slots[ordinal]
+        self.ordinals.pop(bisect.bisect_left(self.ordinals, ordinal))
+        return True
+
+    def put(self, asc_date: str, times: list[str]):
+        with self.lock:
+            fetched_at = time.time()
+            self.set(asc_date, times, fetched_at)
+            self.append({"date": asc_date, "times": times, "at": fetched_at})
+
+    def remove(self, asc_date: str):
+        with self.lock:
+            if self.unset(asc_date):
+                self.append({"date": asc_date, "times": None})
+
+    def remove_time(self, asc_date: str, asc_time: str):
+        with self.lock:
+            slot = self.slots.get(date_ordinal(asc_date))
+            if not slot or asc_time not in slot[1]:
+                return
+
+            times = [x for x in slot[1] if x != asc_time]
+            self.set(asc_date, times, slot[2])
+            self.append({"date": asc_date, "times": times, "at": slot[2]})
+
+    def retain(self, asc_dates: list[str]):
+        with self.lock:
+            keep = {date_ordinal(x) for x in asc_dates}
+            for ordinal in [x for x in self.ordinals if x not in keep]:
+                self.remove(self.slots[ordinal][0])
+
+    def find(self, start_ordinal: int, end_ordinal: int, latest: bool = False) -> Optional[tuple[str, list[str]]]:
+        with self.lock:
+            expired_before = time.time() - self.ttl
+            start = bisect.bisect_left(self.ordinals, start_ordinal)
+            end = bisect.bisect_left(self.ordinals, end_ordinal)
+            ordinals = self.ordinals[start:end]
+            for ordinal in reversed(ordinals) if latest else ordinals:
+                asc_date, times, fetched_at = self.slots[ordinal]
+                if times and fetched_at >= expired_before:
+                    return asc_date, times
+            return None
+
+    def get(self, asc_date: str) -> list[str]:
+        with self.lock:
+            slot = self.slots.get(date_ordinal(asc_date))
+            if not slot or slot[2] < time.time() - self.ttl:
+                return []
+            return slot[1]
+
+    def usable(self) -> list[tuple[int, str, list[str]]]:
+        with self.lock:
+            expired_before = time.time() - self.ttl
+            return [
+                (ordinal, *self.slots[ordinal][:2])
+                for ordinal in self.ordinals
+                if self.slots[ordinal][1] and self.slots[ordinal][2] >= expired_before
+            ]
+
+    def evict(self):
+        with self.lock:
+            expired_before = time.time() - self.ttl
+            for ordinal in [x for x in self.ordinals if self.slots[x][2] < expired_before or not self.slots[x][1]]:
+                self.remove(self.slots[ordinal][0])
+
+    def append(self, record: dict):
+        with open(self.asc_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.journal_size += 1
+        if self.journal_size > 4 * len(self.slots) + 16:
+            self.compact()
+
+    def compact(self):
+        temp_file = f"{self.asc_file}.tmp"
+        with open(temp_file, "w") as f:
+            for ordinal in self.ordinals:
+                asc_date, times, fetched_at = self.slots[ordinal]
+                f.write(json.dumps({"date": asc_date, "times": times, "at": fetched_at}) + "\n")
+        os.replace(temp_file, self.asc_file)
+        self.journal_size = len(self.slots)
+
+
+class HistoryStore:
+    def __init__(self, history_file: str, logger: Optional[Callable[[str], None]] = None):
+        self.history_file = history_file
+        self.logger = logger
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        # (table, key) -> (row id, payload, last seen, observed values, earliest day, read until) of the latest row
+        self.latest: dict[
+            tuple[str, tuple],
+            tuple[int, str, int, Optional[list[str]], Optional[int], Optional[int]]
+        ] = dict()
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = False
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.history_file)
+        connection.executescript(HISTORY_SCHEMA)
+        # files written before days.json reading stopped early
+        if "read_until" not in {x[1] for x in connection.execute("PRAGMA table_info(dates)")}:
+            connection.execute("ALTER TABLE dates ADD COLUMN read_until INTEGER")
+        return connection
+
+    def start(self) -> "HistoryStore":
+        self.thread = threading.Thread(target=self.run, name="history", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        if not self.stopped and self.thread:
+            self.stopped = True
+            self.queue.put(None)
+            self.thread.join()
+
+    def record_dates(
+            self,
+            country: str,
+            facility_id: str,
+            observed_at: float,
+            dates: list[str],
+            read_until: Optional[str] = None
+    ):
+        # read_until is the last date read when the rest of days.json was skipped, the row says nothing past it
+        read_until_ordinal = date_ordinal(read_until) if read_until else None
+        self.queue.put(("dates", (country, facility_id), int(observed_at), dates, read_until_ordinal))
+
+    def record_times(
+            self,
+            country: str,
+            facility_id: str,
+            observed_at: float,
+            available_date: str,
+            times: list[str]
+    ):
+        key = (country, facility_id, date_ordinal(available_date))
+        self.queue.put(("times", key, int(observed_at), times))
+
+    def run(self):
+        connection: Optional[sqlite3.Connection] = None
+        try:
+            while True:
+                item = self.queue.get()
+                # a failed write loses its batch but never the writer, or the queue would grow until exit
+                # noinspection PyBroadException
+                try:
+                    connection = connection or self.connect()
+                    while item is not None:
+                        # noinspection PyBroadException
+                        try:
+                            self.write(connection, *item)
+                        except Exception as err:
+                            self.log(f"History write of {item[0]} failed: {err}")
+                        try:
+                            item = self.queue.get_nowait()
+                        except queue.Empty:
+                            break
+                    connection.commit()
+                except Exception as err:
+                    self.log(f"History batch dropped: {err}")
+                    # cached row ids may belong to the rolled back rows
+                    self.latest.clear()
+                    if connection:
+                        connection.close()
+                        connection = None
+                if item is None:
+                    return
+        finally:
+            if connection:
+                connection.close()
+
+    def log(self, message: str):
+        if self.logger:
+            self.logger(message)
+
+    def write(
+            self,
+            connection: sqlite3.Connection,
+            table: str,
+            key: tuple,
+            observed_at: int,
+            values: list[str],
+            read_until: Optional[int] = None
+    ):
+        latest = self.latest.get((table, key)) or self.load_latest(connection, table, key)
+
+        if latest and latest[3] == values:
+            earliest, payload = latest[4], latest[1]
+        else:
+            earliest, payload = HistoryStore.encode(table, values)
+
+        # unchanged payload only stretches the latest row, so months of polling stay small
+        if latest and latest[4:] == (earliest, read_until) and latest[1] == payload and \
+                observed_at - latest[2] <= HISTORY_MAX_GAP:
+            connection.execute(
+                f"UPDATE {table} SET last_seen = ?, polls = polls + 1 WHERE id = ?",
+                (observed_at, latest[0])
+            )
+            self.latest[(table, key)] = (latest[0], payload, observed_at, values, earliest, read_until)
+            return
+
+        if table == "dates":
+            cursor = connection.execute(
+                "INSERT INTO dates (country, facility_id, first_seen, last_seen, polls, earliest, days, read_until) "
+                "VALUES (?, ?, ?, ?, 1, ?, ?, ?)",
+                (*key, observed_at, observed_at, earliest, payload, read_until)
+            )
+        else:
+            cursor = connection.execute(
+                "INSERT INTO times (country, facility_id, day, first_seen, last_seen, polls, times) "
+                "VALUES (?, ?, ?, ?, ?, 1, ?)",
+                (*key, observed_at, observed_at, payload)
+            )
+        self.latest[(table, key)] = (cursor.lastrowid, payload, observed_at, values, earliest, read_until)
+
+    @staticmethod
+    def encode(table: str, values: list[str]) -> tuple[Optional[int], str]:
+        if table == "times":
+            return None, ",".join(x.replace(":", "") for x in sorted(values))
+        # dates as day offsets from the earliest one
+        days = sorted(date_ordinal(x) for x in values)
+        return (days[0] if days else None), ",".join(str(x - days[0]) for x in days)
+
+    @staticmethod
+    def load_latest(connection: sqlite3.Connection, table: str, key: tuple) -> Optional[tuple]:
+        if table == "dates":
+            row = connection.execute(
+                "SELECT id, days, last_seen, earliest, read_until FROM dates WHERE country = ? AND facility_id = ? "
+                "ORDER BY first_seen DESC LIMIT 1",
+                key
+            ).fetchone()
+            return (*row[:3], None, *row[3:]) if row else None
+        row = connection.execute(
+            "SELECT id, times, last_seen FROM times WHERE country = ? AND facility_id = ? AND day = ? "
+            "ORDER BY first_seen DESC LIMIT 1",
+            key
+        ).fetchone()
+        return (*row, None, None, None) if row else None
+
+    def releases(self, country: str, facility_id: str, since: float) -> tuple[list[float], Optional[float]]:
+        connection = self.connect()
+        try:
+            rows = connection.execute(
+                "SELECT first_seen, earliest, days, read_until FROM dates "
+                "WHERE country = ? AND facility_id = ? AND last_seen >= ? ORDER BY first_seen",
+                (country, facility_id, int(since))
+            ).fetchall()
+        finally:
+            connection.close()
+
+        releases = []
+        previous: Optional[set[int]] = None
+        previous_until: Optional[int] = None
+        for first_seen, earliest, days, read_until in rows:
+            current = {earliest + int(x) for x in days.split(",")} if days else set()
+            # past where either list was cut, a date only looks new
+            bound = min((x for x in (read_until, previous_until) if x is not None), default=None)
+            if previous is not None and any(bound is None or x <= bound for x in current - previous):
+                releases.append(float(first_seen))
+            previous, previous_until = current, read_until
+
+        return releases, (float(rows[0][0]) if rows else None)
+
+    def query_earlier(
+            self,
+            country: str,
+            facility_id: str,
+            before: date,
+            since: float
+    ) -> list[tuple[datetime, datetime, int, date, int]]:
+        connection = self.connect()
+        try:
+            rows = connection.execute(
+                "SELECT first_seen, last_seen, polls, earliest, days FROM dates "
+                "WHERE country = ? AND facility_id = ? AND earliest < ? AND last_seen >= ? "
+                "ORDER BY first_seen",
+                (country, facility_id, before.toordinal(), int(since))
+            ).fetchall()
+        finally:
+            connection.close()
+
+        return [
+            (
+                datetime.fromtimestamp(first_seen),
+                datetime.fromtimestamp(last_seen),
+                polls,
+                date.fromordinal(earliest),
+                len(days.split(","))
+            )
+            for first_seen, last_seen, polls, earliest, days in rows
+        ]
+
+
 class Config:
-    def __init__(self, config_file: str):
+    def __init__(self, config_file: str, interactive: bool = True):
         self.config_file = config_file
+        self.interactive = interactive
 
         config_data = dict()
         if not os.path.exists(self.config_file):
@@ -188,17 +1985,18 @@ class Config:
 
         email = config_data.get("EMAIL")
         if not email:
-            email = input("Enter email: ")
+            email = self.__input("EMAIL", "Enter email: ")
         self.email: str = email
 
         password = config_data.get("PASSWORD")
         if not password:
-            password = input("Enter password: ")
+            password = self.__input("PASSWORD", "Enter password: ")
         self.password: str = password
 
         country = config_data.get("COUNTRY")
         while not country:
-            country = input(
+            country = self.__input(
+                "COUNTRY",
                 "Select country (enter two letters): \n" + "\n".join(
                     [key + " " + value for (key, value) in COUNTRIES.items()]
                 ) + "\n"
@@ -211,11 +2009,12 @@ class Config:
         try:
             if min_date:
                 min_date = datetime.strptime(min_date, DATE_FORMAT)
-        except ValueError | TypeError:
+        except (ValueError, TypeError):
             min_date = None
         while not min_date:
             try:
-                min_date = input(
+                min_date = self.__input(
+                    "MIN_DATE",
                     "Enter minimal appointment date in format day.month.year "
                     "(example 10.01.2002) or leave blank: "
                 )
@@ -223,7 +2022,7 @@ class Config:
                     min_date = datetime.strptime(min_date, DATE_FORMAT)
                 else:
                     min_date = datetime.now()
-            except ValueError | TypeError:
+            except (ValueError, TypeError):
                 pass
         self.min_date: date = min_date.date()
 
@@ -232,12 +2031,13 @@ class Config:
         try:
             if max_date:
                 max_date = datetime.strptime(max_date, DATE_FORMAT)
-        except ValueError | TypeError:
+        except (ValueError, TypeError):
             max_date = None
         if init_max_date:
             while True:
                 try:
-                    max_date = input(
+                    max_date = self.__input(
+                        "MAX_DATE",
                         "Enter maximal appointment date in format day.month.year "
                         "(example 10.01.2002) or leave blank (but make note, "
                         "it may lead to the exhaustion of the transfer limit): "
@@ -247,13 +2047,14 @@ class Config:
                     else:
                         max_date = None
                     break
-                except ValueError | TypeError:
+                except (ValueError, TypeError):
                     pass
         self.max_date: Optional[date] = max_date.date() if max_date else None
 
         need_asc = config_data.get("NEED_ASC")
         if need_asc is None:
-            need_asc = input(
+            need_asc = self.__input(
+                "NEED_ASC",
                 "Do you need ASC registration (Y/N. Enter N, if you don't know, what is it)?: "
             ).upper() == "Y"
         else:
@@ -269,44 +2070,117 @@ class Config:
             self.facility_id = None
             self.asc_facility_id = None
 
+        self.facility_ids: Optional[str] = config_data.get("FACILITY_IDS")
+        self.asc_facility_ids: Optional[str] = config_data.get("ASC_FACILITY_IDS")
+        self.scan_budget: int = max(1, Config.__get_int(config_data, "SCAN_BUDGET", DEFAULT_SCAN_BUDGET))
+
+        self.prefetch_dates: int = Config.__get_int(config_data, "PREFETCH_DATES", 0)
+
+        poll_schedule = config_data.get("POLL_SCHEDULE") or DEFAULT_POLL_SCHEDULE
+        try:
+            if poll_schedule != ADAPTIVE_SCHEDULE:
+                parse_schedule(poll_schedule)
+        except ValueError:
+            poll_schedule = DEFAULT_POLL_SCHEDULE
+        self.poll_schedule: str = poll_schedule
+        self.poll_budget: int = max(1, Config.__get_int(config_data, "POLL_BUDGET", DEFAULT_POLL_BUDGET))
+        self.poll_quiet_interval: int = max(
+            1,
+            Config.__get_int(config_data, "POLL_QUIET_INTERVAL", DEFAULT_POLL_QUIET_INTERVAL)
+        )
+
+        self.session_ttl: int = Config.__get_int(config_data, "SESSION_TTL", DEFAULT_SESSION_TTL)
+        self.asc_ttl: int = Config.__get_int(config_data, "ASC_TTL", DEFAULT_ASC_TTL)
+        self.asc_concurrency: int = max(1, Config.__get_int(config_data, "ASC_CONCURRENCY", DEFAULT_ASC_CONCURRENCY))
+        self.asc_timeout: int = Config.__get_int(config_data, "ASC_TIMEOUT", DEFAULT_ASC_TIMEOUT)
+        asc_policy = (config_data.get("ASC_POLICY") or ASC_POLICY_EARLIEST).lower()
+        self.asc_policy: str = asc_policy if asc_policy in (ASC_POLICY_EARLIEST, ASC_POLICY_CLOSEST) \
+            else ASC_POLICY_EARLIEST
+        self.metrics_port: int = Config.__get_int(config_data, "METRICS_PORT", 0)
+        self.pool_size: int = max(1, Config.__get_int(config_data, "POOL_SIZE", DEFAULT_POOL_SIZE))
+        self.warm_up_seconds: int = Config.__get_int(config_data, "WARM_UP_SECONDS", DEFAULT_WARM_UP_SECONDS)
+        self.warm_connections: int = Config.__get_int(config_data, "WARM_CONNECTIONS", DEFAULT_WARM_CONNECTIONS)
+        self.book_parallel: int = max(1, Config.__get_int(config_data, "BOOK_PARALLEL", DEFAULT_BOOK_PARALLEL))
+        self.times_ttl: int = Config.__get_int(config_data, "TIMES_TTL", DEFAULT_TIMES_TTL)
+        self.history: bool = config_data.get("HISTORY") != "False"
+        self.rate_limit: int = Config.__get_int(config_data, "RATE_LIMIT", 0)
+        self.account_rate_limit: int = Config.__get_int(config_data, "ACCOUNT_RATE_LIMIT", 0)
+        self.rate_burst: int = max(1, Config.__get_int(config_data, "RATE_BURST", DEFAULT_RATE_BURST))
+        self.backoff_max: int = Config.__get_int(config_data, "BACKOFF_MAX", DEFAULT_BACKOFF_MAX)
+        self.rate_file: Optional[str] = config_data.get("RATE_FILE")
+        self.connect_timeout: int = Config.__get_int(config_data, "CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)
+        self.read_timeout: int = Config.__get_int(config_data, "READ_TIMEOUT", DEFAULT_READ_TIMEOUT)
+        self.timeouts: Optional[str] = config_data.get("TIMEOUTS", DEFAULT_TIMEOUTS)
+        self.hedge: Optional[str] = config_data.get("HEDGE", DEFAULT_HEDGE)
+        self.hedge_rate: int = Config.__get_int(config_data, "HEDGE_RATE", DEFAULT_HEDGE_RATE)
+        self.clock_sync: bool = config_data.get("CLOCK_SYNC") != "False"
+
+        log_level = (config_data.get("LOG_LEVEL") or DEFAULT_LOG_LEVEL).upper()
+        if not isinstance(logging.getLevelName(log_level), int):
+            log_level = DEFAULT_LOG_LEVEL
+        self.log_level: str = log_level
+        self.log_max_bytes: int = Config.__get_int(config_data, "LOG_MAX_BYTES", DEFAULT_LOG_MAX_BYTES)
+        self.log_backup_count: int = Config.__get_int(config_data, "LOG_BACKUP_COUNT", DEFAULT_LOG_BACKUP_COUNT)
+        self.log_rotate_when: Optional[str] = config_data.get("LOG_ROTATE_WHEN")
+
         self.__save()
 
     def set_facility_id(self, locations: dict[str, str]):
-        self.facility_id = self.__choose_location(locations, "consul")
+        self.facility_id = self.__choose_location(locations, "consul", "FACILITY_ID")
         self.__save()
 
     def set_asc_facility_id(self, locations: dict[str, str]):
-        self.asc_facility_id = self.__choose_location(locations, "asc")
+        self.asc_facility_id = self.__choose_location(locations, "asc", "ASC_FACILITY_ID")
+        self.__save()
+
+    def set_facility_ids(self, locations: dict[str, str]):
+        self.facility_ids = ",".join(locations)
+        self.__save()
+
+    def set_asc_facility_ids(self, asc_facility_ids: dict[str, str]):
+        self.asc_facility_ids = ",".join(f"{x}:{y}" for x, y in asc_facility_ids.items())
         self.__save()
 
     def set_schedule_id(self, schedule_ids: dict[str, Appointment]):
-        self.schedule_id = Config.__choose(
+        self.schedule_id = self.__choose(
             schedule_ids,
+            "SCHEDULE_ID",
             f"Choose schedule id (enter number): \n" +
             "\n".join([x[0] + "  " + x[1].description for x in schedule_ids.items()]) + "\n"
         )
         self.__save()
 
-    @staticmethod
-    def __choose_location(locations: dict[str, str], location_name: str) -> str:
-        return Config.__choose(
+    def __choose_location(self, locations: dict[str, str], location_name: str, key: str) -> str:
+        return self.__choose(
             locations,
+            key,
             f"Choose {location_name} location (enter number): \n" +
             "\n".join([x[0] + "  " + x[1] for x in locations.items()]) + "\n"
         )
 
     @staticmethod
-    def __choose(values: dict, message: str) -> str:
+    def __get_int(config_data: dict[str, Optional[str]], key: str, default: int) -> int:
+        try:
+            return int(config_data.get(key) or default)
+        except ValueError:
+            return default
+
+    def __choose(self, values: dict, key: str, message: str) -> str:
         if len(values) == 1:
             return next(iter(values))
 
         value = None
         while not value:
-            value = input(message)
+            value = self.__input(key, message)
             if value not in values:
                 value = None
         return value
 
+    def __input(self, key: str, message: str) -> str:
+        if not self.interactive:
+            raise ConfigIncomplete(self.config_file, key)
+        return input(message)
+
     def __save(self):
         with open(self.config_file, "w") as f:
             f.write(
@@ -319,25 +2193,107 @@ class Config:
                 f"\nNEED_ASC={self.need_asc}"
                 f"\nASC_FACILITY_ID={self.asc_facility_id}"
                 f"\nSCHEDULE_ID={self.schedule_id}"
+                f"\nFACILITY_IDS={self.facility_ids}"
+                f"\nASC_FACILITY_IDS={self.asc_facility_ids}"
+                f"\nSCAN_BUDGET={self.scan_budget}"
+                f"\nPREFETCH_DATES={self.prefetch_dates}"
+                f"\nPOLL_SCHEDULE={self.poll_schedule}"
+                f"\nPOLL_BUDGET={self.poll_budget}"
+                f"\nPOLL_QUIET_INTERVAL={self.poll_quiet_interval}"
+                f"\nSESSION_TTL={self.session_ttl}"
+                f"\nASC_TTL={self.asc_ttl}"
+                f"\nASC_CONCURRENCY={self.asc_concurrency}"
+                f"\nASC_TIMEOUT={self.asc_timeout}"
+                f"\nASC_POLICY={self.asc_policy}"
+                f"\nMETRICS_PORT={self.metrics_port}"
+                f"\nPOOL_SIZE={self.pool_size}"
+                f"\nWARM_UP_SECONDS={self.warm_up_seconds}"
+                f"\nWARM_CONNECTIONS={self.warm_connections}"
+                f"\nBOOK_PARALLEL={self.book_parallel}"
+                f"\nTIMES_TTL={self.times_ttl}"
+                f"\nHISTORY={self.history}"
+                f"\nRATE_LIMIT={self.rate_limit}"
+                f"\nACCOUNT_RATE_LIMIT={self.account_rate_limit}"
+                f"\nRATE_BURST={self.rate_burst}"
+                f"\nBACKOFF_MAX={self.backoff_max}"
+                f"\nRATE_FILE={self.rate_file}"
+                f"\nCONNECT_TIMEOUT={self.connect_timeout}"
+                f"\nREAD_TIMEOUT={self.read_timeout}"
+                f"\nTIMEOUTS={self.timeouts}"
+                f"\nHEDGE={self.hedge}"
+                f"\nHEDGE_RATE={self.hedge_rate}"
+                f"\nCLOCK_SYNC={self.clock_sync}"
+                f"\nLOG_LEVEL={self.log_level}"
+                f"\nLOG_MAX_BYTES={self.log_max_bytes}"
+                f"\nLOG_BACKUP_COUNT={self.log_backup_count}"
+                f"\nLOG_ROTATE_WHEN={self.log_rotate_when}"
             )
 
 
 class Bot:
-    def __init__(self, config: Config, logger: Logger, asc_file: str):
+    def __init__(
+            self,
+            config: Config,
+            logger: Logger | AccountLogger,
+            asc_file: str,
+            session_file: str,
+            adapter: Optional[HTTPAdapter] = None,
+            base_url: str = BASE_URL,
+            history: Optional[HistoryStore] = None,
+            rate_store: Optional[RateStore] = None,
+            clock: Optional[Clock] = None
+    ):
         self.logger = logger
         self.config = config
         self.asc_file = asc_file
-        self.url = f"https://{HOST}/en-{config.country}/niv"
+        self.session_cache = SessionCache(session_file, config.session_ttl)
+        self.adapter = adapter
+        self.base_url = base_url
+        self.host = urlparse(base_url).netloc
+        self.url = f"{base_url}/en-{config.country}/niv"
+        self.history = history if config.history else None
+        self.verify: bool | str = True
 
         self.appointment_datetime: Optional[datetime] = None
+        # weights rank dates of different facilities, so the current appointment is ranked by its facility too
+        self.appointment_facility_id: Optional[str] = None
         self.csrf: Optional[str] = None
         self.cookie: Optional[str] = None
-        self.session = requests.session()
-        self.asc_dates = dict()
+        self.session = self.new_session()
+        self.asc_dates = AscSlotStore(asc_file, config.asc_ttl)
+        self.asc_stores: dict[str, AscSlotStore] = dict()
+        self.availability = AvailabilityTracker(config.times_ttl)
+        self.trackers: dict[str, AvailabilityTracker] = dict()
+        self.facilities: dict[str, float] = dict()
+        self.scan_credits: dict[str, float] = dict()
+        self.asc_refresh: Optional[threading.Thread] = None
+        # polls are lined up with the AIS server clock, slots are released on it
+        self.clock = clock or (ServerClock() if config.clock_sync else Clock())
+        self.scheduler: Optional[Scheduler] = None
+        # buckets can be shared with other processes, so they stay on the local clock
+        self.governor = RateGovernor(
+            rate_store or create_rate_store(config.rate_file),
+            config.rate_limit / 60,
+            config.account_rate_limit / 60,
+            config.rate_burst,
+            config.backoff_max,
+            config.hedge_rate / 60
+        )
+        self.timeouts = parse_timeouts(config.timeouts, config.connect_timeout, config.read_timeout)
+        self.hedged = set(parse_pairs(config.hedge))
+        self.latencies: dict[str, LatencyTracker] = dict()
+        self.hedge_executor: Optional[ThreadPoolExecutor] = None
+        # (facility id, date) -> times
+        self.prefetched_times: dict[tuple[Optional[str], str], list[str]] = dict()
+        # (facility id, date, time) -> ASC date and times
+        self.prefetched_asc_slots: dict[tuple[Optional[str], str, str], tuple[Optional[str], list[str]]] = dict()
+        self.logins = 0
+        if isinstance(adapter, RecordingAdapter):
+            adapter.cassette.protect(config.email, config.password)
 
     @staticmethod
     def get_csrf(response: Response) -> str:
-        return BeautifulSoup(response.text, HTML_PARSER).find("meta", {"name": "csrf-token"})["content"]
+        return extract_csrf(response.text)
 
     def headers(self) -> dict[str, str]:
         headers = dict()
@@ -350,18 +2306,141 @@ class Bot:
 
         return headers
 
-    def init(self):
-        # noinspection PyBroadException
+    @property
+    def account(self) -> str:
+        return self.config.schedule_id or NONE
+
+    def timeout(self, endpoint: str) -> tuple[float, float]:
+        return self.timeouts.get(endpoint) or (self.config.connect_timeout, self.config.read_timeout)
+
+    def send(self, endpoint: str, method: str, url: str, **kwargs) -> Response:
+        started = time.perf_counter()
+        sent = time.time()
+        response = self.session.request(method, url, verify=self.verify, **kwargs)
+        self.latencies.setdefault(endpoint, LatencyTracker()).observe(time.perf_counter() - started)
+        if isinstance(self.clock, ServerClock) and self.clock.observe(sent, time.time(), response.headers.get("Date")):
+            self.logger(f"Server clock offset {self.clock.offset:+.3f} s ± {self.clock.error:.3f} s")
+        return response
+
+    @staticmethod
+    def discard(future: Future):
+        # a streamed body nobody reads would keep its connection out of the pool
+        if future.exception() is None:
+            future.result().raw.drain_conn()
+
+    def send_hedged(self, endpoint: str, method: str, url: str, delay: float, **kwargs) -> Response:
+        if not self.hedge_executor:
+            self.hedge_executor = ThreadPoolExecutor(max_workers=2 * self.config.pool_size)
+
+        primary = self.hedge_executor.submit(self.send, endpoint, method, url, **kwargs)
+        # a hedge is one more request to the host, it is only worth sending if the budget has a token for it
+        if wait([primary], timeout=delay)[0] or not self.governor.try_acquire(self.host, self.account, hedge=True):
+            return primary.result()
+
+        self.logger.debug(f"Hedge {endpoint} after {delay * 1000:.0f} ms")
+        hedge = self.hedge_executor.submit(self.send, endpoint, method, url, **kwargs)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda x: x.exception() is not None):
+                if future.exception() is None or not pending:
+                    METRICS.inc(
+                        "ais_hedged_requests_total",
+                        endpoint=endpoint,
+                        winner="primary" if future is primary else "hedge"
+                    )
+                    for loser in {primary, hedge} - {future}:
+                        loser.add_done_callback(Bot.discard)
+                    return future.result()
+
+    def request(self, endpoint: str, method: str, url: str, **kwargs) -> Response:
+        waited = self.governor.acquire(self.host, self.account)
+        if waited:
+            self.logger.debug(f"Throttled {endpoint} for {waited:.2f} s")
+
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout(endpoint)
+
+        delay = None
+        if method == "GET" and self.config.hedge_rate > 0 and endpoint in self.hedged and endpoint in self.latencies:
+            delay = self.latencies[endpoint].quantile(HEDGE_QUANTILE)
+
+        started = time.perf_counter()
+        status = "error"
         try:
-            self.session.close()
-        except Exception:
-            pass
-        self.session = requests.Session()
+            if delay is None:
+                response = self.send(endpoint, method, url, **kwargs)
+            else:
+                response = self.send_hedged(endpoint, method, url, max(delay, HEDGE_MIN_DELAY), **kwargs)
+            status = str(response.status_code)
+            delay = self.governor.feedback(self.host, response.status_code, response.headers.get("Retry-After"))
+            if delay:
+                self.logger(f"Get {status} on {endpoint}, back off for {delay:.1f} s")
+            return response
+        finally:
+            METRICS.observe("ais_request_duration_seconds", time.perf_counter() - started,
+                            endpoint=endpoint, account=self.account)
+            METRICS.inc("ais_requests_total", endpoint=endpoint, status=status, account=self.account)
+
+    def new_session(self) -> requests.Session:
+        session = requests.Session()
+        session.mount(
+            self.base_url,
+            self.adapter or HTTPAdapter(pool_connections=1, pool_maxsize=self.config.pool_size)
+        )
+        return session
+
+    def warm_up(self, connections: Optional[int] = None):
+        connections = connections or min(self.config.warm_connections, self.config.pool_size)
+        if connections <= 0:
+            return
+
+        self.logger.debug(f"Warm up {connections} connections")
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [
+                executor.submit(
+                    self.request,
+                    "warm_up",
+                    "HEAD",
+                    self.base_url,
+                    headers=DEFAULT_HEADERS,
+                    allow_redirects=False,
+                    timeout=WARM_UP_TIMEOUT
+                )
+                for _ in range(connections)
+            ]
+            for future in futures:
+                # noinspection PyBroadException
+                try:
+                    future.result()
+                except Exception as err:
+                    self.logger.debug(f"Warm up failed: {err}")
+
+    def init(self):
+        # Shared adapter belongs to the orchestrator, closing the session would drop its pool
+        if not self.adapter:
+            # noinspection PyBroadException
+            try:
+                self.session.close()
+            except Exception:
+                pass
+        self.session = self.new_session()
+
+        if self.restore_session():
+            return
 
+        METRICS.inc("ais_logins_total", account=self.account)
+        self.logins += 1
         self.login()
         self.init_current_data()
         self.init_csrf_and_cookie()
+        self.init_locations()
+        self.init_asc_dates()
+        self.save_session()
 
+        self.log_appointment_datetime()
+
+    def init_locations(self):
         if not self.config.facility_id:
             self.logger("Not found facility_id")
             self.config.set_facility_id(self.get_available_facility_id())
@@ -370,16 +2449,134 @@ class Bot:
             self.logger("Not found asc_facility_id")
             self.config.set_asc_facility_id(self.get_available_asc_facility_id())
 
-        self.init_asc_dates()
+        if (self.config.facility_ids or "").lower() == FACILITIES_ALL:
+            self.config.set_facility_ids(self.get_available_facility_id())
+
+        self.init_facilities()
+
+        if self.config.need_asc and not self.asc_facilities_resolved():
+            self.logger("Not found asc_facility_ids")
+            asc_facility_ids = parse_pairs(self.config.asc_facility_ids)
+            # only the polled facilities without an ASC are matched, an ambiguous name elsewhere does not matter
+            facilities = {
+                k: v for k, v in self.get_available_facility_id().items()
+                if k in self.facilities and not asc_facility_ids.get(k)
+            }
+            self.config.set_asc_facility_ids({
+                **match_asc_facilities(facilities, self.get_available_asc_facility_id()),
+                **asc_facility_ids
+            })
 
+    def log_appointment_datetime(self):
         self.logger(
             "Current appointment date and time: "
             f"{self.appointment_datetime.strftime(DATE_TIME_FORMAT) if self.appointment_datetime else 'No date'}"
         )
 
+    def init_facilities(self):
+        facilities = dict()
+        for facility_id, weight in parse_pairs(self.config.facility_ids).items():
+            if facility_id.lower() == FACILITIES_ALL:
+                continue
+            try:
+                facilities[facility_id] = max(float(weight or 1), 0.01)
+            except ValueError:
+                facilities[facility_id] = 1.0
+        self.facilities = facilities or {self.config.facility_id: 1.0}
+
+    def asc_facilities_resolved(self) -> bool:
+        asc_facility_ids = parse_pairs(self.config.asc_facility_ids)
+        return all(
+            x == self.config.facility_id or asc_facility_ids.get(x)
+            for x in self.facilities
+        )
+
+    def asc_facility_of(self, facility_id: Optional[str]) -> Optional[str]:
+        if not facility_id or facility_id == self.config.facility_id:
+            return self.config.asc_facility_id
+        return parse_pairs(self.config.asc_facility_ids).get(facility_id) or self.config.asc_facility_id
+
+    def asc_store(self, asc_facility_id: Optional[str]) -> AscSlotStore:
+        if not asc_facility_id or asc_facility_id == self.config.asc_facility_id:
+            return self.asc_dates
+
+        store = self.asc_stores.get(asc_facility_id)
+        if store is None:
+            store = self.asc_stores[asc_facility_id] = AscSlotStore(
+                f"{self.asc_file}.{asc_facility_id}",
+                self.config.asc_ttl
+            )
+            store.load()
+        return store
+
+    def tracker(self, facility_id: Optional[str]) -> AvailabilityTracker:
+        if not facility_id or facility_id == self.config.facility_id:
+            return self.availability
+        return self.trackers.setdefault(facility_id, AvailabilityTracker(self.config.times_ttl))
+
+    def restore_session(self) -> bool:
+        data = self.session_cache.load()
+        if (not data or data.get("schedule_id") != self.config.schedule_id or
+                not self.config.facility_id or
+                (self.config.need_asc and not self.config.asc_facility_id) or
+                (self.config.facility_ids or "").lower() == FACILITIES_ALL):
+            return False
+
+        self.init_facilities()
+        if self.config.need_asc and not self.asc_facilities_resolved():
+            return False
+
+        self.logger("Restore session")
+        self.cookie = data.get("cookie")
+        self.csrf = data.get("csrf")
+        appointment_datetime = data.get("appointment_datetime")
+        self.appointment_datetime = (
+            datetime.strptime(appointment_datetime, DATE_TIME_FORMAT) if appointment_datetime else None
+        )
+        self.appointment_facility_id = data.get("appointment_facility_id") or self.config.facility_id
+
+        try:
+            self.get_available_dates()
+        except HTTPError as err:
+            if err.response.status_code != 401:
+                raise err
+
+            self.logger("Cached session expired")
+            self.session_cache.clear()
+            self.cookie = None
+            self.csrf = None
+            self.appointment_datetime = None
+            return False
+
+        if self.appointment_datetime and self.appointment_datetime.date() <= self.config.min_date:
+            raise AppointmentDateLowerMinDate()
+
+        self.load_asc_dates()
+        self.log_appointment_datetime()
+        return True
+
+    def save_session(self):
+        self.session_cache.save({
+            "schedule_id": self.config.schedule_id,
+            "cookie": self.cookie,
+            "csrf": self.csrf,
+            "appointment_datetime": (
+                self.appointment_datetime.strftime(DATE_TIME_FORMAT) if self.appointment_datetime else None
+            ),
+            "appointment_facility_id": self.appointment_facility_id
+        })
+
+    def refresh_credentials(self):
+        self.logger("Refresh credentials")
+        self.login()
+        self.init_csrf_and_cookie()
+        self.save_session()
+
     def login(self):
-        self.logger("Get sign in")
-        response = self.session.get(
+        self.logger.debug("Get sign in")
+        response = self.request(
+            "sign_in_page",
+            "GET",
             f"{self.url}/users/sign_in",
             headers={
                 COOKIE_HEADER: "",
@@ -390,8 +2587,10 @@ class Bot:
         response.raise_for_status()
         cookies = response.headers.get(SET_COOKIE)
 
-        self.logger("Post sing in")
-        response = self.session.post(
+        self.logger.debug("Post sing in")
+        response = self.request(
+            "sign_in",
+            "POST",
             f"{self.url}/users/sign_in",
             headers={
                 **DEFAULT_HEADERS,
@@ -413,8 +2612,10 @@ class Bot:
         self.cookie = response.headers.get(SET_COOKIE)
 
     def init_current_data(self):
-        self.logger("Get current appointment")
-        response = self.session.get(
+        self.logger.debug("Get current appointment")
+        response = self.request(
+            "dashboard",
+            "GET",
             self.url,
             headers={
                 **self.headers(),
@@ -423,109 +2624,130 @@ class Bot:
         )
         response.raise_for_status()
 
-        applications = BeautifulSoup(response.text, HTML_PARSER).findAll("div", {"class": "application"})
+        applications = extract_applications(response.text)
 
         if not applications:
             raise NoScheduleIdException()
 
         schedule_ids = dict()
 
-        for application in applications:
-            schedule_id = re.search(r"\d+", str(application.find("a")))
+        for link, cells, consular_appt in applications:
+            schedule_id = re.search(r"\d+", link)
 
             if not schedule_id:
                 continue
 
             schedule_id = schedule_id.group(0)
-            description = ' '.join([x.get_text() for x in application.findAll("td")][0:4])
-            appointment_datetime = application.find("p", {"class": "consular-appt"})
-            if appointment_datetime:
-                appointment_datetime = re.search(r"\d{1,2} \w+?, \d{4}, \d{1,2}:\d{1,2}",
-                                                 appointment_datetime.get_text())
-
-                if appointment_datetime:
-                    appointment_datetime = datetime.strptime(appointment_datetime.group(0), "%d %B, %Y, %H:%M")
-                else:
-                    appointment_datetime = None
+            description = ' '.join(cells[0:4])
+            appointment_datetime = None
+            if consular_appt is not None:
+                appointment_datetime_match = re.search(r"\d{1,2} \w+?, \d{4}, \d{1,2}:\d{1,2}", consular_appt)
+
+                if appointment_datetime_match:
+                    appointment_datetime = datetime.strptime(appointment_datetime_match.group(0),
+                                                             "%d %B, %Y, %H:%M")
 
             schedule_ids[schedule_id] = Appointment(schedule_id, description, appointment_datetime)
 
         if not self.config.schedule_id:
             self.config.set_schedule_id(schedule_ids)
 
-        self.appointment_datetime = schedule_ids[self.config.schedule_id].appointment_datetime
+        appointment_datetime = schedule_ids[self.config.schedule_id].appointment_datetime
+        if appointment_datetime != self.appointment_datetime or not self.appointment_facility_id:
+            # not booked by this bot, the dashboard only names the city, so it is taken as FACILITY_ID
+            self.appointment_facility_id = self.config.facility_id
+        self.appointment_datetime = appointment_datetime
 
         if self.appointment_datetime and self.appointment_datetime.date() <= self.config.min_date:
             raise AppointmentDateLowerMinDate()
 
+    def load_asc_dates(self):
+        self.asc_dates.load()
+
     def init_asc_dates(self):
         if not self.config.need_asc or not self.config.asc_facility_id:
             return
 
-        if not os.path.exists(self.asc_file):
-            open(self.asc_file, 'w').close()
-        with open(self.asc_file) as f:
-            # noinspection PyBroadException
-            try:
-                self.asc_dates = json.load(f)
-            except:
-                pass
+        if not len(self.asc_dates):
+            self.load_asc_dates()
 
         dates_temp = None
 
         # noinspection PyBroadException
         try:
-            dates_temp = self.get_asc_available_dates()
+            dates_temp = self.get_asc_available_dates(timeout=self.config.asc_timeout)
         except:
             pass
 
         if dates_temp:
-            dates = []
-            for x in dates_temp:
-                date_temp = parse_date(x)
-                if self.config.min_date <= date_temp <= self.config.max_date:
-                    dates.append(x)
+            min_ordinal = self.config.min_date.toordinal()
+            max_ordinal = self.config.max_date.toordinal() if self.config.max_date else None
+            dates = [
+                x for x in dates_temp
+                if min_ordinal <= date_ordinal(x) and (max_ordinal is None or date_ordinal(x) <= max_ordinal)
+            ]
 
             if len(dates) > 0:
-                self.asc_dates = dict()
-                for x in dates:
-                    # noinspection PyBroadException
-                    try:
-                        self.asc_dates[x] = self.get_asc_available_times(x)
-                    except:
-                        pass
+                started = time.perf_counter()
+                self.asc_dates.retain(dates)
+
+                with ThreadPoolExecutor(max_workers=self.config.asc_concurrency) as executor:
+                    futures = {
+                        executor.submit(self.get_asc_available_times, x, timeout=self.config.asc_timeout): x
+                        for x in dates
+                    }
+                    failed = 0
+                    for future in as_completed(futures):
+                        # noinspection PyBroadException
+                        try:
+                            self.asc_dates.put(futures[future], future.result())
+                        except:
+                            failed += 1
+
+                self.logger(
+                    f"Refreshed ASC times for {len(dates) - failed} of {len(dates)} dates "
+                    f"in {time.perf_counter() - started:.2f} s"
+                )
+
+        self.asc_dates.evict()
+
+    def refresh_asc_dates(self):
+        if self.asc_refresh and self.asc_refresh.is_alive():
+            self.logger("ASC refresh is already running")
+            return
+
+        self.asc_refresh = threading.Thread(target=self.run_asc_refresh, daemon=True)
+        self.asc_refresh.start()
 
-        with open(self.asc_file, 'w') as f:
-            json.dump(self.asc_dates, f)
+    def run_asc_refresh(self):
+        try:
+            self.init_asc_dates()
+        except Exception as err:
+            self.logger(err)
 
     def init_csrf_and_cookie(self):
-        self.logger("Init csrf")
+        self.logger.debug("Init csrf")
         response = self.load_change_appointment_page()
         self.cookie = response.headers.get(SET_COOKIE)
         self.csrf = Bot.get_csrf(response)
 
     def get_available_locations(self, element_id: str) -> dict[str, str]:
-        self.logger("Get location list")
-        locations = (BeautifulSoup(self.load_change_appointment_page().text, HTML_PARSER)
-                     .find("select", {"id": element_id})
-                     .findAll("option"))
-        facility_id_to_location = dict[str, str]()
-        for location in locations:
-            if location["value"]:
-                facility_id_to_location[location["value"]] = location.text
-        return facility_id_to_location
+        self.logger.debug("Get location list")
+        return extract_options(self.load_change_appointment_page().text, element_id)
 
     def get_available_facility_id(self) -> dict[str, str]:
-        self.logger("Get facility id list")
+        self.logger.debug("Get facility id list")
         return self.get_available_locations("appointments_consulate_appointment_facility_id")
 
     def get_available_asc_facility_id(self) -> dict[str, str]:
-        self.logger("Get asc facility id list")
+        self.logger.debug("Get asc facility id list")
         return self.get_available_locations("appointments_asc_appointment_facility_id")
 
     def load_change_appointment_page(self) -> Response:
-        self.logger("Get new appointment")
-        response = self.session.get(
+        self.logger.debug("Get new appointment")
+        response = self.request(
+            "appointment",
+            "GET",
             f"{self.url}/schedule/{self.config.schedule_id}/appointment",
             headers={
                 **self.headers(),
@@ -537,29 +2759,59 @@ class Bot:
         response.raise_for_status()
         return response
 
-    def get_available_dates(self) -> list[str]:
-        self.logger("Get available date")
-        response = self.session.get(
+    def appointment_bound(self, facility_id: Optional[str]) -> Optional[int]:
+        # first day at the facility which does not rank better than the current appointment
+        if not self.appointment_datetime:
+            return None
+        today = date.fromtimestamp(self.clock.now()).toordinal()
+        days = (self.appointment_datetime.toordinal() - today) / self.facilities.get(self.appointment_facility_id, 1.0)
+        return today + math.ceil(days * self.facilities.get(facility_id, 1.0))
+
+    def date_window(self, facility_id: Optional[str] = None) -> tuple[str, Optional[str]]:
+        before = self.appointment_bound(facility_id)
+        if self.config.max_date:
+            after_max_date = self.config.max_date.toordinal() + 1
+            before = min(before, after_max_date) if before is not None else after_max_date
+        return self.config.min_date.isoformat(), date.fromordinal(before).isoformat() if before is not None else None
+
+    def get_available_dates(self, facility_id: Optional[str] = None) -> list[str]:
+        facility_id = facility_id or self.config.facility_id
+        self.logger.debug("Get available date")
+        response = self.request(
+            "days",
+            "GET",
             f"{self.url}/schedule/{self.config.schedule_id}/appointment/days/"
-            f"{self.config.facility_id}.json?appointments[expedite]=false",
+            f"{facility_id}.json?appointments[expedite]=false",
             headers={
                 **self.headers(),
                 **JSON_HEADERS,
                 REFERER: f"{self.url}/schedule/{self.config.schedule_id}/appointment"
-            }
+            },
+            stream=True
         )
-        response.raise_for_status()
-
-        data = response.json()
-        self.logger(f"Response: {data}")
-        dates = [x["date"] for x in data]
-        dates.sort()
+        try:
+            response.raise_for_status()
+            # only dates which could be booked are kept, the history gets every date read
+            listed = [] if self.history else None
+            after, before = self.date_window(facility_id)
+            dates = read_dates(response.iter_content(DAYS_CHUNK_SIZE), after, before, listed)
+        finally:
+            # the rest of an early stopped body is read without parsing, so the connection goes back to the pool
+            response.raw.drain_conn()
+
+        self.logger.debug(f"Response: {summarize(dates)}")
+        if self.history:
+            read_until = listed[-1] if before and listed and listed[-1] >= before else None
+            self.history.record_dates(self.config.country, facility_id, time.time(), listed, read_until)
         return dates
 
-    def get_available_times(self, available_date: str) -> list[str]:
-        self.logger("Get available time")
-        response = self.session.get(
-            f"{self.url}/schedule/{self.config.schedule_id}/appointment/times/{self.config.facility_id}.json?"
+    def get_available_times(self, available_date: str, facility_id: Optional[str] = None) -> list[str]:
+        facility_id = facility_id or self.config.facility_id
+        self.logger.debug("Get available time")
+        response = self.request(
+            "times",
+            "GET",
+            f"{self.url}/schedule/{self.config.schedule_id}/appointment/times/{facility_id}.json?"
             f"date={available_date}&appointments[expedite]=false",
             headers={
                 **self.headers(),
@@ -569,20 +2821,26 @@ class Bot:
         )
         response.raise_for_status()
         data = response.json()
-        self.logger(f"Response: {data}")
         times = data["available_times"] or data["business_times"]
         times.sort()
+        self.logger.debug(f"Response: {summarize(times)}")
+        if self.history:
+            self.history.record_times(self.config.country, facility_id, time.time(), available_date, times)
         return times
 
     def get_asc_available_dates(
             self,
             available_date: Optional[str] = None,
-            available_time: Optional[str] = None
+            available_time: Optional[str] = None,
+            timeout: Optional[float] = None,
+            facility_id: Optional[str] = None
     ) -> list[str]:
-        self.logger("Get available dates ASC")
-        response = self.session.get(
+        self.logger.debug("Get available dates ASC")
+        response = self.request(
+            "asc_days",
+            "GET",
             f"{self.url}/schedule/{self.config.schedule_id}/appointment/days/"
-            f"{self.config.asc_facility_id}.json?&consulate_id={self.config.facility_id}"
+            f"{self.asc_facility_of(facility_id)}.json?&consulate_id={facility_id or self.config.facility_id}"
             f"&consulate_date={available_date if available_date else ''}"
             f"&consulate_time={available_time if available_time else ''}"
             f"&appointments[expedite]=false",
@@ -590,24 +2848,30 @@ class Bot:
                 **self.headers(),
                 **JSON_HEADERS,
                 REFERER: f"{self.url}/schedule/{self.config.schedule_id}/appointment"
-            }
+            },
+            timeout=timeout
         )
         response.raise_for_status()
         data = response.json()
-        self.logger(f"Response: {data}")
         dates = [x["date"] for x in data]
         dates.sort()
+        self.logger.debug(f"Response: {summarize(dates)}")
         return dates
 
     def get_asc_available_times(
             self,
             asc_available_date: str,
             available_date: Optional[str] = None,
-            available_time: Optional[str] = None
+            available_time: Optional[str] = None,
+            timeout: Optional[float] = None,
+            facility_id: Optional[str] = None
     ) -> list[str]:
-        self.logger("Get available times ASC")
-        response = self.session.get(
-            f"{self.url}/schedule/{self.config.schedule_id}/appointment/times/{self.config.asc_facility_id}.json?"
+        self.logger.debug("Get available times ASC")
+        response = self.request(
+            "asc_times",
+            "GET",
+            f"{self.url}/schedule/{self.config.schedule_id}/appointment/times/"
+            f"{self.asc_facility_of(facility_id)}.json?"
             f"date={asc_available_date}&consulate_id={self.config.schedule_id}"
             f"&consulate_date={available_date if available_date else ''}"
             f"&consulate_time={available_time if available_time else ''}"
@@ -616,251 +2880,1036 @@ class Bot:
                 **self.headers(),
                 **JSON_HEADERS,
                 REFERER: f"{self.url}/schedule/{self.config.schedule_id}/appointment"
-            }
+            },
+            timeout=timeout
         )
         response.raise_for_status()
         data = response.json()
-        self.logger(f"Response: {data}")
         times = data["available_times"] or data["business_times"]
         times.sort()
+        self.logger.debug(f"Response: {summarize(times)}")
         return times
 
-    def book(
+    def booking_body(
             self,
             available_date: str,
             available_time: str,
             asc_available_date: Optional[str],
-            asc_available_time: Optional[str]
-    ):
-        self.logger("Book")
-
+            asc_available_time: Optional[str],
+            facility_id: Optional[str] = None,
+            asc_facility_id: Optional[str] = None
+    ) -> str:
         body = {
             "authenticity_token": self.csrf,
             "confirmed_limit_message": "1",
             "use_consulate_appointment_capacity": "true",
-            "appointments[consulate_appointment][facility_id]": self.config.facility_id,
+            "appointments[consulate_appointment][facility_id]": facility_id or self.config.facility_id,
             "appointments[consulate_appointment][date]": available_date,
             "appointments[consulate_appointment][time]": available_time
         }
 
         if asc_available_date and available_time:
-            self.logger("Add ASC date and time to request")
             body = {
                 **body,
-                "appointments[asc_appointment][facility_id]": self.config.asc_facility_id,
+                "appointments[asc_appointment][facility_id]": asc_facility_id or self.config.asc_facility_id,
                 "appointments[asc_appointment][date]": asc_available_date,
                 "appointments[asc_appointment][time]": asc_available_time
             }
 
-        self.logger(f"Request {body}")
+        return urlencode(body)
+
+    def book(
+            self,
+            available_date: str,
+            available_time: str,
+            asc_available_date: Optional[str],
+            asc_available_time: Optional[str]
+    ) -> Response:
+        return self.post_booking(
+            self.booking_body(available_date, available_time, asc_available_date, asc_available_time)
+        )
+
+    def post_booking(self, body: str) -> Response:
+        self.logger.debug(f"Book {body}")
 
-        return self.session.post(
+        return self.request(
+            "book",
+            "POST",
             f"{self.url}/schedule/{self.config.schedule_id}/appointment",
             headers={
                 **self.headers(),
                 **DOCUMENT_HEADERS,
                 **SEC_FETCH_USER_HEADERS,
                 CONTENT_TYPE: "application/x-www-form-urlencoded",
-                "Origin": f"https://{HOST}",
+                "Origin": self.base_url,
                 REFERER: f"{self.url}/schedule/{self.config.schedule_id}/appointment"
             },
-            data=urlencode(body)
+            data=body,
+            allow_redirects=False
         )
 
-    def process(self):
-        self.init()
-        while True:
-            time.sleep(1.5)
+    def prepare_booking(self, candidate: BookingCandidate) -> str:
+        if candidate.body is None or candidate.csrf != self.csrf:
+            candidate.csrf = self.csrf
+            candidate.body = self.booking_body(
+                candidate.available_date,
+                candidate.available_time,
+                candidate.asc_available_date,
+                candidate.asc_available_time,
+                candidate.facility_id,
+                candidate.asc_facility_id
+            )
+        return candidate.body
+
+    def score(self, facility_id: Optional[str], key: int, today_key: int) -> float:
+        # minutes from today scaled by the facility weight, the same rule as rank
+        return (key - today_key) / self.facilities.get(facility_id, 1.0)
+
+    def improvement_limits(self) -> tuple[int, Optional[int], int, Optional[float]]:
+        today_key = date.fromtimestamp(self.clock.now()).toordinal() * MINUTES_PER_DAY
+        return (
+            self.config.min_date.toordinal(),
+            self.config.max_date.toordinal() if self.config.max_date else None,
+            today_key,
+            self.score(self.appointment_facility_id, datetime_key(self.appointment_datetime), today_key)
+            if self.appointment_datetime else None
+        )
+
+    def is_improvement(
+            self,
+            candidate: BookingCandidate,
+            limits: Optional[tuple[int, Optional[int], int, Optional[float]]] = None
+    ) -> bool:
+        min_ordinal, max_ordinal, today_key, appointment_score = limits or self.improvement_limits()
+        return (
+            candidate.ordinal > min_ordinal and
+            (max_ordinal is None or candidate.ordinal <= max_ordinal) and
+            (appointment_score is None or
+             self.score(candidate.facility_id, candidate.key, today_key) < appointment_score)
+        )
+
+    def send_booking(self, candidate: BookingCandidate) -> str:
+        # noinspection PyBroadException
+        try:
+            return classify_booking(self.post_booking(self.prepare_booking(candidate)))
+        except Exception as err:
+            self.logger(err)
+            return BOOKING_UNKNOWN
+
+    def send_batch(self, batch: list[BookingCandidate]) -> list[str]:
+        # every success frees the previous slot, so a worse time is only sent once the better ones are taken
+        results = []
+        for candidate in batch:
+            self.log_booking(candidate)
+            METRICS.inc("ais_booking_attempts_total", account=self.account)
+            results.append(self.send_booking(candidate))
+            if results[-1] != BOOKING_SLOT_TAKEN:
+                break
+        return results
+
+    def book_batch(self, batch: list[BookingCandidate]) -> list[str]:
+        results = self.send_batch(batch)
+
+        if results[-1] == BOOKING_CSRF_EXPIRED:
+            self.logger("Booking rejected by expired session")
+            self.refresh_credentials()
+            results = results[:-1] + self.send_batch(batch[len(results) - 1:])
+
+        return self.settle_bookings(batch, results)
+
+    def refresh_appointment(self, batch: list[BookingCandidate]):
+        self.init_current_data()
+        # the dashboard does not tell the facility, the candidate booked at that time does
+        appointment_key = datetime_key(self.appointment_datetime) if self.appointment_datetime else None
+        landed = next((x for x in batch if x.key == appointment_key), None)
+        if landed:
+            self.appointment_facility_id = landed.facility_id or self.config.facility_id
+
+    def settle_bookings(self, batch: list[BookingCandidate], results: list[str]) -> list[str]:
+        if results[-1] == BOOKING_BOOKED:
+            self.appointment_datetime = batch[len(results) - 1].appointment_datetime
+            self.appointment_facility_id = batch[len(results) - 1].facility_id or self.config.facility_id
+        elif results[-1] == BOOKING_UNKNOWN:
+            self.logger("Unknown booking response, check current appointment")
+            appointment_datetime = self.appointment_datetime
+            self.refresh_appointment(batch)
+            changed = appointment_datetime != self.appointment_datetime
+            appointment_key = datetime_key(self.appointment_datetime) if self.appointment_datetime else None
+
+            settled = []
+            for candidate, result in zip(batch, results):
+                if changed and candidate.key == appointment_key:
+                    settled.append(BOOKING_BOOKED)
+                elif result == BOOKING_UNKNOWN:
+                    settled.append(BOOKING_SLOT_TAKEN)
+                else:
+                    settled.append(result)
+            results = settled
+
+        for candidate, result in zip(batch, results):
+            self.logger.debug(f"Booking result for {candidate}: {result}")
+            METRICS.inc("ais_booking_results_total", account=self.account, result=result)
+
+        return results
+
+    def find_asc_slot(
+            self,
+            available_ordinal: int,
+            store: Optional[AscSlotStore] = None
+    ) -> Optional[tuple[str, list[str]]]:
+        return (store or self.asc_dates).find(
+            available_ordinal - ASC_WINDOW_DAYS,
+            available_ordinal,
+            self.config.asc_policy == ASC_POLICY_CLOSEST
+        )
+
+    def pair_asc_dates(
+            self,
+            candidate_dates: list[tuple[str, str]]
+    ) -> dict[tuple[str, str], tuple[str, list[str]]]:
+        groups = dict[Optional[str], list[tuple[str, str]]]()
+        for facility_id, available_date in candidate_dates:
+            groups.setdefault(self.asc_facility_of(facility_id), []).append((facility_id, available_date))
+
+        pairs = dict()
+        for asc_facility_id, group in groups.items():
+            slots = self.asc_store(asc_facility_id).usable()
+            # candidates are ranked across facilities, pairing needs them in date order
+            available_dates = sorted({x[1] for x in group})
+            paired = pair_asc_slots(
+                [date_ordinal(x) for x in available_dates],
+                [x[0] for x in slots],
+                self.config.asc_policy
+            )
+            by_date = {x: slots[i][1:] for x, i in zip(available_dates, paired) if i is not None}
+            pairs.update({x: by_date[x[1]] for x in group if x[1] in by_date})
+        return pairs
+
+    def select_asc_date(self, available_date: str, asc_available_dates: list[str]) -> str:
+        pair = pair_asc_slots(
+            [date_ordinal(available_date)],
+            [date_ordinal(x) for x in asc_available_dates],
+            self.config.asc_policy
+        )[0]
+        return asc_available_dates[0 if pair is None else pair]
+
+    def get_asc_slot(
+            self,
+            available_date: str,
+            available_time: str,
+            facility_id: Optional[str] = None
+    ) -> tuple[Optional[str], list[str]]:
+        asc_available_dates = self.get_asc_available_dates(available_date, available_time, facility_id=facility_id)
+
+        if not asc_available_dates:
+            return None, []
+
+        asc_available_date = self.select_asc_date(available_date, asc_available_dates)
+        return asc_available_date, self.get_asc_available_times(
+            asc_available_date,
+            available_date,
+            available_time,
+            facility_id=facility_id
+        )
+
+    def facility_label(self, facility_id: Optional[str]) -> str:
+        return f"Facility {facility_id}: " if len(self.facilities) > 1 else ""
+
+    def scan_facilities(self) -> list[str]:
+        if len(self.facilities) <= self.config.scan_budget:
+            return list(self.facilities)
+
+        # smooth weighted round-robin: every facility earns its weight, the richest ones are polled and pay for it
+        total = sum(self.facilities.values())
+        for facility_id, weight in self.facilities.items():
+            self.scan_credits[facility_id] = self.scan_credits.get(facility_id, 0) + weight
+        facility_ids = heapq.nlargest(self.config.scan_budget, self.facilities, key=self.scan_credits.__getitem__)
+        for facility_id in facility_ids:
+            self.scan_credits[facility_id] -= total / self.config.scan_budget
+        return facility_ids
+
+    def fetch_available_dates(self, facility_ids: list[str]) -> dict[str, list[str]]:
+        if len(facility_ids) == 1:
+            return {facility_ids[0]: self.get_available_dates(facility_ids[0])}
+
+        with ThreadPoolExecutor(max_workers=min(len(facility_ids), self.config.pool_size)) as executor:
+            futures = {x: executor.submit(self.get_available_dates, x) for x in facility_ids}
+
+        available = dict()
+        errors = []
+        for facility_id, future in futures.items():
+            # noinspection PyBroadException
             try:
-                now = datetime.now()
-                mod = now.minute % 5
+                available[facility_id] = future.result()
+            except HTTPError as err:
+                if err.response.status_code == 401:
+                    raise err
+                errors.append(err)
+            except Exception as err:
+                errors.append(err)
+
+        if errors and not available:
+            raise errors[0]
+        for err in errors:
+            self.logger(err)
+        return available
+
+    def rank(self, facility_id: Optional[str], available_date: str) -> tuple[float, str]:
+        # a facility with weight 2 is worth waiting twice as long for
+        days = date_ordinal(available_date) - date.fromtimestamp(self.clock.now()).toordinal()
+        return days / self.facilities.get(facility_id, 1.0), available_date
+
+    def diff_available_dates(self, facility_id: str, available_dates: list[str]) -> list[str]:
+        label = self.facility_label(facility_id)
+        availability = self.tracker(facility_id)
+        appeared, gone = availability.update(available_dates)
+
+        if not available_dates:
+            if gone:
+                self.logger(f"{label}No available dates")
+            else:
+                self.logger.debug(f"{label}No available dates")
+            return []
+
+        if appeared or gone:
+            self.logger(
+                f"{label}All available dates: {summarize(available_dates)}, "
+                f"new: {summarize(appeared)}, gone: {summarize(gone)}"
+            )
+        else:
+            self.logger.debug(f"{label}Available dates unchanged: {summarize(available_dates)}")
+
+        candidate_dates = self.get_candidate_dates(available_dates, facility_id)
+        changed_dates = availability.changed(candidate_dates, self.clock.now())
+        if len(changed_dates) < len(candidate_dates):
+            self.logger.debug(
+                f"{label}Skip dates checked in the last {self.config.times_ttl} s: "
+                f"{summarize([x for x in candidate_dates if x not in changed_dates])}"
+            )
+        return changed_dates
 
-                if mod != 0 or now.second < 10:
-                    if now.second % 10 == 0:
-                        self.logger("Wait")
-                    continue
+    def get_candidate_dates(self, available_dates: list[str], facility_id: Optional[str] = None) -> list[str]:
+        candidate_dates = []
+        min_ordinal = self.config.min_date.toordinal()
+        appointment_ordinal = self.appointment_bound(facility_id)
+        max_ordinal = self.config.max_date.toordinal() if self.config.max_date else None
 
-                try:
-                    available_dates = self.get_available_dates()
-                except HTTPError as err:
-                    if err.response.status_code != 401:
-                        raise err
+        for available_date_str in available_dates:
+            available_ordinal = date_ordinal(available_date_str)
+
+            if available_ordinal <= min_ordinal:
+                self.logger.debug(
+                    f"Date {available_date_str} is lower than your minimal date "
+                    f"{self.config.min_date.strftime(DATE_FORMAT)}"
+                )
+                continue
 
-                    self.logger("Get 401")
-                    self.init()
-                    available_dates = self.get_available_dates()
+            if appointment_ordinal is not None and available_ordinal >= appointment_ordinal:
+                self.logger.debug(
+                    f"Date {available_date_str} does not rank better than your current date "
+                    f"{self.appointment_datetime.strftime(DATE_FORMAT)}"
+                )
+                break
 
-                if not available_dates:
-                    self.logger("No available dates")
-                    continue
+            if max_ordinal is not None and available_ordinal > max_ordinal:
+                self.logger.debug(
+                    f"Date {available_date_str} is greater than your maximal date "
+                    f"{self.config.max_date.strftime(DATE_FORMAT)}"
+                )
+                break
 
-                self.logger(f"All available dates: {available_dates}")
+            candidate_dates.append(available_date_str)
 
-                reinit_asc = False
-                for available_date_str in available_dates:
-                    self.logger(f"Next nearest date: {available_date_str}")
+        return candidate_dates
 
-                    available_date = parse_date(available_date_str)
+    def prefetch(self, candidate_dates: list[tuple[str, str]]):
+        self.prefetched_times = dict()
+        self.prefetched_asc_slots = dict()
 
-                    if available_date <= self.config.min_date:
-                        self.logger(
-                            "Nearest date is lower than your minimal date "
-                            f"{self.config.min_date.strftime(DATE_FORMAT)}"
-                        )
-                        continue
+        candidate_dates = candidate_dates[:self.config.prefetch_dates]
+        if len(candidate_dates) < 2:
+            return
 
-                    if self.appointment_datetime and available_date >= self.appointment_datetime.date():
-                        self.logger(
-                            "Nearest date is greater than your current date "
-                            f"{self.appointment_datetime.strftime(DATE_FORMAT)}"
-                        )
-                        break
+        self.logger(f"Prefetch times for dates: {[x[1] for x in candidate_dates]}")
+        with ThreadPoolExecutor(max_workers=min(len(candidate_dates), self.config.pool_size)) as executor:
+            for facility_id, available_date in candidate_dates:
+                executor.submit(self.prefetch_date, facility_id, available_date)
 
-                    if self.config.max_date and available_date > self.config.max_date:
-                        self.logger(
-                            "Nearest date is greater than your maximal date "
-                            f"{self.config.max_date.strftime(DATE_FORMAT)}"
-                        )
-                        break
-
-                    available_times = self.get_available_times(available_date_str)
-                    if not available_times:
-                        self.logger("No available times")
-                        continue
-
-                    self.logger(f"All available times for date {available_date_str}: {available_times}")
-
-                    booked = False
-                    for available_time_str in available_times:
-                        self.logger(f"Next nearest time: {available_time_str}")
-
-                        asc_available_date_str = None
-                        asc_available_time_str = None
-
-                        if self.config.need_asc:
-                            asc_available_date_str = None
-                            asc_available_time_str = None
-
-                            min_asc_date = available_date - timedelta(days=7)
-
-                            for k, v in self.asc_dates.items():
-                                if min_asc_date <= parse_date(k) < available_date and len(v) > 0:
-                                    asc_available_date_str = k
-                                    asc_available_time_str = random.choice(v)
-                                    break
-
-                            if not asc_available_date_str or not asc_available_time_str:
-                                asc_available_dates = self.get_asc_available_dates(
-                                    available_date_str,
-                                    available_time_str
-                                )
-
-                                if not asc_available_dates:
-                                    self.logger("No available ASC dates")
-                                    break
-
-                                asc_available_date_str = asc_available_dates[0]
-
-                                asc_available_times = self.get_asc_available_times(
-                                    asc_available_date_str,
-                                    available_date_str,
-                                    available_time_str
-                                )
-
-                                if not asc_available_times:
-                                    self.logger("No available ASC times")
-                                    continue
-
-                                asc_available_time_str = random.choice(asc_available_times)
-
-                        log = (
-                            "=====================\n"
-                            "#                   #\n"
-                            "#                   #\n"
-                            "#    Try to book    #\n"
-                            "#                   #\n"
-                            "#                   #\n"
-                            f"# {available_time_str}  {available_date_str} #\n"
-                        )
+    def prefetch_date(self, facility_id: str, available_date: str):
+        # noinspection PyBroadException
+        try:
+            available_times = self.get_available_times(available_date, facility_id)
+        except Exception as err:
+            self.logger(err)
+            return
 
-                        if asc_available_date_str and asc_available_time_str:
-                            log += (
-                                "#                   #\n"
-                                "#                   #\n"
-                                "#     With  ASC     #\n"
-                                f"# {asc_available_time_str}  {asc_available_date_str} #\n"
-                            )
-
-                        log += (
-                            "#                   #\n"
-                            "#                   #\n"
-                            "====================="
-                        )
+        self.prefetched_times[(facility_id, available_date)] = available_times
+
+        if (not self.config.need_asc or not available_times or
+                self.find_asc_slot(date_ordinal(available_date), self.asc_store(self.asc_facility_of(facility_id)))):
+            return
+
+        # noinspection PyBroadException
+        try:
+            self.prefetched_asc_slots[(facility_id, available_date, available_times[0])] = self.get_asc_slot(
+                available_date,
+                available_times[0],
+                facility_id
+            )
+        except Exception as err:
+            self.logger(err)
+
+    def fetch_available_times(self, available_date: str, facility_id: Optional[str] = None) -> list[str]:
+        available_times = self.prefetched_times.pop((facility_id, available_date), None)
+        if available_times is None:
+            return self.get_available_times(available_date, facility_id)
+        return available_times
+
+    def fetch_asc_slot(
+            self,
+            available_date: str,
+            available_time: str,
+            facility_id: Optional[str] = None
+    ) -> tuple[Optional[str], list[str]]:
+        asc_slot = self.prefetched_asc_slots.pop((facility_id, available_date, available_time), None)
+        if asc_slot is None:
+            return self.get_asc_slot(available_date, available_time, facility_id)
+        return asc_slot
+
+    def process(self):
+        self.init()
+
+        self.scheduler = Scheduler(self.clock, self.logger)
+        self.schedule_polls()
+        try:
+            self.scheduler.run()
+        except KeyboardInterrupt:
+            return
+
+    def schedule_polls(self):
+        self.scheduler.clear()
+        self.scheduler.add(
+            self.poll_policy(),
+            self.scheduled_poll,
+            self.warm_up,
+            self.config.warm_up_seconds
+        )
 
-                        self.logger(log)
+    def reload_config(self) -> dict[str, list[str]]:
+        config = Config(self.config.config_file, interactive=False)
+        changed = [
+            x for x, value in vars(config).items()
+            if x not in ("config_file", "interactive") and value != getattr(self.config, x, None)
+        ]
+        kept = [x for x in changed if x in RESTART_KEYS]
+        for key in kept:
+            setattr(config, key, getattr(self.config, key))
+        applied = [x for x in changed if x not in kept]
+        if kept:
+            self.logger(f"Reload keeps {', '.join(x.upper() for x in kept)} until restart")
+        if not applied:
+            return {"applied": [], "restart": [x.upper() for x in kept]}
+
+        self.logger(f"Reload {', '.join(x.upper() for x in applied)}")
+        previous = self.config
+        self.config = config
+        relocated = any(x in LOCATION_KEYS for x in applied)
+        if relocated:
+            # resolve before anything else changes, a failure leaves the running config as it was
+            try:
+                self.init_locations()
+            except Exception:
+                self.config = previous
+                self.init_facilities()
+                raise
+        # the session, its cookie and the connection pool stay, only what is derived from the config is rebuilt
+        self.session_cache.ttl = config.session_ttl
+        for store in (self.asc_dates, *self.asc_stores.values()):
+            store.ttl = config.asc_ttl
+        self.availability = AvailabilityTracker(config.times_ttl)
+        self.trackers = dict()
+        self.governor = RateGovernor(
+            self.governor.store,
+            config.rate_limit / 60,
+            config.account_rate_limit / 60,
+            config.rate_burst,
+            config.backoff_max,
+            config.hedge_rate / 60
+        )
+        self.timeouts = parse_timeouts(config.timeouts, config.connect_timeout, config.read_timeout)
+        self.hedged = set(parse_pairs(config.hedge))
+
+        if relocated:
+            if config.asc_facility_id != previous.asc_facility_id:
+                self.asc_dates.retain([])
+            self.scan_credits = dict()
+            self.init_asc_dates()
+            self.save_session()
+        if self.scheduler and any(x in SCHEDULE_KEYS for x in applied):
+            self.schedule_polls()
+
+        return {"applied": [x.upper() for x in applied], "restart": [x.upper() for x in kept]}
+
+    def status(self) -> dict:
+        due = self.scheduler.next_due() if self.scheduler else None
+        return {
+            "account": self.account,
+            "appointment": self.appointment_datetime.strftime(DATE_TIME_FORMAT) if self.appointment_datetime else None,
+            "running": bool(self.scheduler and self.scheduler.running),
+            "paused": bool(self.scheduler and self.scheduler.paused),
+            "next_poll": datetime.fromtimestamp(due).isoformat(timespec="seconds") if due else None,
+            "facilities": list(self.facilities),
+            "min_date": self.config.min_date.isoformat(),
+            "max_date": self.config.max_date.isoformat() if self.config.max_date else None,
+            "need_asc": self.config.need_asc,
+            "logins": self.logins
+        }
+
+    @property
+    def schedule_key(self) -> str:
+        if self.config.poll_schedule == ADAPTIVE_SCHEDULE:
+            return f"{ADAPTIVE_SCHEDULE} {self.config.country} {self.config.facility_id} {self.config.poll_budget}"
+        return self.config.poll_schedule
+
+    def poll_policy(self) -> SchedulePolicy:
+        if self.config.poll_schedule != ADAPTIVE_SCHEDULE:
+            return parse_schedule(self.config.poll_schedule)
+
+        return AdaptivePolicy(
+            self.config.poll_budget,
+            self.config.poll_quiet_interval,
+            functools.partial(self.history.releases, self.config.country, self.config.facility_id)
+            if self.history else None
+        )
+
+    def scheduled_poll(self):
+        try:
+            self.poll()
+        except AppointmentDateLowerMinDate as err:
+            self.logger(err)
+            self.scheduler.stop()
+        except Exception as err:
+            self.logger(err)
+
+    def iter_candidates(self, candidate_dates: list[tuple[str, str]]) -> Iterator[BookingCandidate]:
+        asc_pairs = self.pair_asc_dates(candidate_dates) if self.config.need_asc else dict()
+
+        for facility_id, available_date_str in candidate_dates:
+            label = self.facility_label(facility_id)
+            self.logger(f"{label}Next nearest date: {available_date_str}")
+
+            available_ordinal = date_ordinal(available_date_str)
+            asc_facility_id = self.asc_facility_of(facility_id) if self.config.need_asc else None
+            asc_store = self.asc_store(asc_facility_id)
+
+            available_times = self.fetch_available_times(available_date_str, facility_id)
+            self.tracker(facility_id).settle(available_date_str, self.clock.now())
+            if not available_times:
+                self.logger("No available times")
+                continue
+
+            self.logger(f"All available times for date {available_date_str}: {summarize(available_times)}")
+
+            for available_time_str in available_times:
+                self.logger.debug(f"Next nearest time: {available_time_str}")
+
+                candidate = BookingCandidate(available_date_str, available_time_str, facility_id, asc_facility_id)
 
-                        self.book(
+                if self.config.need_asc:
+                    asc_slot = asc_pairs.get((facility_id, available_date_str))
+                    if asc_slot:
+                        asc_times = asc_store.get(asc_slot[0])
+                        asc_slot = (asc_slot[0], asc_times) if asc_times \
+                            else self.find_asc_slot(available_ordinal, asc_store)
+                        asc_pairs[(facility_id, available_date_str)] = asc_slot
+
+                    if asc_slot:
+                        candidate.asc_available_date = asc_slot[0]
+                        candidate.asc_available_time = random.choice(asc_slot[1])
+                        candidate.asc_from_store = True
+                    else:
+                        asc_available_date, asc_available_times = self.fetch_asc_slot(
                             available_date_str,
                             available_time_str,
-                            asc_available_date_str,
-                            asc_available_time_str
+                            facility_id
                         )
 
-                        appointment_datetime = self.appointment_datetime
-                        self.init_current_data()
-
-                        if appointment_datetime != self.appointment_datetime:
-                            log = (
-                                "=====================\n"
-                                "#                   #\n"
-                                "#                   #\n"
-                                "#     Booked at     #\n"
-                                "#                   #\n"
-                                "#                   #\n"
-                                f"# {self.appointment_datetime.strftime(DATE_TIME_FORMAT)} #\n"
-                            )
-
-                            if asc_available_date_str and asc_available_time_str:
-                                log += (
-                                    "#                   #\n"
-                                    "#                   #\n"
-                                    "#     With  ASC     #\n"
-                                    f"# {asc_available_time_str}  {asc_available_date_str} #\n"
-                                )
-
-                            log += (
-                                "#                   #\n"
-                                "#                   #\n"
-                                "#  Close window to  #\n"
-                                "#    end awaiting   #\n"
-                                "====================="
-                            )
-
-                            self.logger(log)
-                            booked = True
+                        if not asc_available_date:
+                            self.logger("No available ASC dates")
                             break
 
-                    reinit_asc = True
+                        candidate.asc_available_date = asc_available_date
 
-                    if booked:
-                        break
+                        if not asc_available_times:
+                            self.logger("No available ASC times")
+                            continue
 
-                if reinit_asc and self.config.need_asc:
-                    self.init_asc_dates()
+                        candidate.asc_available_time = random.choice(asc_available_times)
 
-            except KeyboardInterrupt:
-                return
-            except AppointmentDateLowerMinDate as err:
-                self.logger(err)
-                return
-            except Exception as err:
-                self.logger(err)
+                self.prepare_booking(candidate)
+                yield candidate
+
+    def log_booking(self, candidate: BookingCandidate):
+        log = (
+            "=====================\n"
+            "#                   #\n"
+            "#                   #\n"
+            "#    Try to book    #\n"
+            "#                   #\n"
+            "#                   #\n"
+            f"# {candidate.available_time}  {candidate.available_date} #\n"
+        )
+
+        if candidate.asc_available_date and candidate.asc_available_time:
+            log += (
+                "#                   #\n"
+                "#                   #\n"
+                "#     With  ASC     #\n"
+                f"# {candidate.asc_available_time}  {candidate.asc_available_date} #\n"
+            )
+
+        log += (
+            "#                   #\n"
+            "#                   #\n"
+            "====================="
+        )
+
+        self.logger(log)
+
+    def log_booked(self, candidate: BookingCandidate):
+        log = (
+            "=====================\n"
+            "#                   #\n"
+            "#                   #\n"
+            "#     Booked at     #\n"
+            "#                   #\n"
+            "#                   #\n"
+            f"# {self.appointment_datetime.strftime(DATE_TIME_FORMAT)} #\n"
+        )
+
+        if candidate.asc_available_date and candidate.asc_available_time:
+            log += (
+                "#                   #\n"
+                "#                   #\n"
+                "#     With  ASC     #\n"
+                f"# {candidate.asc_available_time}  {candidate.asc_available_date} #\n"
+            )
+
+        log += (
+            "#                   #\n"
+            "#                   #\n"
+            "#  Close window to  #\n"
+            "#    end awaiting   #\n"
+            "====================="
+        )
+
+        self.logger(log)
+
+    def poll(self):
+        METRICS.inc("ais_polls_total", account=self.account)
+        facility_ids = self.scan_facilities()
+        try:
+            available = self.fetch_available_dates(facility_ids)
+        except HTTPError as err:
+            if err.response.status_code != 401:
+                raise err
+
+            self.logger("Get 401")
+            METRICS.inc("ais_unauthorized_total", account=self.account)
+            self.refresh_credentials()
+            available = self.fetch_available_dates(facility_ids)
+
+        candidate_dates = sorted(
+            ((facility_id, x) for facility_id, available_dates in available.items()
+             for x in self.diff_available_dates(facility_id, available_dates)),
+            key=lambda x: self.rank(*x)
+        )
+        if not candidate_dates:
+            return
+        self.prefetch(candidate_dates)
+
+        candidates = self.iter_candidates(candidate_dates)
+        batch_size = self.config.book_parallel
+
+        reinit_asc = False
+        try:
+            while True:
+                batch = list(itertools.islice(candidates, batch_size))
+                if not batch:
+                    break
+
+                reinit_asc = True
+                limits = self.improvement_limits()
+                batch = sorted(
+                    (x for x in batch if self.is_improvement(x, limits)),
+                    key=lambda x: (self.rank(x.facility_id, x.available_date), x.key)
+                )
+                if not batch:
+                    continue
+
+                results = self.book_batch(batch)
+
+                for candidate, result in zip(batch, results):
+                    if result in (BOOKING_SLOT_TAKEN, BOOKING_CSRF_EXPIRED) and candidate.asc_from_store:
+                        self.asc_store(candidate.asc_facility_id).remove_time(
+                            candidate.asc_available_date,
+                            candidate.asc_available_time
+                        )
+                    if result != BOOKING_SLOT_TAKEN:
+                        self.tracker(candidate.facility_id).invalidate(candidate.available_date)
+
+                if BOOKING_BOOKED in results:
+                    self.log_booked(batch[results.index(BOOKING_BOOKED)])
+                    METRICS.inc("ais_bookings_total", account=self.account)
+                    self.invalidate_availability()
+                    self.save_session()
+                    break
+
+                if BOOKING_LIMIT_REACHED in results:
+                    self.logger("Booking limit reached")
+                    break
+        except Exception:
+            self.invalidate_availability()
+            raise
+
+        if reinit_asc and self.config.need_asc:
+            self.refresh_asc_dates()
+
+    def invalidate_availability(self):
+        self.availability.invalidate()
+        for tracker in self.trackers.values():
+            tracker.invalidate()
+
+
+class Orchestrator:
+    def __init__(self, bots: list[Bot], logger: Logger, workers: int, clock: Optional[Clock] = None):
+        self.bots = bots
+        self.logger = logger
+        self.workers = workers
+        self.not_initialized = set(bots)
+        self.scheduler = Scheduler(clock, logger)
+
+    def process(self):
+        try:
+            asyncio.run(self.run())
+        except KeyboardInterrupt:
+            return
+
+    async def run(self):
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=self.workers))
+
+        self.logger(f"Start {len(self.bots)} accounts")
+        await asyncio.gather(*[self.init_bot(x) for x in self.bots])
+
+        schedules = dict[str, list[Bot]]()
+        for bot in self.bots:
+            schedules.setdefault(bot.schedule_key, []).append(bot)
+        for bots in schedules.values():
+            self.scheduler.add(
+                bots[0].poll_policy(),
+                functools.partial(self.poll_bots, bots),
+                functools.partial(self.warm_up_bots, bots),
+                bots[0].config.warm_up_seconds
+            )
+
+        await self.scheduler.run_async()
+
+    async def warm_up_bots(self, bots: list[Bot]):
+        # Bots share the connection pool, so it is enough to open enough connections through one of them
+        bots = [x for x in bots if x in self.bots]
+        if bots:
+            connections = min(sum(x.config.warm_connections for x in bots), self.workers)
+            await asyncio.to_thread(bots[0].warm_up, connections)
+
+    async def poll_bots(self, bots: list[Bot]):
+        await asyncio.gather(*[self.poll_bot(x) for x in bots if x in self.bots])
+        if not self.bots:
+            self.scheduler.stop()
+
+    async def init_bot(self, bot: Bot):
+        try:
+            await asyncio.to_thread(bot.init)
+            self.not_initialized.discard(bot)
+        except AppointmentDateLowerMinDate as err:
+            bot.logger(err)
+            self.bots.remove(bot)
+        except Exception as err:
+            bot.logger(err)
+
+    async def poll_bot(self, bot: Bot):
+        if bot in self.not_initialized:
+            await self.init_bot(bot)
+            return
+
+        try:
+            await asyncio.to_thread(bot.poll)
+        except AppointmentDateLowerMinDate as err:
+            bot.logger(err)
+            self.bots.remove(bot)
+        except Exception as err:
+            bot.logger(err)
+
+
+def create_bot(
+        config: Config,
+        logger: Logger | AccountLogger,
+        asc_file: str,
+        session_file: str,
+        adapter: Optional[HTTPAdapter] = None,
+        base_url: str = BASE_URL,
+        history: Optional[HistoryStore] = None,
+        rate_store: Optional[RateStore] = None,
+        clock: Optional[Clock] = None
+) -> Bot:
+    return Bot(config, logger, asc_file, session_file, adapter, base_url, history, rate_store, clock)
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    def log_message(self, log_format: str, *args):
+        pass
+
+    def reply(self, status: int, data: dict):
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header(CONTENT_TYPE, "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/status":
+            self.send_error(404)
+            return
+        self.reply(200, self.server.bot.status())
+
+    def do_POST(self):
+        command = self.path.split("?")[0].strip("/")
+        if command not in CONTROL_COMMANDS[1:]:
+            self.send_error(404)
+            return
+
+        bot = self.server.bot
+        scheduler = bot.scheduler
+        if not scheduler:
+            self.reply(503, {"error": "Not started yet"})
+            return
+
+        # noinspection PyBroadException
+        try:
+            if command == "reload":
+                result = scheduler.call(bot.reload_config).result()
+            elif command == "poll":
+                result = scheduler.call(bot.scheduled_poll).result()
+            else:
+                result = scheduler.pause(command == "pause")
+        except Exception as err:
+            self.reply(400, {"error": str(err)})
+            return
+        self.reply(200, {**(result or dict()), "status": bot.status()})
+
+
+def start_control_server(port: int, bot: Bot) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", port), ControlHandler)
+    server.daemon_threads = True
+    server.bot = bot
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def send_control(port: int, command: str) -> dict:
+    url = f"http://127.0.0.1:{port}/{command}"
+    response = requests.get(url) if command == "status" else requests.post(url)
+    return response.json()
+
+
+def load_accounts(accounts_file: str) -> list[str]:
+    with open(accounts_file) as f:
+        return [x.strip() for x in f.readlines() if x.strip() and not x.strip().startswith("#")]
+
+
+def create_adapter(pool_size: int, record: Optional[str], replay: Optional[str], speed: float) -> HTTPAdapter:
+    if record:
+        return RecordingAdapter(Cassette(record), pool_connections=1, pool_maxsize=pool_size)
+    if replay:
+        return ReplayAdapter(replay, speed)
+    return HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+
+
+def replay_directory() -> str:
+    # replayed answers carry redacted cookies and old dates, they must not reach the real session, ASC and history
+    directory = tempfile.mkdtemp(prefix="replay-")
+    atexit.register(shutil.rmtree, directory, True)
+    return directory
+
+
+def run_accounts(
+        accounts_file: str,
+        workers: int,
+        metrics_port: int,
+        record: Optional[str] = None,
+        replay: Optional[str] = None,
+        replay_speed: float = 1.0
+):
+    configs = [(x, Config(x)) for x in load_accounts(accounts_file)]
+    # the accounts share one log, it takes the LOG_* settings of the first account
+    logger = Logger(
+        LOG_FILE,
+        LOG_FORMAT,
+        configs[0][1].log_level,
+        configs[0][1].log_max_bytes,
+        configs[0][1].log_backup_count,
+        configs[0][1].log_rotate_when
+    ) if configs else Logger(LOG_FILE, LOG_FORMAT)
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    adapter = create_adapter(workers, record, replay, replay_speed)
+    history = HistoryStore(HISTORY_FILE, logger).start() if not replay else None
+    directory = replay_directory() if replay else None
+    # accounts of one process share the host budget, RATE_FILE shares it with other processes too
+    rate_stores = dict[Optional[str], RateStore]()
+    # all accounts talk to one server, so they share its clock estimate and the scheduler runs on it
+    clock = ServerClock()
+
+    bots = []
+    for i, (config_file, config) in enumerate(configs):
+        account_logger = AccountLogger(logger, os.path.basename(config_file))
+        if config.rate_file not in rate_stores:
+            rate_stores[config.rate_file] = create_rate_store(config.rate_file)
+        state_file = os.path.join(directory, str(i)) if directory else config_file
+        bots.append(create_bot(
+            config,
+            account_logger,
+            f"{state_file}.{ASC_FILE}",
+            f"{state_file}.{SESSION_FILE}",
+            adapter,
+            history=history,
+            rate_store=rate_stores[config.rate_file],
+            clock=clock if config.clock_sync else None
+        ))
+
+    Orchestrator(bots, logger, workers, clock).process()
+
+
+def query_history(history_file: str, country: str, facility_id: str, before: date, days: int):
+    if not os.path.exists(history_file):
+        print(f"No history in {history_file}")
+        return
+
+    rows = HistoryStore(history_file).query_earlier(
+        country,
+        facility_id,
+        before,
+        time.time() - days * 24 * 3600
+    )
+    if not rows:
+        print(f"No dates earlier than {before} for facility {facility_id} in the last {days} days")
+        return
+
+    print(f"{'first seen':<21}{'last seen':<21}{'polls':>5}  {'earliest':<12}{'dates':>6}")
+    for first_seen, last_seen, polls, earliest, count in rows:
+        print(f"{first_seen:%Y-%m-%d %H:%M:%S}  {last_seen:%Y-%m-%d %H:%M:%S}  {polls:>5}  {earliest}  {count:>6}")
 
 
 def main():
-    config = Config(CONFIG_FILE)
-    logger = Logger(LOG_FILE, LOG_FORMAT)
-    Bot(config, logger, ASC_FILE).process()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--accounts",
+        help="file with config file paths (one per line) to run in one process"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="maximal number of concurrent requests in accounts mode"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="serve Prometheus metrics on http://127.0.0.1:<port>/metrics in accounts mode"
+    )
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument(
+        "--record",
+        metavar="CASSETTE",
+        help="record every request and response into a cassette file, credentials and cookies are redacted"
+    )
+    cassette_group.add_argument(
+        "--replay",
+        metavar="CASSETTE",
+        help="answer requests from a cassette file instead of the site"
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="replay speed of the recorded response times, 0 answers at once (default 1)"
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="run without prompts and serve the control API on 127.0.0.1, the config must be complete"
+    )
+    parser.add_argument(
+        "--control-port",
+        type=int,
+        default=DEFAULT_CONTROL_PORT,
+        help=f"control API port of --daemon and of the control command (default {DEFAULT_CONTROL_PORT})"
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    control_parser = subparsers.add_parser("control", help="send a command to a running daemon")
+    control_parser.add_argument("action", choices=CONTROL_COMMANDS)
+    history_parser = subparsers.add_parser("history", help="query the availability history")
+    history_parser.add_argument("--country", required=True, help="country code, e.g. ca")
+    history_parser.add_argument("--facility", required=True, help="facility id")
+    history_parser.add_argument("--before", required=True, type=parse_date, help="YYYY-MM-DD")
+    history_parser.add_argument("--days", type=int, default=30, help="look back this many days (default 30)")
+    history_parser.add_argument("--file", default=HISTORY_FILE, help=f"history file (default {HISTORY_FILE})")
+    args = parser.parse_args()
+
+    if args.command == "history":
+        query_history(args.file, args.country, args.facility, args.before, args.days)
+        return
+
+    if args.command == "control":
+        print(json.dumps(send_control(args.control_port, args.action), indent=2))
+        return
+
+    if args.accounts and args.daemon:
+        parser.error("--daemon runs a single config, not --accounts")
+
+    if args.accounts:
+        run_accounts(args.accounts, args.workers, args.metrics_port, args.record, args.replay, args.replay_speed)
+        return
+
+    config = Config(CONFIG_FILE, interactive=not args.daemon)
+    logger = Logger(
+        LOG_FILE,
+        LOG_FORMAT,
+        config.log_level,
+        config.log_max_bytes,
+        config.log_backup_count,
+        config.log_rotate_when
+    )
+    if config.metrics_port:
+        start_metrics_server(config.metrics_port)
+    adapter = create_adapter(config.pool_size, args.record, args.replay, args.replay_speed)
+    if args.replay:
+        directory = replay_directory()
+        bot = create_bot(
+            config,
+            logger,
+            os.path.join(directory, ASC_FILE),
+            os.path.join(directory, SESSION_FILE),
+            adapter
+        )
+    else:
+        history = HistoryStore(HISTORY_FILE, logger).start() if config.history else None
+        bot = create_bot(config, logger, ASC_FILE, SESSION_FILE, adapter, history=history)
+    if args.daemon:
+        start_control_server(args.control_port, bot)
+        logger(f"Control API on http://127.0.0.1:{args.control_port}")
+    bot.process()
 
 
 if __name__ == "__main__":
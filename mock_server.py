@@ -0,0 +1,491 @@
+import argparse
+import json
+import random
+import re
+import secrets
+import ssl
+import sys
+import threading
+import time
+from datetime import datetime
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+
+PAGE_PADDING = 200
+SESSION_COOKIE = "_yatri_session"
+ENDPOINTS = {
+    ("GET", "/users/sign_in"): "sign_in_page",
+    ("POST", "/users/sign_in"): "sign_in",
+    ("GET", ""): "dashboard",
+    ("GET", "/schedule/{id}/appointment"): "appointment",
+    ("GET", "/schedule/{id}/appointment/days/{id}.json"): "days",
+    ("GET", "/schedule/{id}/appointment/times/{id}.json"): "times",
+    ("POST", "/schedule/{id}/appointment"): "book",
+    ("GET", "/schedule/{id}/appointment/instructions"): "instructions",
+}
+
+
+def page(head: str, body: str) -> str:
+    navigation = "".join(
+        f'<li class="menu-item"><a href="/en-ca/niv/page/{i}">Menu item {i}</a></li>' for i in range(PAGE_PADDING)
+    )
+    script = "".join(f"var value{i} = {{\"key\": \"{'x' * 40}\", \"index\": {i}}};\n" for i in range(PAGE_PADDING))
+    footer = "".join(f'<div class="footer-column"><p>Footer text {i}</p></div>' for i in range(PAGE_PADDING))
+    return (
+        "<!DOCTYPE html>\n<html lang=\"en\"><head>"
+        "<meta charset=\"utf-8\"><title>Nonimmigrant Visa - Schedule Appointment</title>"
+        f"{head}"
+        f"<script>{script}</script>"
+        "</head><body>"
+        f"<nav><ul>{navigation}</ul></nav>"
+        f"<div id=\"main\"><div class=\"mainContent\">{body}</div></div>"
+        f"<footer>{footer}</footer>"
+        "</body></html>"
+    )
+
+
+def sign_in_page(csrf: str) -> str:
+    return page(
+        f'<meta name="csrf-param" content="authenticity_token"><meta name="csrf-token" content="{csrf}">',
+        '<form id="sign_in_form" action="/en-ca/niv/users/sign_in" method="post">'
+        '<input type="email" name="user[email]"><input type="password" name="user[password]"></form>'
+    )
+
+
+def dashboard_page(csrf: str, country: str, *groups: dict[str, Optional[datetime]]) -> str:
+    return page(
+        f'<meta name="csrf-token" content="{csrf}">',
+        "<h2>Groups</h2>" + "".join(applications_container(country, x) for x in groups) +
+        '<div class="other">Other content</div>'
+    )
+
+
+def applications_container(country: str, applications: dict[str, Optional[datetime]]) -> str:
+    body = ""
+    for schedule_id, appointment_datetime in applications.items():
+        consular_appt = ""
+        if appointment_datetime:
+            consular_appt = (
+                '<p class="consular-appt"><strong>Consular Appointment:</strong> '
+                f"{appointment_datetime.strftime('%d %B, %Y, %H:%M')} local time at Consulate "
+                '<a href="https://maps.google.com">Get Directions</a></p>'
+            )
+        body += (
+            '<div class="card application attend_appointment">'
+            '<div class="medium-6 columns text-right">'
+            f'<a class="button primary small" href="/en-{country}/niv/schedule/{schedule_id}/continue_actions">'
+            'Continue</a></div>'
+            '<table class="medium-12 columns"><tbody><tr>'
+            f'<td>APPLICANT {schedule_id}</td><td>AB{schedule_id}</td><td>B1/B2</td><td>Schedule {schedule_id}</td>'
+            '<td class="text-right">Actions</td></tr></tbody></table>'
+            f"{consular_appt}"
+            "</div>"
+        )
+    return f'<div class="applications">{body}</div>'
+
+
+def appointment_page(csrf: str, facilities: dict[str, str], asc_facilities: dict[str, str]) -> str:
+    def select(element_id: str, locations: dict[str, str]) -> str:
+        options = "".join(f'<option value="{k}">{v}</option>' for k, v in locations.items())
+        return f'<select name="{element_id}" id="{element_id}"><option value=""></option>{options}</select>'
+
+    return page(
+        f'<meta name="csrf-token" content="{csrf}">',
+        '<form id="appointment-form" action="/appointment" method="post">'
+        f'{select("appointments_consulate_appointment_facility_id", facilities)}'
+        f'{select("appointments_asc_appointment_facility_id", asc_facilities)}'
+        "</form>"
+    )
+
+
+class Release:
+    def __init__(self, at: float, facility_id: str, available_date: str, times: list[str]):
+        self.at = at
+        self.facility_id = facility_id
+        self.available_date = available_date
+        self.times = times
+        self.released_at: Optional[float] = None
+
+
+class MockAis:
+    def __init__(
+            self,
+            email: str = "user@example.com",
+            password: str = "password",
+            country: str = "ca",
+            schedule_id: str = "1234567",
+            facilities: Optional[dict[str, str]] = None,
+            asc_facilities: Optional[dict[str, str]] = None,
+            appointment_datetime: Optional[datetime] = None,
+            latency: float = 0.0,
+            rate_limit: int = 0,
+            rate_window: float = 60.0,
+            keep_alive: float = 5.0,
+            contention: float = 0.0,
+            stall_rate: float = 0.0,
+            stall_seconds: float = 0.0,
+            clock_skew: float = 0.0
+    ):
+        self.email = email
+        self.password = password
+        self.country = country
+        self.schedule_id = schedule_id
+        self.facilities = facilities or {"89": "Toronto", "92": "Vancouver"}
+        self.asc_facilities = asc_facilities or {"95": "Toronto ASC", "98": "Vancouver ASC"}
+        self.appointment_datetime = appointment_datetime
+        # (facility id, date, time) of an appointment booked here, a reschedule frees it again
+        self.appointment_slot: Optional[tuple[str, str, str]] = None
+        self.latency = latency
+        self.endpoint_latency: dict[str, float] = dict()
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.keep_alive = keep_alive
+        self.contention = contention
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self.clock_skew = clock_skew
+
+        self.lock = threading.RLock()
+        self.started_at = time.time()
+        # facility id -> date -> times
+        self.slots: dict[str, dict[str, list[str]]] = dict()
+        # (facility id, date, time) listed in times.json but already taken on booking
+        self.taken: set[tuple[str, str, str]] = set()
+        # (facility id, date, time) of released slots -> when another applicant books it
+        self.competitors: dict[tuple[str, str, str], float] = dict()
+        self.releases: list[Release] = []
+        self.sessions: dict[str, str] = dict()
+        self.unauthorized = 0
+        self.request_times: list[float] = []
+        self.requests: list[tuple[float, str, int]] = []
+        self.bookings: list[tuple[float, str, str, str, bool]] = []
+        self.booked = threading.Event()
+
+    def add_slots(self, facility_id: str, available_date: str, times: list[str]):
+        with self.lock:
+            self.slots.setdefault(facility_id, dict()).setdefault(available_date, [])
+            self.slots[facility_id][available_date] = sorted({*self.slots[facility_id][available_date], *times})
+
+    def add_taken_slots(self, facility_id: str, available_date: str, times: list[str]):
+        with self.lock:
+            self.add_slots(facility_id, available_date, times)
+            self.taken.update((facility_id, available_date, x) for x in times)
+
+    def release(self, at: float, facility_id: str, available_date: str, times: list[str]) -> Release:
+        release = Release(at, facility_id, available_date, times)
+        with self.lock:
+            self.releases.append(release)
+        return release
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def reject_next(self, count: int):
+        with self.lock:
+            self.unauthorized += count
+
+    def count(self, endpoint: str) -> int:
+        with self.lock:
+            return sum(1 for x in self.requests if x[1] == endpoint)
+
+    def apply_releases(self, now: float):
+        for release in self.releases:
+            if release.released_at is None and now - self.started_at >= release.at:
+                release.released_at = now
+                self.add_slots(release.facility_id, release.available_date, release.times)
+                if self.contention:
+                    for x in release.times:
+                        self.competitors[(release.facility_id, release.available_date, x)] = (
+                            now + random.expovariate(1 / self.contention)
+                        )
+
+    def apply_competitors(self, now: float):
+        for (facility_id, available_date, available_time), at in list(self.competitors.items()):
+            if now < at:
+                continue
+            del self.competitors[(facility_id, available_date, available_time)]
+            times = self.slots.get(facility_id, {}).get(available_date, [])
+            if available_time in times:
+                times.remove(available_time)
+
+    def is_rate_limited(self, now: float) -> bool:
+        if not self.rate_limit:
+            return False
+        self.request_times = [x for x in self.request_times if now - x < self.rate_window]
+        self.request_times.append(now)
+        return len(self.request_times) > self.rate_limit
+
+    def new_session(self) -> tuple[str, str]:
+        token = secrets.token_hex(16)
+        csrf = secrets.token_urlsafe(32)
+        self.sessions[token] = csrf
+        return token, csrf
+
+    def session_of(self, cookie: Optional[str]) -> Optional[str]:
+        match = re.search(rf"{SESSION_COOKIE}=([^;]+)", cookie or "")
+        if not match or match.group(1) not in self.sessions:
+            return None
+        return match.group(1)
+
+
+class MockAisHandler(BaseHTTPRequestHandler):
+    server: "MockServer"
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    @property
+    def timeout(self) -> float:
+        return self.server.state.keep_alive
+
+    def log_message(self, log_format: str, *args):
+        pass
+
+    def date_time_string(self, timestamp: Optional[float] = None) -> str:
+        # send_response adds the Date header, it follows the skewed server clock
+        return formatdate((timestamp or time.time()) + self.server.state.clock_skew, usegmt=True)
+
+    def do_HEAD(self):
+        with self.server.state.lock:
+            self.server.state.requests.append((time.time(), "head", 200))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method: str):
+        state = self.server.state
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = ""
+        if method == "POST":
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode()
+        form = {k: v[0] for k, v in parse_qs(body).items()}
+
+        prefix = f"/en-{state.country}/niv"
+        path = url.path.removeprefix(prefix)
+        endpoint = ENDPOINTS.get((method, re.sub(r"\d+", "{id}", path)), "unknown")
+
+        delay = state.endpoint_latency.get(endpoint, state.latency)
+        if state.stall_rate and random.random() < state.stall_rate:
+            delay += state.stall_seconds
+        time.sleep(delay)
+
+        with state.lock:
+            now = time.time()
+            state.apply_releases(now)
+            state.apply_competitors(now)
+
+            if state.is_rate_limited(now):
+                status, headers, content = 429, {"Retry-After": "1"}, "Rate limit exceeded"
+            elif endpoint not in ("sign_in_page", "sign_in") and state.unauthorized > 0:
+                state.unauthorized -= 1
+                status, headers, content = 401, {}, "Unauthorized"
+            else:
+                status, headers, content = self.route(state, endpoint, path, query, form, now)
+
+            state.requests.append((now, endpoint, status))
+
+        self.send(status, headers, content)
+
+    def route(
+            self,
+            state: MockAis,
+            endpoint: str,
+            path: str,
+            query: dict[str, str],
+            form: dict[str, str],
+            now: float
+    ) -> tuple[int, dict[str, str], str]:
+        if endpoint == "sign_in_page":
+            token, csrf = state.new_session()
+            return 200, self.cookie_headers(token), sign_in_page(csrf)
+
+        if endpoint == "sign_in":
+            if form.get("user[email]") != state.email or form.get("user[password]") != state.password:
+                return 401, {}, "Invalid email or password"
+            token, _ = state.new_session()
+            return 200, self.cookie_headers(token), "window.location.href = '/'"
+
+        token = state.session_of(self.headers.get("Cookie"))
+        if not token or endpoint == "unknown":
+            return (401, {}, "Unauthorized") if not token else (404, {}, "Not found")
+        headers = self.cookie_headers(token)
+        csrf = state.sessions[token]
+
+        if endpoint == "dashboard":
+            return 200, headers, dashboard_page(
+                csrf, state.country, {state.schedule_id: state.appointment_datetime}
+            )
+
+        if endpoint == "appointment":
+            return 200, headers, appointment_page(csrf, state.facilities, state.asc_facilities)
+
+        if endpoint == "instructions":
+            return 200, headers, page("", "<h2>Your appointment is scheduled</h2>")
+
+        facility_id = path.removesuffix(".json").rsplit("/", maxsplit=1)[-1]
+
+        if endpoint == "days":
+            days = [{"date": x, "business_day": True} for x in state.slots.get(facility_id, {})]
+            return 200, {**headers, "Content-Type": "application/json"}, json.dumps(days)
+
+        if endpoint == "times":
+            times = state.slots.get(facility_id, {}).get(query.get("date", ""), [])
+            return 200, {**headers, "Content-Type": "application/json"}, json.dumps({
+                "available_times": times,
+                "business_times": times
+            })
+
+        if endpoint == "book":
+            return self.book(state, headers, csrf, form, now)
+
+        return 404, {}, "Not found"
+
+    def book(
+            self,
+            state: MockAis,
+            headers: dict[str, str],
+            csrf: str,
+            form: dict[str, str],
+            now: float
+    ) -> tuple[int, dict[str, str], str]:
+        if form.get("authenticity_token") != csrf:
+            return 422, headers, "ActionController::InvalidAuthenticityToken"
+
+        facility_id = form.get("appointments[consulate_appointment][facility_id]", "")
+        available_date = form.get("appointments[consulate_appointment][date]", "")
+        available_time = form.get("appointments[consulate_appointment][time]", "")
+
+        times = state.slots.get(facility_id, {}).get(available_date, [])
+        success = available_time in times and (facility_id, available_date, available_time) not in state.taken
+        state.bookings.append((now, facility_id, available_date, available_time, success))
+
+        if not success:
+            return 200, headers, page(
+                f'<meta name="csrf-token" content="{csrf}">',
+                '<div class="flash alert">The selected appointment time is no longer available</div>'
+            )
+
+        times.remove(available_time)
+        if state.appointment_slot:
+            state.add_slots(state.appointment_slot[0], state.appointment_slot[1], [state.appointment_slot[2]])
+        state.appointment_slot = (facility_id, available_date, available_time)
+        state.appointment_datetime = datetime.strptime(f"{available_date} {available_time}", "%Y-%m-%d %H:%M")
+        state.booked.set()
+        return 302, {**headers, "Location": f"/en-{state.country}/niv/schedule/{state.schedule_id}/appointment"
+                                            "/instructions"}, ""
+
+    @staticmethod
+    def cookie_headers(token: str) -> dict[str, str]:
+        return {"Set-Cookie": f"{SESSION_COOKIE}={token}; path=/; HttpOnly"}
+
+    def send(self, status: int, headers: dict[str, str], content: str):
+        data = content.encode()
+        self.send_response(status)
+        if "Content-Type" not in headers:
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+            self,
+            state: MockAis,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            certfile: Optional[str] = None,
+            keyfile: Optional[str] = None
+    ):
+        super().__init__((host, port), MockAisHandler)
+        self.state = state
+        self.thread: Optional[threading.Thread] = None
+        self.tls = certfile is not None
+        if certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    def handle_error(self, request, client_address):
+        # clients which gave up on a stalled response are expected, anything else is still printed
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"{'https' if self.tls else 'http'}://{host}:{port}"
+
+    def start(self) -> "MockServer":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="delay of every response in seconds")
+    parser.add_argument("--rate-limit", type=int, default=0, help="requests per minute before 429, 0 disables")
+    parser.add_argument("--keep-alive", type=float, default=5.0, help="seconds before idle connections are closed")
+    parser.add_argument(
+        "--contention",
+        type=float,
+        default=0.0,
+        help="mean seconds before another applicant books each released slot, 0 disables"
+    )
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="share of responses delayed by --stall-seconds")
+    parser.add_argument("--stall-seconds", type=float, default=5.0, help="extra delay of a stalled response")
+    parser.add_argument("--clock-skew", type=float, default=0.0, help="seconds the Date header is ahead of real time")
+    parser.add_argument("--certfile", help="serve https with this certificate")
+    parser.add_argument("--keyfile", help="private key of the certificate")
+    parser.add_argument(
+        "--release",
+        action="append",
+        default=[],
+        help="scripted slot release \"SECONDS FACILITY_ID YYYY-MM-DD HH:MM[,HH:MM]\", may be repeated"
+    )
+    args = parser.parse_args()
+
+    state = MockAis(
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        keep_alive=args.keep_alive,
+        contention=args.contention,
+        stall_rate=args.stall_rate,
+        stall_seconds=args.stall_seconds,
+        clock_skew=args.clock_skew
+    )
+    for release in args.release:
+        at, facility_id, available_date, times = release.split()
+        state.release(float(at), facility_id, available_date, times.split(","))
+
+    server = MockServer(state, args.host, args.port, args.certfile, args.keyfile)
+    print(f"Mock AIS on {server.url}/en-{state.country}/niv, "
+          f"email {state.email}, password {state.password}, schedule {state.schedule_id}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()